@@ -23,7 +23,8 @@ def process_member(caller,
                    tags=None,
                    title_prefix="",
                    bookmark_count=None,
-                   notifier=None):
+                   notifier=None,
+                   stop_event=None):
     # caller function/method
     # TODO: ideally to be removed or passed as argument
     db = caller.__dbManager__
@@ -70,6 +71,9 @@ def process_member(caller,
                 except PixivException as ex:
                     caller.ERROR_CODE = ex.errorCode
                     PixivHelper.print_and_log('info', f'Member ID ({member_id}): {ex}')
+                    if ex.errorCode == PixivException.CIRCUIT_OPEN:
+                        # pixiv is failing, let the caller defer this member
+                        raise
                     if ex.errorCode == PixivException.NO_IMAGES:
                         pass
                     else:
@@ -116,77 +120,90 @@ def process_member(caller,
             db.updateMemberName(member_id, artist.artistName, artist.artistToken)
 
             result = PixivConstant.PIXIVUTIL_NOT_OK
-            for image_id in artist.imageList:
-                ui_prefix = f'{Fore.LIGHTGREEN_EX}[{no_of_images} of {artist.totalImages}]{Style.RESET_ALL} '
-                # PixivHelper.print_and_log(None, ui_prefix)
-                retry_count = 0
-                while True:
-                    try:
-                        if artist.totalImages > 0:
-                            total_image_page_count = artist.totalImages
-                            if (offset_stop > 0 and offset_stop < total_image_page_count):
-                                total_image_page_count = offset_stop
-                            total_image_page_count = total_image_page_count - offset_start
-                            # PixivHelper.safePrint("Total Images Offset = " + str(total_image_page_count))
-                        else:
-                            total_image_page_count = ((page - 1) * 20) + len(artist.imageList)
-                        title_prefix_img = f"{title_prefix}MemberId: {member_id} Page: {page} Post {no_of_images}+{updated_limit_count} of {total_image_page_count}"
-                        if not caller.DEBUG_SKIP_PROCESS_IMAGE:
-                            result = PixivImageHandler.process_image(caller,
-                                                                     config,
-                                                                     artist,
-                                                                     image_id,
-                                                                     user_dir,
-                                                                     bookmark,
-                                                                     title_prefix=title_prefix_img,
-                                                                     bookmark_count=bookmark_count,
-                                                                     notifier=notifier,
-                                                                     ui_prefix=ui_prefix)
+            # get the next image info while the current image is downloading
+            depth = 0 if caller.DEBUG_SKIP_PROCESS_IMAGE else config.prefetchImageInfo
+            with PixivImageHandler.ImagePagePrefetcher(caller, config, artist.imageList, artist, bookmark, bookmark_count, depth) as prefetcher:
+                for image_id in artist.imageList:
+                    # set when the members are processed in parallel and the user interrupted
+                    if stop_event is not None and stop_event.is_set():
+                        raise KeyboardInterrupt()
+                    ui_prefix = f'{Fore.LIGHTGREEN_EX}[{no_of_images} of {artist.totalImages}]{Style.RESET_ALL} '
+                    # PixivHelper.print_and_log(None, ui_prefix)
+                    retry_count = 0
+                    while True:
+                        try:
+                            if artist.totalImages > 0:
+                                total_image_page_count = artist.totalImages
+                                if (offset_stop > 0 and offset_stop < total_image_page_count):
+                                    total_image_page_count = offset_stop
+                                total_image_page_count = total_image_page_count - offset_start
+                                # PixivHelper.safePrint("Total Images Offset = " + str(total_image_page_count))
+                            else:
+                                total_image_page_count = ((page - 1) * 20) + len(artist.imageList)
+                            title_prefix_img = f"{title_prefix}MemberId: {member_id} Page: {page} Post {no_of_images}+{updated_limit_count} of {total_image_page_count}"
+                            if not caller.DEBUG_SKIP_PROCESS_IMAGE:
+                                result = PixivImageHandler.process_image(caller,
+                                                                         config,
+                                                                         artist,
+                                                                         image_id,
+                                                                         user_dir,
+                                                                         bookmark,
+                                                                         title_prefix=title_prefix_img,
+                                                                         bookmark_count=bookmark_count,
+                                                                         notifier=notifier,
+                                                                         ui_prefix=ui_prefix,
+                                                                         prefetched=prefetcher.get(image_id))
 
-                        break
-                    except KeyboardInterrupt:
-                        result = PixivConstant.PIXIVUTIL_KEYBOARD_INTERRUPT
-                        break
-                    except BaseException:
-                        if retry_count > config.retry:
-                            PixivHelper.print_and_log('error', f"Giving up image_id: {image_id}")
-                            return
-                        retry_count = retry_count + 1
-                        PixivHelper.print_and_log(None, f"Stuff happened, trying again after 2 second ({retry_count})")
-                        exc_type, exc_value, exc_traceback = sys.exc_info()
-                        traceback.print_exception(exc_type, exc_value, exc_traceback)
-                        PixivHelper.print_and_log("error", f"Error at process_member(): {sys.exc_info()} Member Id: {member_id}")
-                        PixivHelper.print_delay(2)
+                            break
+                        except KeyboardInterrupt:
+                            result = PixivConstant.PIXIVUTIL_KEYBOARD_INTERRUPT
+                            break
+                        except BaseException:
+                            if retry_count > config.retry:
+                                PixivHelper.print_and_log('error', f"Giving up image_id: {image_id}")
+                                return
+                            retry_count = retry_count + 1
+                            PixivHelper.print_and_log(None, f"Stuff happened, trying again after 2 second ({retry_count})")
+                            exc_type, exc_value, exc_traceback = sys.exc_info()
+                            traceback.print_exception(exc_type, exc_value, exc_traceback)
+                            PixivHelper.print_and_log("error", f"Error at process_member(): {sys.exc_info()} Member Id: {member_id}")
+                            PixivHelper.print_delay(2)
 
-                no_of_images = no_of_images + 1
+                    # show the progress of the member post by post when the members are processed in parallel
+                    PixivHelper.flush_captured_output()
+                    no_of_images = no_of_images + 1
                 
-                if result in (PixivConstant.PIXIVUTIL_SKIP_DUPLICATE,
-                              PixivConstant.PIXIVUTIL_SKIP_LOCAL_LARGER,
-                              PixivConstant.PIXIVUTIL_SKIP_DUPLICATE_NO_WAIT):
-                    updated_limit_count = updated_limit_count + 1
-                    if config.checkUpdatedLimit != 0 and updated_limit_count >= config.checkUpdatedLimit:
-                        PixivHelper.safePrint(f"Skipping member: {member_id}")
+                    if result in (PixivConstant.PIXIVUTIL_SKIP_DUPLICATE,
+                                  PixivConstant.PIXIVUTIL_SKIP_LOCAL_LARGER,
+                                  PixivConstant.PIXIVUTIL_SKIP_DUPLICATE_NO_WAIT):
+                        updated_limit_count = updated_limit_count + 1
+                        if config.checkUpdatedLimit != 0 and updated_limit_count >= config.checkUpdatedLimit:
+                            PixivHelper.safePrint(f"Skipping member: {member_id}")
+                            db.updateLastDownloadDate(member_id)
+                            PixivBrowserFactory.getBrowser(config=config).clear_history()
+                            return
+                        gc.collect()
+                        continue
+                    if result == PixivConstant.PIXIVUTIL_KEYBOARD_INTERRUPT:
+                        if stop_event is not None:
+                            # cannot prompt from a worker thread, stop the other members too
+                            stop_event.set()
+                            raise KeyboardInterrupt()
+                        choice = input("Keyboard Interrupt detected, continue to next image (Y/N)").rstrip("\r")
+                        if choice.upper() == 'N':
+                            PixivHelper.print_and_log("info", f"Member: {member_id}, processing aborted")
+                            flag = False
+                            break
+                        else:
+                            continue
+                    # return code from process image
+                    if result == PixivConstant.PIXIVUTIL_SKIP_OLDER:
+                        PixivHelper.print_and_log("info", "Reached older images, skippin to next member.")
                         db.updateLastDownloadDate(member_id)
-                        PixivBrowserFactory.getBrowser(config=config).clear_history()
-                        return
-                    gc.collect()
-                    continue
-                if result == PixivConstant.PIXIVUTIL_KEYBOARD_INTERRUPT:
-                    choice = input("Keyboard Interrupt detected, continue to next image (Y/N)").rstrip("\r")
-                    if choice.upper() == 'N':
-                        PixivHelper.print_and_log("info", f"Member: {member_id}, processing aborted")
                         flag = False
                         break
-                    else:
-                        continue
-                # return code from process image
-                if result == PixivConstant.PIXIVUTIL_SKIP_OLDER:
-                    PixivHelper.print_and_log("info", "Reached older images, skippin to next member.")
-                    db.updateLastDownloadDate(member_id)
-                    flag = False
-                    break
 
-                PixivHelper.wait(result, config)
+                    PixivHelper.wait(result, config)
 
             if artist.isLastPage:
                 db.updateLastDownloadDate(member_id)
@@ -219,7 +236,9 @@ def process_member(caller,
         PixivHelper.print_and_log("info", f"Member_id: {member_id} completed: {log_message}")
     except KeyboardInterrupt:
         raise
-    except Exception:
+    except Exception as ex:
+        if isinstance(ex, PixivException) and ex.errorCode == PixivException.CIRCUIT_OPEN:
+            raise
         exc_type, exc_value, exc_traceback = sys.exc_info()
         traceback.print_exception(exc_type, exc_value, exc_traceback)
         PixivHelper.print_and_log('error', f'Error at process_member(): {sys.exc_info()}')
@@ -0,0 +1,347 @@
+# -*- coding: utf-8 -*-
+# pylint: disable=W0603
+import asyncio
+import atexit
+import os
+import sys
+import threading
+import time
+import traceback
+import urllib
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from colorama import Fore, Style
+
+import PixivBrowserFactory
+import PixivCircuitBreaker
+import PixivConstant
+import PixivDownloadHandler
+import PixivHelper
+import PixivProgress
+import PixivProxyPool
+import PixivRateLimiter
+from PixivException import PixivException
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+class AsyncDownloadEngine(object):
+    '''Download engine for downloadEngine = async.
+
+    Same contract as PixivDownloadHandler.download_image(), but the transfers run as coroutines
+    on one asyncio event loop in a background thread. The local file/DB checks and the post
+    processing (hash, verify, ugoira) and the writes to the download files run in a small thread pool,
+    so only the network part is multiplexed on the event loop. The requests take the same
+    maxConcurrentRequests slots as the default engine, on top of asyncMaxDownloads.'''
+
+    def __init__(self, config):
+        import aiohttp
+        self._aiohttp = aiohttp
+        self._network_errors = PixivCircuitBreaker.NETWORK_ERRORS + (aiohttp.ClientError,)
+        self._config = config
+        self._proxy_pool = PixivProxyPool.get_pool(config)
+        self._loop = asyncio.new_event_loop()
+        self._executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="async-io")
+        # backpressure: submit() blocks when too many downloads are waiting
+        self._queued = threading.BoundedSemaphore(config.asyncMaxQueued)
+        self._futures = set()
+        self._futures_lock = threading.Lock()
+        self._session = None
+        self._transfers = None
+        self._thread = threading.Thread(target=self._loop.run_forever, name="async-download", daemon=True)
+        self._thread.start()
+        asyncio.run_coroutine_threadsafe(self._setup(), self._loop).result()
+        atexit.register(self.close)
+
+    async def _setup(self):
+        config = self._config
+        connector = self._aiohttp.TCPConnector(limit=config.asyncMaxDownloads,
+                                               ssl=None if config.enableSSLVerification else False)
+        self._session = self._aiohttp.ClientSession(connector=connector,
+                                                    headers={"User-Agent": config.useragent},
+                                                    cookie_jar=self._aiohttp.DummyCookieJar())
+        self._transfers = asyncio.Semaphore(config.asyncMaxDownloads)
+
+    def close(self):
+        if self._session is None:
+            return
+        self.cancel()
+        asyncio.run_coroutine_threadsafe(self._session.close(), self._loop).result()
+        self._session = None
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._executor.shutdown(wait=False)
+
+    def submit(self, caller, url, filename, referer, overwrite, max_retry, backup_old_file=False, image=None, page=None, notifier=None, download_from=PixivConstant.DOWNLOAD_PIXIV):
+        '''Queue a download and return a concurrent.futures.Future of (result, filename).'''
+        self._queued.acquire()
+        future = asyncio.run_coroutine_threadsafe(self.download_image(caller,
+                                                                      url,
+                                                                      filename,
+                                                                      referer,
+                                                                      overwrite,
+                                                                      max_retry,
+                                                                      backup_old_file,
+                                                                      image,
+                                                                      page,
+                                                                      notifier,
+                                                                      download_from),
+                                                  self._loop)
+        with self._futures_lock:
+            self._futures.add(future)
+        future.add_done_callback(self._on_done)
+        return future
+
+    def _on_done(self, future):
+        with self._futures_lock:
+            self._futures.discard(future)
+        self._queued.release()
+
+    def cancel(self, futures=None):
+        '''Cancel the given futures or all queued and running downloads, the partial files are removed.'''
+        if futures is None:
+            with self._futures_lock:
+                futures = list(self._futures)
+        for future in futures:
+            future.cancel()
+
+    async def _run_in_executor(self, func, *args):
+        return await self._loop.run_in_executor(self._executor, func, *args)
+
+    async def download_image(self,
+                             caller,
+                             url,
+                             filename,
+                             referer,
+                             overwrite,
+                             max_retry,
+                             backup_old_file=False,
+                             image=None,
+                             page=None,
+                             notifier=None,
+                             download_from=PixivConstant.DOWNLOAD_PIXIV):
+        '''return download result and filename if ok'''
+        config = caller.__config__
+        if notifier is None:
+            notifier = PixivHelper.dummy_notifier
+
+        temp_error_code = None
+        retry_count = 0
+        filename_save = await self._run_in_executor(PixivDownloadHandler.get_filename_save, caller, filename)
+
+        while retry_count <= max_retry:
+            try:
+                try:
+                    (check_result, remote_file_size) = await self._run_in_executor(PixivDownloadHandler.check_before_download,
+                                                                                   caller,
+                                                                                   config,
+                                                                                   url,
+                                                                                   filename,
+                                                                                   filename_save,
+                                                                                   referer,
+                                                                                   overwrite,
+                                                                                   image,
+                                                                                   page,
+                                                                                   notifier,
+                                                                                   download_from)
+                    if check_result is not None:
+                        return check_result
+
+                    # actual download
+                    notifier(type="DOWNLOAD", message=f"Start downloading {url} to {filename_save}")
+                    (downloaded_size, filename_save, headers) = await self.perform_download(url, remote_file_size, filename_save, overwrite, config, referer)
+
+                    result = await self._run_in_executor(PixivDownloadHandler.finish_download,
+                                                         caller,
+                                                         config,
+                                                         url,
+                                                         filename_save,
+                                                         downloaded_size,
+                                                         remote_file_size,
+                                                         image)
+                    if result is not None and result[0] == PixivConstant.PIXIVUTIL_OK:
+                        await self._run_in_executor(PixivDownloadHandler.save_remote_file_info,
+                                                    caller,
+                                                    image,
+                                                    page,
+                                                    download_from,
+                                                    downloaded_size,
+                                                    headers)
+                    if result is None:
+                        if retry_count < max_retry:
+                            retry_count = retry_count + 1
+                            PixivHelper.print_and_log(None, f"Retrying [{retry_count}]: {url}")
+                            await asyncio.sleep(config.retryWait)
+                            continue
+                        return (PixivConstant.DOWNLOAD_FAILED_OTHER, filename_save)
+                    return result
+
+                except urllib.error.HTTPError as httpError:
+                    PixivHelper.print_and_log('error', f'[download_image()] HTTP Error: {httpError} at {url}')
+                    if httpError.code == 404 or httpError.code == 502 or httpError.code == 500:
+                        return (PixivConstant.PIXIVUTIL_NOT_OK, None)
+                    temp_error_code = PixivException.DOWNLOAD_FAILED_NETWORK
+                    raise
+                except (self._aiohttp.ClientError, asyncio.TimeoutError) as networkError:
+                    PixivHelper.print_and_log('error', f'[download_image()] Network Error: {networkError!r} at {url}')
+                    temp_error_code = PixivException.DOWNLOAD_FAILED_NETWORK
+                    raise
+                except IOError:
+                    temp_error_code = PixivException.DOWNLOAD_FAILED_IO
+                    raise
+
+            except asyncio.CancelledError:
+                raise
+            except BaseException:
+                exc_type, exc_value, exc_traceback = sys.exc_info()
+                if PixivCircuitBreaker.is_circuit_open_error(exc_value):
+                    caller.ERROR_CODE = PixivException.CIRCUIT_OPEN
+                    PixivHelper.print_and_log('error', f'{exc_value.message} at {url}')
+                    raise
+                if temp_error_code is None:
+                    temp_error_code = PixivException.DOWNLOAD_FAILED_OTHER
+                caller.ERROR_CODE = temp_error_code
+                traceback.print_exception(exc_type, exc_value, exc_traceback)
+                PixivHelper.print_and_log('error', f'Error at download_image(): {sys.exc_info()} at {url} ({caller.ERROR_CODE})')
+
+                if retry_count < max_retry:
+                    retry_count = retry_count + 1
+                    PixivHelper.print_and_log(None, f"Retrying [{retry_count}]: {url}")
+                    await asyncio.sleep(config.retryWait)
+                else:
+                    raise
+
+    async def _request_slot(self):
+        '''Take one of the maxConcurrentRequests slots shared with the default engine, without blocking the event loop.
+        Return the semaphore to release, or None if the number of requests is not limited.'''
+        slots = PixivBrowserFactory.get_request_slots()
+        if slots is None:
+            return None
+        while not slots.acquire(blocking=False):
+            await asyncio.sleep(0.05)
+        return slots
+
+    @staticmethod
+    def _open_download_file(url, filename, offset, headers, file_size):
+        (save, filename) = PixivHelper.open_download_file(url, filename, offset)
+        resumable = PixivHelper.save_resume_info(url, filename, headers, file_size)
+        preallocated = not resumable and PixivHelper.preallocate_download_file(save, offset, file_size)
+        return (save, filename, preallocated)
+
+    @staticmethod
+    def _close_download_file(url, save, filename, preallocated, curr, file_size, overwrite, pending_write=None):
+        try:
+            if pending_write is not None and not pending_write.cancelled():
+                pending_write.result()
+            if preallocated and curr < file_size:
+                save.truncate(curr)
+        finally:
+            save.close()
+        return PixivHelper.complete_download(url, filename, curr, file_size, overwrite)
+
+    async def perform_download(self, url, file_size, filename, overwrite, config, referer=None):
+        '''Download url to filename, the file I/O runs in the thread pool so a slow disk does not stall the other transfers.'''
+        if referer is None:
+            referer = config.referer
+        headers = {'Referer': referer}
+        resume = await self._run_in_executor(PixivHelper.get_resume_info, url, filename)
+        if resume is not None:
+            PixivHelper.print_and_log('info', f"Resuming download from {PixivHelper.size_in_str(resume['offset'])} => {filename}")
+            headers.update(PixivHelper.get_resume_headers(resume))
+        cookie = get_cookie_header(url)
+        if cookie is not None:
+            headers['Cookie'] = cookie
+        timeout = self._aiohttp.ClientTimeout(sock_connect=config.timeout, sock_read=config.timeout)
+        buffer_size = config.downloadBuffer * 1024
+        limiter = PixivRateLimiter.get_bandwidth_limiter(config, url)
+        if limiter is not None:
+            buffer_size = min(buffer_size, limiter.chunk_size)
+
+        async with self._transfers:
+            delay = PixivRateLimiter.reserve(url)
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            slots = await self._request_slot()
+            try:
+                proxy = self._proxy_pool.choose() if self._proxy_pool is not None else None
+                start_time = time.time()
+                with PixivCircuitBreaker.guard(url, self._network_errors), PixivProxyPool.track(proxy, self._network_errors):
+                    async with self._session.get(url, headers=headers, proxy=proxy.url if proxy is not None else None, timeout=timeout) as res:
+                        if proxy is not None:
+                            proxy.record_success(time.time() - start_time)
+                        offset = await self._run_in_executor(PixivHelper.get_resume_offset, url, filename, resume, res.status, res.headers)
+                        if res.status >= 400:
+                            raise urllib.error.HTTPError(url, res.status, res.reason, res.headers, None)
+                        if offset > 0:
+                            file_size = resume['content_length']
+                        elif file_size < 0:
+                            content_length = res.headers.get('Content-Length')
+                            if content_length is not None:
+                                file_size = int(content_length)
+
+                        (save, filename, preallocated) = await self._run_in_executor(self._open_download_file, url, filename, offset, res.headers, file_size)
+                        curr = offset
+                        transfer = PixivProgress.start(os.path.basename(filename), file_size, offset)
+                        # one chunk is written in the thread pool while the next one is read
+                        pending_write = None
+                        try:
+                            async for chunk in res.content.iter_chunked(buffer_size):
+                                if pending_write is not None:
+                                    await asyncio.wrap_future(pending_write)
+                                pending_write = self._executor.submit(save.write, chunk)
+                                curr = curr + len(chunk)
+                                transfer.update(curr)
+                                if limiter is not None:
+                                    delay = limiter.reserve(len(chunk))
+                                    if delay > 0:
+                                        await asyncio.sleep(delay)
+                        finally:
+                            transfer.finish()
+                            # shielded, so the file is closed even if the download is cancelled again while waiting
+                            completed = await asyncio.shield(self._run_in_executor(self._close_download_file,
+                                                                                   url,
+                                                                                   save,
+                                                                                   filename,
+                                                                                   preallocated,
+                                                                                   curr,
+                                                                                   file_size,
+                                                                                   overwrite,
+                                                                                   pending_write))
+            finally:
+                if slots is not None:
+                    slots.release()
+
+        if completed:
+            total_time = time.time() - start_time
+            PixivHelper.print_and_log(None, f' {PixivHelper.size_in_str(curr - offset)} completed in {Fore.CYAN}{total_time:.3f}{Style.RESET_ALL}s ({Fore.RED}{PixivHelper.speed_in_str(curr - offset, total_time)}{Style.RESET_ALL}) => {filename}')
+        return (curr, filename, res.headers)
+
+
+def get_cookie_header(url):
+    '''Cookie header for the url from the shared browser cookie jar, e.g. for FANBOX downloads.'''
+    cookie_jar = PixivBrowserFactory.defaultCookieJar
+    if cookie_jar is None:
+        return None
+    req = urllib.request.Request(url)
+    cookie_jar.add_cookie_header(req)
+    return req.get_header('Cookie')
+
+
+def get_engine(config):
+    '''Return the shared async engine, or None if it cannot be used.'''
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            proxy_pool = PixivProxyPool.get_pool(config)
+            if proxy_pool is not None and proxy_pool.has_socks():
+                PixivHelper.print_and_log('warn', 'downloadEngine = async does not support SOCKS proxy, using the default engine.')
+                return None
+            try:
+                _engine = AsyncDownloadEngine(config)
+            except ImportError:
+                PixivHelper.print_and_log('warn', 'downloadEngine = async requires aiohttp (pip install aiohttp), using the default engine.')
+                return None
+        return _engine
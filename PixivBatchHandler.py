@@ -6,14 +6,22 @@ from copy import deepcopy
 
 import PixivArtistHandler
 import PixivBrowserFactory
+import PixivCircuitBreaker
 import PixivConfig
+import PixivFanboxHandler
 import PixivHelper
 import PixivImageHandler
+import PixivRateLimiter
 import PixivSketchHandler
 import PixivTagsHandler
 import PixivUtil2
 
 _default_batch_filename = "./batch_job.json"
+# backends used by each job_type, the pixiv jobs use pixiv for the metadata and pximg for the files
+_job_backends = {'1': (PixivRateLimiter.HOST_PIXIV, PixivRateLimiter.HOST_PXIMG),
+                 '2': (PixivRateLimiter.HOST_PIXIV, PixivRateLimiter.HOST_PXIMG),
+                 '3': (PixivRateLimiter.HOST_PIXIV, PixivRateLimiter.HOST_PXIMG),
+                 '4': (PixivRateLimiter.HOST_FANBOX, )}
 
 
 class JobOption(object):
@@ -36,6 +44,10 @@ class JobOption(object):
             option_data = job["option"]
             for option in option_data:
                 self.config.__setattr__(option, option_data[option])
+            if "bandwidthLimit" in option_data:
+                # the job downloads use their own bandwidth bucket
+                self.config.bandwidthLimit = int(option_data["bandwidthLimit"])
+                PixivRateLimiter.set_job_bandwidth_limit(self.config, self.config.bandwidthLimit)
 
 
 def handle_members(caller, job, job_name, job_option):
@@ -180,6 +192,44 @@ def handle_tags(caller: PixivUtil2, job, job_name, job_option):
                                   type_mode=type_mode)
 
 
+def handle_fanbox_creators(caller: PixivUtil2, job, job_name, job_option):
+    creator_ids = list()
+    if "creator_ids" in job:
+        creator_ids = job["creator_ids"]
+        print(f"Found multiple FANBOX creators: {len(creator_ids)}")
+    elif "creator_id" in job:
+        creator_ids.append(job["creator_id"])
+    else:
+        print(f"No creator_id or creator_ids found in {job_name}!")
+        return
+
+    end_page = 0
+    if "end_page" in job:
+        end_page = int(job["end_page"])
+
+    for creator_id in creator_ids:
+        PixivFanboxHandler.process_fanbox_artist_by_id(caller,
+                                                       job_option.config,
+                                                       creator_id,
+                                                       end_page,
+                                                       title_prefix=f"{job_name} ")
+
+
+def process_job(caller: PixivUtil2, job_name, curr_job):
+    PixivHelper.print_and_log("info", f"Processing {job_name}")
+    job_option = JobOption(curr_job, caller.__config__)
+    if curr_job["job_type"] == '1':
+        handle_members(caller, curr_job, job_name, job_option)
+    elif curr_job["job_type"] == '2':
+        handle_images(caller, curr_job, job_name, job_option)
+    elif curr_job["job_type"] == '3':
+        handle_tags(caller, curr_job, job_name, job_option)
+    elif curr_job["job_type"] == '4':
+        handle_fanbox_creators(caller, curr_job, job_name, job_option)
+    else:
+        PixivHelper.print_and_log("error", f"Unsupported job_type {curr_job['job_type']} in {job_name}")
+
+
 def process_batch_job(caller: PixivUtil2, batch_file=None):
     PixivHelper.get_logger().info('Batch Mode from json (b).')
     caller.set_console_title("Batch Menu")
@@ -197,8 +247,8 @@ def process_batch_job(caller: PixivUtil2, batch_file=None):
         active_job = len([y for y in jobs["jobs"] if jobs["jobs"][y]["enabled"]])
         PixivHelper.print_and_log("info", f"Found {active_job} active job(s) of {total_job} jobs from {batch_file}.")
 
+        job_names = list()
         for job_name in jobs["jobs"]:
-            PixivHelper.print_and_log("info", f"Processing {job_name}")
             curr_job = jobs["jobs"][job_name]
 
             if "enabled" not in curr_job or not bool(curr_job["enabled"]):
@@ -208,16 +258,13 @@ def process_batch_job(caller: PixivUtil2, batch_file=None):
             if "job_type" not in curr_job:
                 PixivHelper.print_and_log("error", f"Cannot find job_type in {job_name}")
                 continue
+            job_names.append(job_name)
 
-            job_option = JobOption(curr_job, caller.__config__)
-            if curr_job["job_type"] == '1':
-                handle_members(caller, curr_job, job_name, job_option)
-            elif curr_job["job_type"] == '2':
-                handle_images(caller, curr_job, job_name, job_option)
-            elif curr_job["job_type"] == '3':
-                handle_tags(caller, curr_job, job_name, job_option)
-            else:
-                PixivHelper.print_and_log("error", f"Unsupported job_type {curr_job['job_type']} in {job_name}")
+        # jobs for a failing backend are deferred, see circuitBreakerThreshold
+        PixivCircuitBreaker.process_deferrable(job_names,
+                                               lambda job_name: process_job(caller, job_name, jobs["jobs"][job_name]),
+                                               lambda job_name: _job_backends.get(jobs["jobs"][job_name]["job_type"], ()),
+                                               max_deferral=caller.__config__.retry)
     else:
         PixivHelper.print_and_log("error", f"Cannot found {batch_file}, see https://github.com/Nandaka/PixivUtil2/wiki/Using-Batch-Job-(Experimental) for example. ")
 
@@ -4,23 +4,31 @@
 import http.client
 import http.cookiejar
 import json
+import os
 import re
 import socket
 import sys
+import threading
 import time
 import traceback
+from contextlib import contextmanager, nullcontext
 from urllib.error import HTTPError
-from urllib.parse import urlparse
 from urllib.request import Request
 from typing import List, Tuple, Union
 
 import demjson3
 import mechanize
-import socks
+import requests
 from bs4 import BeautifulSoup
 from colorama import Fore, Style
 
+import PixivCircuitBreaker
 import PixivHelper
+import PixivProxyPool
+import PixivRateLimiter
+import PixivResponseCache
+import PixivRetryPolicy
+import PixivStatistics
 from PixivArtist import PixivArtist
 from PixivBookmark import PixivNewIllustBookmark
 from PixivException import PixivException
@@ -35,13 +43,20 @@ from PixivTags import PixivTags
 defaultCookieJar = None
 defaultConfig = None
 _browser = None
+_worker = threading.local()
+_request_slots = None
+_request_slots_size = 0
+_download_session = None
+_download_session_key = None
+_download_session_lock = threading.Lock()
 
 
 # pylint: disable=E1101
 class PixivBrowser(mechanize.Browser):
     _config = None
-    _cache = dict()
     _max_cache = 10000  # keep n-item in memory
+    _max_cache_size = 64 * 1024 * 1024  # and up to n-bytes
+    _cache = PixivResponseCache.MemoryCache(_max_cache, _max_cache_size)
     _myId = 0
     _isPremium = False
     _xRestrict = 0
@@ -75,30 +90,24 @@ class PixivBrowser(mechanize.Browser):
         return self.__oauth_manager
 
     def _put_to_cache(self, key, item, expiration=3600):
-        expiry = time.time() + expiration
-        self._cache[key] = (item, expiry)
-
-        # check oldest item
-        oldest_expiry = expiry
-        oldest_item = key
-        if len(self._cache) > self._max_cache:
-            for key2 in self._cache:
-                curr_expiry = self._cache[key2][1]
-                if curr_expiry < oldest_expiry:
-                    oldest_item = key2
-                    oldest_expiry = curr_expiry
-            del self._cache[oldest_item]
-
-    def _get_from_cache(self, key, sliding_window=3600):
-        if key in self._cache.keys():
-            (item, expiry) = self._cache.pop(key)
-            if expiry - time.time() > 0:
-                self._cache[key] = (item, expiry + sliding_window)
+        response_cache = PixivResponseCache.get_cache(self._config)
+        if response_cache is not None:
+            response_cache.put(key, item)
+        self._cache.put(key, item, expiration)
+
+    def _get_from_cache(self, key, sliding_window=3600, persistent=True):
+        item = self._cache.get(key, sliding_window)
+        if item is not None:
+            return item
+
+        # not in memory, try the persistent cache from the previous runs
+        response_cache = PixivResponseCache.get_cache(self._config) if persistent else None
+        if response_cache is not None:
+            item = response_cache.get(key)
+            if item is not None:
+                self._cache.put(key, item, sliding_window)
                 return item
 
-            # expired data
-            del item
-
         return None
 
     def __init__(self, config, cookie_jar):
@@ -112,6 +121,17 @@ class PixivBrowser(mechanize.Browser):
         mechanize.Browser.clear_history(self)
         return
 
+    def _copy_session_from(self, other):
+        '''Share the login state of other browser, used for the worker thread browsers.'''
+        self._myId = other._myId
+        self._isPremium = other._isPremium
+        self._xRestrict = other._xRestrict
+        self._username = other._username
+        self._password = other._password
+        self._locale = other._locale
+        self._is_logged_in_to_FANBOX = other._is_logged_in_to_FANBOX
+        self.__oauth_manager = other.__oauth_manager
+
     def back(self, n=1):
         mechanize.Browser.back(self, n)
         return
@@ -126,28 +146,14 @@ class PixivBrowser(mechanize.Browser):
             defaultConfig = config
 
         self._config = config
-        if config.useProxy:
-            if config.proxyAddress.startswith('socks'):
-                parseResult = urlparse(config.proxyAddress)
-                assert parseResult.scheme and parseResult.hostname and parseResult.port
-                socksType = socks.PROXY_TYPE_SOCKS5 if 'socks5' in parseResult.scheme else socks.PROXY_TYPE_SOCKS4
-                PixivHelper.get_logger().info(f"Using SOCKS5 Proxy= {parseResult.hostname}:{parseResult.port} @ {parseResult.username}")
-
-                # https://stackoverflow.com/a/14512227
-                socks.setdefaultproxy(socksType, parseResult.hostname, parseResult.port,
-                                      True, parseResult.username, parseResult.password)
-                socket.socket = socks.socksocket
-
-                # https://stackoverflow.com/a/13214222 and
-                # https://github.com/Anorov/PySocks/issues/22
-                def getaddrinfo(*args):
-                    return [(socket.AF_INET, socket.SOCK_STREAM, 6, '', (args[0], args[1]))]
-                self._orig_getaddrinfo = socket.getaddrinfo
-                socket.getaddrinfo = getaddrinfo
-
-            else:
-                self.set_proxies(config.proxy)
-                PixivHelper.get_logger().info("Using Proxy: %s", config.proxyAddress)
+        _configureRequestSlots(config.maxConcurrentRequests)
+        PixivRateLimiter.configure(config)
+        PixivCircuitBreaker.configure(config)
+        proxy_pool = PixivProxyPool.get_pool(config)
+        if proxy_pool is not None:
+            # http and SOCKS proxies are connected by the pool, without patching the socket module.
+            PixivProxyPool.install_handlers(self, proxy_pool)
+            PixivHelper.get_logger().info("Using Proxy: %s", config.proxyAddress)
 
         # self.set_handle_equiv(True)
         # self.set_handle_gzip(True)
@@ -201,14 +207,14 @@ class PixivBrowser(mechanize.Browser):
 
     def open_with_retry(self, url, data=None, timeout=60, retry=0):
         ''' Return response object with retry.'''
-        retry_count = 0
-        if retry == 0 and self._config is not None:
-            retry = self._config.retry
+        assert (self._config is not None)
+        retry_state = PixivRetryPolicy.RetryPolicy.from_config(self._config, retry).start(url)
 
         while True:
             res = None
             try:
-                res = self.open(url, data, timeout)
+                with request_slot(url):
+                    res = self.open(url, data, timeout)
                 return res
             except HTTPError as fanboxError:
                 if res is not None:
@@ -220,17 +226,18 @@ class PixivBrowser(mechanize.Browser):
                     # Issue #1342
                     if "challenge_basic_security_FANBOX" in str(fanboxError.get_data()) and fanboxError.getcode() == 403:
                         return fanboxError
-                raise
+                # only retry rate limit and transient server errors
+                delay = retry_state.next_delay(fanboxError)
+                if delay is None:
+                    raise
+                retry_state.wait(fanboxError, delay)
             except BaseException:
                 exc_value = sys.exc_info()[1]
-                assert (self._config is not None)
-                if retry_count < retry:
-                    print(exc_value, end=' ')
-                    for t in range(1, self._config.retryWait):
-                        print(t, end=' ')
-                        PixivHelper.print_delay(2)
-                    print('')
-                    retry_count = retry_count + 1
+                delay = retry_state.next_delay(exc_value)
+                if delay is not None:
+                    retry_state.wait(exc_value, delay)
+                elif isinstance(exc_value, KeyboardInterrupt) or PixivCircuitBreaker.is_circuit_open_error(exc_value):
+                    raise
                 else:
                     temp = url
                     if isinstance(url, Request):
@@ -247,12 +254,13 @@ class PixivBrowser(mechanize.Browser):
             throw PixivException as server error
         '''
         url = self.fixUrl(url)
-        retry_count = 0
+        assert (self._config is not None)
+        retry_state = PixivRetryPolicy.RetryPolicy.from_config(self._config).start(url)
         while True:
             req = mechanize.Request(url)
             req.add_header('Referer', referer)
 
-            read_page = self._get_from_cache(url)
+            read_page = self._get_from_cache(url, persistent=enable_cache)
             if read_page is None:
                 while True:
                     try:
@@ -273,14 +281,11 @@ class PixivBrowser(mechanize.Browser):
                             raise PixivException(f"Failed to get page: {url}", errorCode=PixivException.SERVER_ERROR)
                     except BaseException:
                         exc_value = sys.exc_info()[1]
-                        assert (self._config is not None)
-                        if retry_count < self._config.retry:
-                            print(exc_value, end=' ')
-                            for t in range(1, self._config.retryWait):
-                                print(t, end=' ')
-                                PixivHelper.print_delay(2)
-                            print('')
-                            retry_count = retry_count + 1
+                        delay = retry_state.next_delay(exc_value)
+                        if delay is not None:
+                            retry_state.wait(exc_value, delay)
+                        elif isinstance(exc_value, KeyboardInterrupt) or PixivCircuitBreaker.is_circuit_open_error(exc_value):
+                            raise
                         else:
                             raise PixivException(f"Failed to get page: {url}", errorCode=PixivException.SERVER_ERROR)
 
@@ -663,8 +668,12 @@ class PixivBrowser(mechanize.Browser):
         else:
             # https://www.pixiv.net/artworks/unlisted/SbliQHtJS5MMu3elqDFZ
             url = f"https://www.pixiv.net{self._locale}/artworks/unlisted/{image_id}"
-        response = self.getPixivPage(url, enable_cache=False)
-        self.handleDebugMediumPage(response, image_id)
+        # the artworks html page is only used for dumping/debugging, the image info is from the ajax api.
+        if self._config.enableDump and (self._config.dumpMediumPage or self._config.debugHttp):
+            response = self.getPixivPage(url, enable_cache=False)
+            self.handleDebugMediumPage(response, image_id)
+        else:
+            PixivStatistics.increment("Skipped artworks html requests")
 
         # Issue #355 new ui handler
         image = None
@@ -751,15 +760,14 @@ class PixivBrowser(mechanize.Browser):
                 info = self._get_from_cache(url)
                 if info is None:
                     PixivHelper.get_logger().debug("Getting member information: %s", member_id)
-                    login_response = self._oauth_manager.login()
-                    if login_response.status_code == 200:
-                        info = json.loads(login_response.text)
-                        if self._config.refresh_token != info["response"]["refresh_token"]:
-                            PixivHelper.print_and_log('info', 'OAuth Refresh Token is updated, updating config.ini')
-                            self._config.refresh_token = info["response"]["refresh_token"]
-                            self._config.writeConfig(path=self._config.configFileLocation)
-
+                    # the access token is reused until it expires
                     response = self._oauth_manager.get_user_info(member_id)
+                    refresh_token = self._oauth_manager.get_refresh_token()
+                    if refresh_token is not None and self._config.refresh_token != refresh_token:
+                        PixivHelper.print_and_log('info', 'OAuth Refresh Token is updated, updating config.ini')
+                        self._config.refresh_token = refresh_token
+                        self._config.writeConfig(path=self._config.configFileLocation)
+
                     info = json.loads(response.text)
                     self._put_to_cache(url, info)
                     PixivHelper.get_logger().debug("reply: %s", response.text)
@@ -1321,11 +1329,17 @@ class PixivBrowser(mechanize.Browser):
         return result
 
 
+PixivStatistics.register(PixivBrowser._cache.get_statistics)
+
+
 def getBrowser(config=None, cookieJar=None):
     global defaultCookieJar
     global defaultConfig
     global _browser
 
+    if _browser is not None and threading.current_thread() is not threading.main_thread():
+        return _getWorkerBrowser(config)
+
     if _browser is None:
         if config is not None:
             defaultConfig = config
@@ -1342,6 +1356,91 @@ def getBrowser(config=None, cookieJar=None):
     return _browser
 
 
+def _configureRequestSlots(size):
+    global _request_slots
+    global _request_slots_size
+    if size != _request_slots_size:
+        _request_slots = threading.BoundedSemaphore(size) if size > 0 else None
+        _request_slots_size = size
+
+
+def get_request_slots():
+    '''Return the semaphore limiting the in-flight HTTP requests, or None, see maxConcurrentRequests.'''
+    return _request_slots
+
+
+@contextmanager
+def request_slot(url=None):
+    '''Wait for the rate limit of the url host and limit the number of in-flight HTTP requests
+    across all threads, see rateLimitXXX and maxConcurrentRequests.
+    Raise PixivException(CIRCUIT_OPEN) if the url backend is failing, see circuitBreakerThreshold.'''
+    breaker = PixivCircuitBreaker.guard(url) if url is not None else nullcontext()
+    with breaker:
+        if url is not None:
+            PixivRateLimiter.acquire(url)
+        PixivStatistics.increment("HTTP requests")
+        slots = _request_slots
+        if slots is None:
+            yield
+            return
+        with slots:
+            yield
+
+
+def getDownloadSession(config=None):
+    '''Return the shared requests.Session for the file downloads, the connections are kept alive in
+    a pool (see downloadPoolSize) so the HEAD and GET requests to i.pximg.net can reuse them.'''
+    global _download_session
+    global _download_session_key
+    if config is None:
+        config = defaultConfig
+
+    verify = config.enableSSLVerification
+    if verify and PixivHelper.we_are_frozen():
+        verify = os.path.dirname(sys.executable) + os.sep + 'cacert.pem'
+    key = (config.downloadPoolSize, config.useragent, verify, id(defaultCookieJar))
+
+    proxy_pool = PixivProxyPool.get_pool(config)
+    if proxy_pool is not None:
+        # one session (and connection pool) per proxy, the proxy is chosen for each request
+        def create_proxy_session(entry):
+            adapter = PixivProxyPool.ProxyHealthAdapter(entry, pool_connections=4, pool_maxsize=config.downloadPoolSize)
+            return _createDownloadSession(config, verify, adapter, {"http": entry.requests_url, "https": entry.requests_url})
+        return proxy_pool.choose().get_session(key, create_proxy_session)
+
+    with _download_session_lock:
+        if _download_session is None or _download_session_key != key:
+            adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=config.downloadPoolSize)
+            _download_session = _createDownloadSession(config, verify, adapter)
+            _download_session_key = key
+        return _download_session
+
+
+def _createDownloadSession(config, verify, adapter, proxies=None):
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers["User-Agent"] = config.useragent
+    session.verify = verify
+    if proxies is not None:
+        session.proxies.update(proxies)
+    if defaultCookieJar is not None:
+        session.cookies = defaultCookieJar
+    return session
+
+
+def _getWorkerBrowser(config=None):
+    '''mechanize.Browser is not thread safe, each worker thread get its own browser sharing the cookie jar.'''
+    browser = getattr(_worker, "browser", None)
+    if browser is None:
+        browser = PixivBrowser(config or _browser._config, defaultCookieJar)
+        browser._copy_session_from(_browser)
+        _worker.browser = browser
+    elif config is not None:
+        browser._configureBrowser(config)
+    return browser
+
+
 def getExistingBrowser():
     global _browser
     if _browser is None:
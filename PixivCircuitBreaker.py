@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+import http.client
+import socket
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from urllib.error import HTTPError, URLError
+
+import requests
+
+import PixivHelper
+import PixivRateLimiter
+import PixivStatistics
+from PixivException import PixivException
+
+STATE_CLOSED = "closed"
+STATE_OPEN = "open"
+STATE_HALF_OPEN = "half-open"
+
+# HTTP status code counted as backend failure, the other status means the backend is alive.
+FAILURE_HTTP_CODES = (429, 500, 502, 503, 504)
+NETWORK_ERRORS = (ConnectionError,
+                  TimeoutError,
+                  socket.timeout,
+                  URLError,
+                  http.client.HTTPException,
+                  requests.exceptions.ConnectionError,
+                  requests.exceptions.Timeout,
+                  requests.exceptions.ChunkedEncodingError)
+
+_breakers = dict()
+_lock = threading.Lock()
+_threshold = 0
+_cooldown = 60
+
+
+class CircuitBreaker(object):
+    '''Circuit breaker for one backend, open after threshold consecutive failures.
+    When open, requests fail fast until cooldown seconds passed, then one probe request is allowed (half-open):
+    the circuit is closed if the probe succeed, otherwise opened again.'''
+
+    def __init__(self, name, threshold, cooldown):
+        self.name = name
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state = STATE_CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self.trips = 0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def before_request(self):
+        '''Raise PixivException(CIRCUIT_OPEN) if the request is not allowed,
+        return True if the request is the half-open probe.'''
+        with self._lock:
+            if self.state == STATE_CLOSED:
+                return False
+            if self.state == STATE_OPEN and time.monotonic() - self.opened_at >= self.cooldown:
+                self.state = STATE_HALF_OPEN
+            if self.state == STATE_HALF_OPEN and not self._probing:
+                self._probing = True
+                PixivHelper.print_and_log('info', f'Circuit breaker for {self.name} is half-open, probing...')
+                return True
+            retry_in = max(self.cooldown - (time.monotonic() - self.opened_at), 0)
+        PixivStatistics.increment(f"Circuit breaker rejected {self.name}")
+        raise PixivException(f"Circuit breaker for {self.name} is open, retry in {retry_in:.0f}s.",
+                             errorCode=PixivException.CIRCUIT_OPEN)
+
+    def record_success(self, probe=False):
+        with self._lock:
+            if probe:
+                self._probing = False
+            if self.state != STATE_CLOSED:
+                PixivHelper.print_and_log('info', f'Circuit breaker for {self.name} is closed.')
+            self.state = STATE_CLOSED
+            self.failures = 0
+
+    def record_failure(self, probe=False):
+        with self._lock:
+            if probe:
+                self._probing = False
+            self.failures = self.failures + 1
+            if self.state == STATE_HALF_OPEN or (self.state == STATE_CLOSED and self.failures >= self.threshold):
+                if self.state == STATE_CLOSED:
+                    PixivStatistics.increment(f"Circuit breaker tripped {self.name}")
+                self.trips = self.trips + 1
+                self.state = STATE_OPEN
+                self.opened_at = time.monotonic()
+                PixivHelper.print_and_log('warn', f'Circuit breaker for {self.name} is open after {self.failures} failure(s), pausing for {self.cooldown}s.')
+
+    def release(self, probe=False):
+        '''The request ended without telling anything about the backend, e.g. Ctrl-C.'''
+        if probe:
+            with self._lock:
+                self._probing = False
+
+    def is_open(self):
+        '''True if the requests are rejected, i.e. open and the cooldown is not passed yet.'''
+        with self._lock:
+            return self.state == STATE_OPEN and time.monotonic() - self.opened_at < self.cooldown
+
+    def get_wait_time(self):
+        '''Seconds until the half-open probe is allowed.'''
+        with self._lock:
+            if self.state != STATE_OPEN:
+                return 0
+            return max(self.cooldown - (time.monotonic() - self.opened_at), 0)
+
+
+def configure(config):
+    '''Set the threshold and cooldown, circuitBreakerThreshold = 0 disable the circuit breakers.'''
+    global _threshold
+    global _cooldown
+    with _lock:
+        _threshold = config.circuitBreakerThreshold
+        _cooldown = config.circuitBreakerCooldown
+        for breaker in _breakers.values():
+            breaker.threshold = _threshold
+            breaker.cooldown = _cooldown
+
+
+def get_breaker(url):
+    '''Return the circuit breaker for the url backend (see PixivRateLimiter.get_host_class), or None.'''
+    if _threshold <= 0:
+        return None
+    backend = PixivRateLimiter.get_host_class(url)
+    if backend is None:
+        return None
+    with _lock:
+        breaker = _breakers.get(backend)
+        if breaker is None:
+            breaker = CircuitBreaker(backend, _threshold, _cooldown)
+            _breakers[backend] = breaker
+        return breaker
+
+
+def is_backend_failure(error, network_errors=NETWORK_ERRORS):
+    if isinstance(error, HTTPError):
+        return error.code in FAILURE_HTTP_CODES
+    return isinstance(error, network_errors)
+
+
+def is_circuit_open_error(error):
+    return isinstance(error, PixivException) and error.errorCode == PixivException.CIRCUIT_OPEN
+
+
+@contextmanager
+def guard(url, network_errors=NETWORK_ERRORS):
+    '''Fail fast if the url backend is open, and record the outcome of the request made inside the block.'''
+    breaker = get_breaker(url)
+    if breaker is None:
+        yield
+        return
+    probe = breaker.before_request()
+    try:
+        yield
+    except BaseException as ex:
+        if is_backend_failure(ex, network_errors):
+            breaker.record_failure(probe)
+        elif isinstance(ex, HTTPError):
+            # 4xx error, the backend is responding.
+            breaker.record_success(probe)
+        else:
+            breaker.release(probe)
+        raise
+    breaker.record_success(probe)
+
+
+def get_open_backends():
+    '''Return the backends currently rejecting requests.'''
+    with _lock:
+        breakers = list(_breakers.values())
+    return [breaker.name for breaker in breakers if breaker.is_open()]
+
+
+def get_wait_time(backends):
+    '''Seconds until all the given backends allow the half-open probe.'''
+    with _lock:
+        breakers = [_breakers[backend] for backend in backends if backend in _breakers]
+    return max([breaker.get_wait_time() for breaker in breakers], default=0)
+
+
+def get_trip_count(backends):
+    '''Number of times the given backends were opened.'''
+    with _lock:
+        breakers = [_breakers[backend] for backend in backends if backend in _breakers]
+    return sum(breaker.trips for breaker in breakers)
+
+
+def wait_for_backends(backends):
+    '''Sleep until the given backends allow the half-open probe.'''
+    blocked = [backend for backend in get_open_backends() if backend in backends]
+    if len(blocked) == 0:
+        return
+    wait_time = get_wait_time(blocked)
+    PixivHelper.print_and_log('info', f'Waiting {wait_time:.0f}s for {", ".join(blocked)} to recover...')
+    time.sleep(wait_time)
+
+
+def process_deferrable(items, process, get_backends, describe=str, max_deferral=3):
+    '''Call process(item) for each item, get_backends(item) return the backends used by the item.
+    While a backend is open, the items using it are moved to the end of the queue so the others can proceed,
+    and an item is queued again (up to max_deferral times) if one of its backends tripped while processing it,
+    or if process(item) raised the CIRCUIT_OPEN error.'''
+    queue = deque((item, 0) for item in items)
+    skipped = 0
+    while len(queue) > 0:
+        (item, deferral) = queue.popleft()
+        backends = get_backends(item)
+        blocked = [backend for backend in get_open_backends() if backend in backends]
+        if len(blocked) > 0:
+            if skipped <= len(queue):
+                skipped = skipped + 1
+                queue.append((item, deferral))
+                continue
+            # every remaining item is blocked
+            wait_for_backends(backends)
+        skipped = 0
+        trips = get_trip_count(backends)
+        try:
+            process(item)
+            tripped = get_trip_count(backends) != trips
+        except PixivException as ex:
+            if not is_circuit_open_error(ex):
+                raise
+            if deferral >= max_deferral:
+                PixivHelper.print_and_log('error', f'Giving up {describe(item)} ==> {ex}')
+                continue
+            tripped = True
+        if tripped and deferral < max_deferral:
+            PixivHelper.print_and_log('warn', f'Circuit breaker tripped while processing {describe(item)}, will retry it later.')
+            PixivStatistics.increment("Deferred jobs")
+            queue.append((item, deferral + 1))
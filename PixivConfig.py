@@ -62,11 +62,28 @@ class PixivConfig():
         ConfigItem("Network", "timeout", 60),
         ConfigItem("Network", "retry", 3),
         ConfigItem("Network", "retryWait", 5),
+        ConfigItem("Network", "retryHttp", 3, restriction=lambda x: int(x) >= 0),
+        ConfigItem("Network", "retryMaxWait", 60, restriction=lambda x: int(x) > 0),
         ConfigItem("Network", "downloadDelay", 5),
         ConfigItem("Network", "checkNewVersion", True),
         ConfigItem("Network", "notifyBetaVersion", True),
         ConfigItem("Network", "openNewVersion", True),
         ConfigItem("Network", "enableSSLVerification", True),
+        ConfigItem("Network", "maxConcurrentRequests", 0, restriction=lambda x: int(x) >= 0),
+        ConfigItem("Network", "downloadPoolSize", 10, restriction=lambda x: int(x) > 0),
+        ConfigItem("Network", "rateLimitPixiv", 0.0, restriction=lambda x: float(x) >= 0),
+        ConfigItem("Network", "rateLimitPixivBurst", 5, restriction=lambda x: int(x) > 0),
+        ConfigItem("Network", "rateLimitPximg", 0.0, restriction=lambda x: float(x) >= 0),
+        ConfigItem("Network", "rateLimitPximgBurst", 10, restriction=lambda x: int(x) > 0),
+        ConfigItem("Network", "rateLimitFanbox", 0.0, restriction=lambda x: float(x) >= 0),
+        ConfigItem("Network", "rateLimitFanboxBurst", 5, restriction=lambda x: int(x) > 0),
+        ConfigItem("Network", "circuitBreakerThreshold", 10, restriction=lambda x: int(x) >= 0),
+        ConfigItem("Network", "circuitBreakerCooldown", 120, restriction=lambda x: int(x) > 0),
+        ConfigItem("Network", "proxyMaxFailures", 3, restriction=lambda x: int(x) > 0),
+        ConfigItem("Network", "proxyEjectTime", 60, restriction=lambda x: int(x) > 0),
+        ConfigItem("Network", "bandwidthLimit", 0, restriction=lambda x: int(x) >= 0),
+        ConfigItem("Network", "bandwidthLimitPximg", 0, restriction=lambda x: int(x) >= 0),
+        ConfigItem("Network", "bandwidthLimitFanbox", 0, restriction=lambda x: int(x) >= 0),
 
         ConfigItem("Debug", "logLevel", "DEBUG",
                    followup=str.upper,
@@ -104,6 +121,12 @@ class PixivConfig():
         ConfigItem("Settings", "stripHTMLTagsFromCaption", False),
         ConfigItem("Settings", "urlBlacklistRegex", ""),
         ConfigItem("Settings", "dbPath", ""),
+        ConfigItem("Settings", "dbJournalMode", "WAL",
+                   followup=str.upper,
+                   restriction=lambda x: x.upper() in ['DELETE', 'TRUNCATE', 'PERSIST', 'WAL']),
+        ConfigItem("Settings", "dbSynchronous", "NORMAL",
+                   followup=str.upper,
+                   restriction=lambda x: x.upper() in ['OFF', 'NORMAL', 'FULL', 'EXTRA']),
         ConfigItem("Settings", "setLastModified", True),
         ConfigItem("Settings", "useLocalTimezone", False),
         ConfigItem("Settings", "defaultSketchOption", ""),
@@ -224,6 +247,22 @@ class PixivConfig():
         ConfigItem("DownloadControl", "postProcessingCmd", ""),
         ConfigItem("DownloadControl", "extensionFilter", ""),
         ConfigItem("DownloadControl", "downloadBuffer", 512, restriction=lambda x: int(x) > 0),
+        ConfigItem("DownloadControl", "maxConcurrentPages", 1, restriction=lambda x: int(x) > 0),
+        ConfigItem("DownloadControl", "maxConcurrentMembers", 1, restriction=lambda x: int(x) > 0),
+        ConfigItem("DownloadControl", "prefetchImageInfo", 2, restriction=lambda x: int(x) >= 0),
+        ConfigItem("DownloadControl", "downloadEngine", "default",
+                   restriction=lambda x: x.lower() in ['default', 'async'],
+                   followup=lambda x: x.lower()),
+        ConfigItem("DownloadControl", "asyncMaxDownloads", 100, restriction=lambda x: int(x) > 0),
+        ConfigItem("DownloadControl", "asyncMaxQueued", 1000, restriction=lambda x: int(x) > 0),
+
+        ConfigItem("Cache", "useResponseCache", False),
+        ConfigItem("Cache", "responseCacheFile", "", followup=os.path.expanduser),
+        ConfigItem("Cache", "responseCacheMaxSize", 100, restriction=lambda x: int(x) > 0),
+        ConfigItem("Cache", "cacheTtlMember", 86400, restriction=lambda x: int(x) >= 0),
+        ConfigItem("Cache", "cacheTtlWorks", 3600, restriction=lambda x: int(x) >= 0),
+        ConfigItem("Cache", "cacheTtlSearch", 3600, restriction=lambda x: int(x) >= 0),
+        ConfigItem("Cache", "cacheTtlDefault", 0, restriction=lambda x: int(x) >= 0),
     ]
 
     def __init__(self):
@@ -235,6 +274,8 @@ class PixivConfig():
         value = getattr(self, "proxyAddress", None)
         if not value:
             return None
+        # only the first proxy if proxyAddress is a list, see PixivProxyPool
+        value = re.split(r"[\s,;|]+", value.strip())[0]
         match = re.match(r"^(?:(https?|socks[45]h?)://)?([\w.-]+)(:\d+)?$", value)
         if not match:
             return None
@@ -270,6 +311,8 @@ class PixivConfig():
             method = config.get
             if option_type == int:
                 method = config.getint
+            elif option_type == float:
+                method = config.getfloat
             elif option_type == bool:
                 method = config.getboolean
 
@@ -2,15 +2,27 @@
 # -*- coding: utf-8 -*-
 
 import codecs
+import copy
+import heapq
 import os
+import queue
 import re
 import sqlite3
 import sys
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
+from functools import partial
 
 # import colorama
 from colorama import Back, Fore, Style
 
+import PixivConstant
+import PixivFileIndex
 import PixivHelper
 from PixivListItem import PixivListItem
 
@@ -19,11 +31,94 @@ from PixivException import PixivException
 script_path = PixivHelper.module_path()
 
 
+class DeferredCommitConnection(sqlite3.Connection):
+    """sqlite3 connection ignoring commit() inside PixivDBManager.transaction(), the writes are committed at the end."""
+    transaction_depth = 0
+
+    def commit(self):
+        if self.transaction_depth > 0:
+            return
+        super().commit()
+
+
+class ImageIdIndex(object):
+    """In-memory set of the image ids in pixiv_master_image, stored as a sorted array (8 bytes per id).
+    The ids added later are kept in a small set and merged into the array in bulk."""
+    MERGE_SIZE = 10000
+
+    def __init__(self, sorted_ids=()):
+        self._ids = array('q', sorted_ids)
+        self._added = set()
+        # the index is shared by the reader threads and the writer thread, see ConcurrentDBManager
+        self._lock = threading.Lock()
+
+    def __contains__(self, image_id):
+        with self._lock:
+            return self._contains(image_id)
+
+    def _contains(self, image_id):
+        if image_id in self._added:
+            return True
+        i = bisect_left(self._ids, image_id)
+        return i < len(self._ids) and self._ids[i] == image_id
+
+    def __len__(self):
+        return len(self._ids) + len(self._added)
+
+    def add(self, image_id):
+        with self._lock:
+            if self._contains(image_id):
+                return
+            self._added.add(image_id)
+            if len(self._added) >= self.MERGE_SIZE:
+                self._ids = array('q', heapq.merge(self._ids, sorted(self._added)))
+                self._added.clear()
+
+    def discard(self, image_id):
+        with self._lock:
+            self._added.discard(image_id)
+            i = bisect_left(self._ids, image_id)
+            if i < len(self._ids) and self._ids[i] == image_id:
+                del self._ids[i]
+
+
 class PixivDBManager(object):
     """Pixiv Database Manager"""
     rootDirectory = "."
-
-    def __init__(self, root_directory, target='', timeout=5 * 60):
+    # (version, description, statements) applied once by migrateDatabase() and recorded in schema_migrations.
+    # Do not modify an applied migration, append a new one instead.
+    MIGRATIONS = [
+        # 0 = false, 1 = true
+        (1, "add pixiv_master_member.is_deleted",
+         ['''ALTER TABLE pixiv_master_member ADD COLUMN is_deleted INTEGER DEFAULT 0''']),
+        (2, "add pixiv_master_member.member_token",
+         ['''ALTER TABLE pixiv_master_member ADD COLUMN member_token TEXT''']),
+        (3, "add pixiv_master_image.is_manga",
+         ['''ALTER TABLE pixiv_master_image ADD COLUMN is_manga TEXT''']),
+        (4, "add pixiv_master_image.caption",
+         ['''ALTER TABLE pixiv_master_image ADD COLUMN caption TEXT''']),
+        # remote file size and validators, see updateRemoteFileInfo()
+        (5, "add remote file info columns",
+         [f'''ALTER TABLE {table} ADD COLUMN {column}'''
+          for table in ("pixiv_master_image", "pixiv_manga_image", "fanbox_post_image")
+          for column in ("remote_size INTEGER", "etag TEXT", "last_modified TEXT")]),
+        (6, "index pixiv_master_image.member_id",
+         ['''CREATE INDEX IF NOT EXISTS idx_pixiv_master_image_member_id ON pixiv_master_image (member_id)''']),
+        (7, "index pixiv_master_member.last_update_date",
+         ['''CREATE INDEX IF NOT EXISTS idx_pixiv_master_member_last_update_date ON pixiv_master_member (last_update_date)''']),
+        # when the remote file info was checked, instead of bumping last_update_date
+        (8, "add remote_checked_date column",
+         [f'''ALTER TABLE {table} ADD COLUMN remote_checked_date DATE'''
+          for table in ("pixiv_master_image", "pixiv_manga_image", "fanbox_post_image")]),
+    ]
+
+    # cleanUp() reads the rows by chunk and checks the files in parallel,
+    # ordered by save_name so the rows of a directory use the same PixivFileIndex listing.
+    CLEANUP_CHUNK_SIZE = 1000
+    CLEANUP_THREADS = 16
+    CLEANUP_PROGRESS_INTERVAL = 5
+
+    def __init__(self, root_directory, target='', timeout=5 * 60, synchronous="NORMAL", journal_mode="WAL"):
         if target is None or len(target) == 0:
             target = script_path + os.sep + "db.sqlite"
             PixivHelper.print_and_log(
@@ -32,7 +127,58 @@ class PixivDBManager(object):
             PixivHelper.print_and_log(
                 'info', "Using custom DB Path: " + target)
         self.rootDirectory = root_directory
-        self.conn = sqlite3.connect(target, timeout)
+        self.target = target
+        self._timeout = timeout
+        self._synchronous = synchronous
+        self._journal_mode = journal_mode
+        # (table, image_id, page) => (remote_size, etag, last_modified) for the rows not inserted yet
+        self._pending_remote_file_info = dict()
+        # see getImageIdIndex(), loaded on first use
+        self._image_index = None
+        # see insertImageTags(), the tag ids in pixiv_master_tag loaded on first use,
+        # and the (tag_id, translation_type) => translation saved since then.
+        self._known_tags = None
+        self._known_tag_translations = dict()
+        # the connection can be used by the writer thread of ConcurrentDBManager
+        self.conn = self._connect()
+
+    def _connect(self, query_only=False):
+        conn = sqlite3.connect(self.target, self._timeout, check_same_thread=False, factory=DeferredCommitConnection)
+        # WAL: the readers in other processes and threads are not blocked by the writes,
+        # and synchronous = NORMAL is safe in WAL mode with fewer fsync.
+        conn.execute(f'''PRAGMA journal_mode = {self._journal_mode}''')
+        conn.execute(f'''PRAGMA synchronous = {self._synchronous}''')
+        if query_only:
+            conn.execute('''PRAGMA query_only = 1''')
+        return conn
+
+    def createReader(self):
+        '''Return a PixivDBManager on the same database with its own read-only connection, e.g. for another thread.'''
+        reader = copy.copy(self)
+        reader.conn = self._connect(query_only=True)
+        reader._pending_remote_file_info = dict()
+        reader._image_index = None
+        reader._known_tags = None
+        return reader
+
+    @contextmanager
+    def transaction(self):
+        '''Commit all the writes made inside the block at once at the end, or roll them back on error.
+        The methods commit() calls are deferred until the outermost transaction() ends.'''
+        self.conn.transaction_depth = self.conn.transaction_depth + 1
+        try:
+            yield self
+        except BaseException:
+            self.conn.transaction_depth = self.conn.transaction_depth - 1
+            if self.conn.transaction_depth == 0:
+                self.conn.rollback()
+                # the caches might contain the rolled back rows
+                self._image_index = None
+                self._known_tags = None
+            raise
+        self.conn.transaction_depth = self.conn.transaction_depth - 1
+        if self.conn.transaction_depth == 0:
+            self.conn.commit()
 
     def close(self):
         self.conn.close()
@@ -57,23 +203,6 @@ class PixivDBManager(object):
 
             self.conn.commit()
 
-            # add column isDeleted
-            # 0 = false, 1 = true
-            try:
-                c.execute(
-                    '''ALTER TABLE pixiv_master_member ADD COLUMN is_deleted INTEGER DEFAULT 0''')
-                self.conn.commit()
-            except BaseException:
-                pass
-
-            # add column for artist token
-            try:
-                c.execute(
-                    '''ALTER TABLE pixiv_master_member ADD COLUMN member_token TEXT''')
-                self.conn.commit()
-            except BaseException:
-                pass
-
             c.execute('''CREATE TABLE IF NOT EXISTS pixiv_master_image (
                             image_id INTEGER PRIMARY KEY,
                             member_id INTEGER,
@@ -82,19 +211,6 @@ class PixivDBManager(object):
                             created_date DATE,
                             last_update_date DATE
                             )''')
-            # add column isManga
-            try:
-                c.execute(
-                    '''ALTER TABLE pixiv_master_image ADD COLUMN is_manga TEXT''')
-            except BaseException:
-                pass
-            # add column caption
-            try:
-                c.execute(
-                    '''ALTER TABLE pixiv_master_image ADD COLUMN caption TEXT''')
-            except BaseException:
-                pass
-                
 
             c.execute('''CREATE TABLE IF NOT EXISTS pixiv_manga_image (
                             image_id INTEGER,
@@ -176,6 +292,8 @@ class PixivDBManager(object):
             self.create_update_novel_table(c)
             self.conn.commit()
 
+            self.migrateDatabase(c)
+
             print('done.')
         except BaseException:
             print('Error at createDatabase():', str(sys.exc_info()))
@@ -184,6 +302,36 @@ class PixivDBManager(object):
         finally:
             c.close()
 
+    def migrateDatabase(self, c):
+        '''Apply the MIGRATIONS not recorded in schema_migrations yet, in order.'''
+        c.execute('''CREATE TABLE IF NOT EXISTS schema_migrations (
+                        version INTEGER PRIMARY KEY,
+                        description TEXT,
+                        applied_date DATE
+                        )''')
+        self.conn.commit()
+
+        c.execute('''SELECT version FROM schema_migrations''')
+        applied = set(row[0] for row in c.fetchall())
+        for (version, description, statements) in self.MIGRATIONS:
+            if version in applied:
+                continue
+            PixivHelper.get_logger().info("Applying database migration %d: %s", version, description)
+            try:
+                c.execute('''BEGIN''')
+                for statement in statements:
+                    try:
+                        c.execute(statement)
+                    except sqlite3.OperationalError as ex:
+                        # the column was added on startup before the migrations were recorded
+                        if "duplicate column name" not in str(ex):
+                            raise
+                c.execute('''INSERT INTO schema_migrations VALUES (?, ?, datetime('now'))''', (version, description))
+                self.conn.commit()
+            except BaseException:
+                self.conn.rollback()
+                raise
+
     def dropDatabase(self):
         try:
             c = self.conn.cursor()
@@ -216,6 +364,8 @@ class PixivDBManager(object):
             raise
         finally:
             c.close()
+        self._image_index = None
+        self._known_tags = None
         print('done.')
 
     def compactDatabase(self):
@@ -525,9 +675,13 @@ class PixivDBManager(object):
             except ValueError:
                 int_diff = 7
 
-            c.execute('''SELECT member_id, save_folder,  (julianday(Date('now')) - julianday(last_update_date)) as diff
+            # compare the column with the cutoff date, so the last_update_date index can be used,
+            # never downloaded members ('1-1-1') are also sorted before any date.
+            # +member_id: sort the matching rows instead of scanning the whole table in member_id order.
+            c.execute('''SELECT member_id, save_folder
                          FROM pixiv_master_member
-                         WHERE is_deleted <> 1 AND ( last_update_date == '1-1-1' OR diff > ? ) ORDER BY member_id''', (int_diff, ))
+                         WHERE is_deleted <> 1 AND last_update_date < date('now', ?)
+                         ORDER BY +member_id''', (f"-{int_diff} days", ))
             result = c.fetchall()
             for row in result:
                 item = PixivListItem(row[0], row[1])
@@ -673,6 +827,7 @@ class PixivDBManager(object):
                         WHERE member_id = ?''', (item.memberId, ))
                 c.execute('''DELETE FROM pixiv_master_member
                         WHERE member_id = ?''', (item.memberId, ))
+            self._image_index = None
             self.conn.commit()
         except BaseException:
             print('Error at deleteMembersByList():', str(sys.exc_info()))
@@ -738,6 +893,7 @@ class PixivDBManager(object):
                         WHERE member_id = ?''', (row[0], ))
                     c.execute('''DELETE FROM pixiv_master_member
                         WHERE member_id = ?''', (row[0], ))
+            self._image_index = None
             self.conn.commit()
         except BaseException:
             print('Error at keepMembersByList():', str(sys.exc_info()))
@@ -755,6 +911,7 @@ class PixivDBManager(object):
                       WHERE member_id = ?''', (memberId, ))
             c.execute('''DELETE FROM pixiv_master_member
                       WHERE member_id = ?''', (memberId, ))
+            self._image_index = None
             self.conn.commit()
         except BaseException:
             print('Error at deleteCascadeMemberByMemberId():', str(sys.exc_info()))
@@ -819,6 +976,7 @@ class PixivDBManager(object):
                       translation = excluded.translation,
                       last_update_date = datetime('now')''',
                       (tag_id, translation_type, translation))
+            self._known_tag_translations.pop((tag_id, translation_type), None)
             self.conn.commit()
         except BaseException:
             print('Error at insertImageToTag():', str(sys.exc_info()))
@@ -827,6 +985,45 @@ class PixivDBManager(object):
         finally:
             c.close()
 
+    def insertImageTags(self, image_tags, tag_translations):
+        '''Save the tags of one or more images with executemany.
+        image_tags is a list of (image_id, tag_id), tag_translations a list of (tag_id, translation_type, translation).
+        The tags already in pixiv_master_tag and the translations saved before are skipped.'''
+        try:
+            c = self.conn.cursor()
+            if self._known_tags is None:
+                c.execute('''SELECT tag_id FROM pixiv_master_tag''')
+                self._known_tags = set(row[0] for row in c)
+                self._known_tag_translations = dict()
+            new_tags = list(dict.fromkeys(tag_id for (_, tag_id) in image_tags if tag_id not in self._known_tags))
+            translations = dict(((tag_id, translation_type), translation) for (tag_id, translation_type, translation) in tag_translations)
+            new_translations = [(tag_id, translation_type, translation)
+                                for ((tag_id, translation_type), translation) in translations.items()
+                                if self._known_tag_translations.get((tag_id, translation_type)) != translation]
+
+            c.executemany('''INSERT OR IGNORE INTO pixiv_master_tag VALUES (?, datetime('now'), datetime('now'))''',
+                          [(tag_id, ) for tag_id in new_tags])
+            c.executemany('''INSERT OR IGNORE INTO pixiv_image_to_tag(image_id, tag_id, created_date, last_update_date)
+                          VALUES (?, ?, datetime('now'), datetime('now'))
+                          ON CONFLICT(image_id, tag_id) DO UPDATE SET last_update_date = datetime('now')''',
+                          [(int(image_id), tag_id) for (image_id, tag_id) in image_tags])
+            c.executemany('''INSERT OR IGNORE INTO pixiv_tag_translation(tag_id, translation_type, translation, created_date, last_update_date)
+                          VALUES (?, ?, ?, datetime('now'), datetime('now'))
+                          ON CONFLICT(tag_id, translation_type) DO UPDATE SET
+                          translation = excluded.translation,
+                          last_update_date = datetime('now')''',
+                          new_translations)
+            self.conn.commit()
+            # rolled back with the transaction, see transaction()
+            self._known_tags.update(new_tags)
+            self._known_tag_translations.update(translations)
+        except BaseException:
+            print('Error at insertImageTags():', str(sys.exc_info()))
+            print('failed')
+            raise
+        finally:
+            c.close()
+
     def selectImagesByTagId(self, tag_id):
         try:
             c = self.conn.cursor()
@@ -871,6 +1068,7 @@ class PixivDBManager(object):
                       WHERE image_id IN (SELECT image_id FROM pixiv_image_to_tag WHERE tag_id = ?)''',
                       (tag_id, ))
             c.execute('''DELETE FROM pixiv_image_to_tag WHERE tag_id = ?''', (tag_id, ))
+            self._image_index = None
             self.conn.commit()
         except BaseException:
             print('Error at deleteImage():', str(sys.exc_info()))
@@ -884,8 +1082,10 @@ class PixivDBManager(object):
             c = self.conn.cursor()
             member_id = int(member_id)
             image_id = int(image_id)
-            c.execute('''INSERT OR IGNORE INTO pixiv_master_image VALUES(?, ?, 'N/A' ,'N/A' , datetime('now'), datetime('now'), ?, ? )''',
+            c.execute('''INSERT OR IGNORE INTO pixiv_master_image (image_id, member_id, title, save_name, created_date, last_update_date, is_manga, caption)
+                      VALUES(?, ?, 'N/A' ,'N/A' , datetime('now'), datetime('now'), ?, ? )''',
                       (image_id, member_id, isManga, caption))
+            self._apply_pending_remote_file_info(c, "pixiv_master_image", [(image_id, None)])
             self.conn.commit()
         except BaseException:
             print('Error at insertImage():', str(sys.exc_info()))
@@ -897,8 +1097,9 @@ class PixivDBManager(object):
     def insertMangaImages(self, manga_files):
         try:
             c = self.conn.cursor()
-            c.executemany('''INSERT OR IGNORE INTO pixiv_manga_image
+            c.executemany('''INSERT OR IGNORE INTO pixiv_manga_image (image_id, page, save_name, created_date, last_update_date)
                           VALUES(?, ?, ?, datetime('now'), datetime('now'))''', manga_files)
+            self._apply_pending_remote_file_info(c, "pixiv_manga_image", [(image_id, page) for (image_id, page, _) in manga_files])
             self.conn.commit()
         except BaseException:
             print('Error at insertMangaImages():', str(sys.exc_info()))
@@ -910,10 +1111,12 @@ class PixivDBManager(object):
     def blacklistImage(self, memberId, ImageId):
         try:
             c = self.conn.cursor()
-            c.execute('''INSERT OR REPLACE INTO pixiv_master_image
+            c.execute('''INSERT OR REPLACE INTO pixiv_master_image (image_id, member_id, title, save_name, created_date, last_update_date)
                       VALUES(?, ?, '**BLACKLISTED**' ,'**BLACKLISTED**' , datetime('now'), datetime('now') )''',
                       (ImageId, memberId))
             self.conn.commit()
+            if self._image_index is not None:
+                self._image_index.add(int(ImageId))
         except BaseException:
             print('Error at blacklistImage():', str(sys.exc_info()))
             print('failed')
@@ -921,6 +1124,41 @@ class PixivDBManager(object):
         finally:
             c.close()
 
+    def getImageIdIndex(self):
+        '''Return the ImageIdIndex of pixiv_master_image, loaded once and updated by the insert/delete methods.'''
+        if self._image_index is None:
+            self._image_index = self.loadImageIdIndex()
+        return self._image_index
+
+    def loadImageIdIndex(self):
+        '''Return a new ImageIdIndex of the downloaded images, not cached.
+        The rows left at 'N/A' by an interrupted insert are not downloaded, same as selectImageByImageId().'''
+        try:
+            c = self.conn.cursor()
+            c.execute('''SELECT image_id FROM pixiv_master_image WHERE save_name != 'N/A' ORDER BY image_id''')
+            index = ImageIdIndex(row[0] for row in c)
+            PixivHelper.get_logger().info("Loaded %d image ids from DB.", len(index))
+            return index
+        except BaseException:
+            print('Error at loadImageIdIndex():', str(sys.exc_info()))
+            print('failed')
+            raise
+        finally:
+            c.close()
+
+    def isImageDownloaded(self, image_id):
+        '''True if the image id is in pixiv_master_image with a saved file name, checked in memory without query.'''
+        try:
+            image_id = int(image_id)
+        except (TypeError, ValueError):
+            # unlisted image id
+            return False
+        return image_id in self.getImageIdIndex()
+
+    def selectDownloadedImageIds(self, image_ids):
+        '''Return the set of the given image ids found in pixiv_master_image, checked in memory.'''
+        return set(image_id for image_id in image_ids if self.isImageDownloaded(image_id))
+
     def selectImageByMemberId(self, member_id):
         try:
             c = self.conn.cursor()
@@ -980,6 +1218,9 @@ class PixivDBManager(object):
                       SET title = ?, save_name = ?, last_update_date = datetime('now'), is_manga = COALESCE(?, is_manga), caption = COALESCE(?, caption)
                       WHERE image_id = ?''', (title, filename, isManga, caption, imageId))
             self.conn.commit()
+            # added to the index once the file is saved, see loadImageIdIndex()
+            if self._image_index is not None and c.rowcount > 0 and filename != 'N/A':
+                self._image_index.add(int(imageId))
         except BaseException:
             print('Error at updateImage():', str(sys.exc_info()))
             print('failed')
@@ -994,6 +1235,8 @@ class PixivDBManager(object):
             c.execute('''DELETE FROM pixiv_manga_image WHERE image_id = ?''', (imageId, ))
             c.execute('''DELETE FROM pixiv_image_to_tag WHERE image_id = ?''', (imageId, ))
             self.conn.commit()
+            if self._image_index is not None:
+                self._image_index.discard(int(imageId))
         except BaseException:
             print('Error at deleteImage():', str(sys.exc_info()))
             print('failed')
@@ -1017,7 +1260,7 @@ class PixivDBManager(object):
     def checkFilenames(self, base_filename, exts):
         for ext2 in exts:
             check_name = base_filename + ext2
-            if os.path.exists(check_name):
+            if PixivFileIndex.exists(check_name):
                 return True
         return False
 
@@ -1026,7 +1269,7 @@ class PixivDBManager(object):
         anim_ext = ['.zip', '.gif', '.apng', '.ugoira', '.webm']
         fileExists = False
         if filename is not None or len(filename) > 0:
-            if os.path.exists(filename):
+            if PixivFileIndex.exists(filename):
                 return True
             for ext in anim_ext:
                 # check filename in db against all combination possible filename in disk
@@ -1038,40 +1281,63 @@ class PixivDBManager(object):
         return fileExists
 
     def cleanUp(self):
-        anim_ext = ['.zip', '.gif', '.apng', '.ugoira', '.webm']
+        print("Start clean-up operation.")
+        print("Selecting all images, this may take some times.")
+        try:
+            self._cleanUpTable("cleanUp",
+                               '''SELECT image_id, save_name FROM pixiv_master_image ORDER BY save_name''',
+                               # Issue 340
+                               lambda row: row[1] is None or len(row[1]) == 0 or not self.cleanupFileExists(row[1]),
+                               [('''DELETE FROM pixiv_master_image WHERE image_id = ?''', lambda row: (row[0], )),
+                                ('''DELETE FROM pixiv_manga_image WHERE image_id = ?''', lambda row: (row[0], )),
+                                ('''DELETE FROM pixiv_image_to_tag WHERE image_id = ?''', lambda row: (row[0], ))])
+        finally:
+            # also when interrupted, the chunks done are already deleted
+            self._image_index = None
+
+    def _cleanUpTable(self, name, query, is_missing, delete_statements):
+        '''Read the rows of query in chunks and check is_missing(row) with a thread pool, as the file checks are slow on network storage.
+        The missing rows of each chunk are deleted in one transaction, so the progress is kept if the clean-up is stopped.
+        delete_statements is a list of (statement, get_parameters(row)).'''
+        missing_count = 0
+        checked = 0
+        start = time.monotonic()
+        last_progress = start
         try:
-            print("Start clean-up operation.")
-            print("Selecting all images, this may take some times.")
             c = self.conn.cursor()
-            c.execute('''SELECT image_id, save_name from pixiv_master_image''')
+            d = self.conn.cursor()
+            c.execute(query)
             print("Checking images.")
-            for row in c:
-                # Issue 340
-                filename = row[1]
-                fileExists = False
-
-                if filename is not None and len(filename) > 0:
-                    if os.path.exists(filename):
-                        continue
-
-                    for ext in anim_ext:
-                        # check filename in db against all combination possible filename in disk
-                        if filename.endswith(ext):
-                            base_filename = filename.rsplit(ext, 1)[0]
-                            if self.checkFilenames(base_filename, anim_ext):
-                                fileExists = True
-                                break
-
-                if not fileExists:
-                    print("Missing: {0} at {1}".format(row[0], row[1]))
-                    self.deleteImage(row[0])
-            self.conn.commit()
+            with ThreadPoolExecutor(max_workers=self.CLEANUP_THREADS, thread_name_prefix="cleanup") as executor:
+                while True:
+                    rows = c.fetchmany(self.CLEANUP_CHUNK_SIZE)
+                    if len(rows) == 0:
+                        break
+                    missing = list()
+                    for (row, row_missing) in zip(rows, executor.map(is_missing, rows)):
+                        if row_missing:
+                            print("Missing: {0} at {1}".format(row[0], row[-1]))
+                            missing.append(row)
+                    if len(missing) > 0:
+                        with self.transaction():
+                            for (statement, get_parameters) in delete_statements:
+                                d.executemany(statement, map(get_parameters, missing))
+                    checked = checked + len(rows)
+                    missing_count = missing_count + len(missing)
+                    now = time.monotonic()
+                    if now - last_progress >= self.CLEANUP_PROGRESS_INTERVAL:
+                        last_progress = now
+                        print(f"Checked {checked} rows, deleted {missing_count} missing rows ({checked / (now - start):.0f} rows/s).")
+
+            elapsed = time.monotonic() - start
+            print(f"Checked {checked} rows in {elapsed:.1f}s, deleted {missing_count} missing rows.")
         except BaseException:
-            print('Error at cleanUp():', str(sys.exc_info()))
+            print(f'Error at {name}():', str(sys.exc_info()))
             print('failed')
             raise
         finally:
             c.close()
+            d.close()
 
     def interactiveCleanUp(self):
         items = []
@@ -1181,6 +1447,83 @@ class PixivDBManager(object):
         finally:
             c.close()
 
+    def _get_remote_file_info_key(self, download_from, image_id, page):
+        '''Return (table, where clause, parameters) of the row storing the file, or None if not supported.'''
+        if download_from == PixivConstant.DOWNLOAD_PIXIV:
+            if page is None:
+                return ("pixiv_master_image", "image_id = ?", (int(image_id), ))
+            return ("pixiv_manga_image", "image_id = ? AND page = ?", (int(image_id), int(page)))
+        if download_from == PixivConstant.DOWNLOAD_FANBOX:
+            return ("fanbox_post_image", "post_id = ? AND page = ?", (int(image_id), -1 if page is None else int(page)))
+        return None
+
+    def selectRemoteFileInfo(self, download_from, image_id, page):
+        '''Return (remote_size, etag, last_modified, checked_date) of the downloaded file, or None.'''
+        key = self._get_remote_file_info_key(download_from, image_id, page)
+        if key is None:
+            return None
+        (table, where, params) = key
+        try:
+            c = self.conn.cursor()
+            # rows checked before remote_checked_date was added use last_update_date
+            c.execute(f'''SELECT remote_size, etag, last_modified, COALESCE(remote_checked_date, last_update_date)
+                      FROM {table} WHERE {where}''', params)
+            return c.fetchone()
+        except BaseException:
+            print('Error at selectRemoteFileInfo():', str(sys.exc_info()))
+            print('failed')
+            raise
+        finally:
+            c.close()
+
+    def updateRemoteFileInfo(self, download_from, image_id, page, remote_size, etag, last_modified):
+        '''Save the remote file size and validators, kept in memory until the row is inserted if it is not in the DB yet.'''
+        key = self._get_remote_file_info_key(download_from, image_id, page)
+        if key is None:
+            return
+        (table, where, params) = key
+        try:
+            c = self.conn.cursor()
+            c.execute(f'''UPDATE {table} SET remote_size = ?, etag = ?, last_modified = ?, remote_checked_date = datetime('now')
+                      WHERE {where}''', (remote_size, etag, last_modified) + params)
+            if c.rowcount == 0:
+                self._pending_remote_file_info[(table, ) + params] = (remote_size, etag, last_modified)
+            self.conn.commit()
+        except BaseException:
+            print('Error at updateRemoteFileInfo():', str(sys.exc_info()))
+            print('failed')
+            raise
+        finally:
+            c.close()
+
+    def _apply_pending_remote_file_info(self, c, table, keys):
+        '''Save the remote file info received before the rows were inserted.'''
+        if len(self._pending_remote_file_info) == 0:
+            return
+        for (image_id, page) in keys:
+            params = (int(image_id), ) if page is None else (int(image_id), int(page))
+            info = self._pending_remote_file_info.pop((table, ) + params, None)
+            if info is None:
+                continue
+            where = "image_id = ?" if page is None else ("post_id = ? AND page = ?" if table == "fanbox_post_image" else "image_id = ? AND page = ?")
+            c.execute(f'''UPDATE {table} SET remote_size = ?, etag = ?, last_modified = ?, remote_checked_date = datetime('now')
+                      WHERE {where}''', info + params)
+
+    def discardPendingRemoteFileInfo(self, download_from, image_id):
+        '''Drop the remote file info kept for the rows of the post which were not inserted, e.g. failed or skipped.
+        Called at the end of each post, so the pending info does not grow for the whole session.'''
+        if len(self._pending_remote_file_info) == 0:
+            return
+        tables = {PixivConstant.DOWNLOAD_PIXIV: ("pixiv_master_image", "pixiv_manga_image"),
+                  PixivConstant.DOWNLOAD_FANBOX: ("fanbox_post_image", )}.get(download_from, ())
+        try:
+            image_id = int(image_id)
+        except (TypeError, ValueError):
+            # unlisted image
+            return
+        for key in [key for key in self._pending_remote_file_info if key[0] in tables and key[1] == image_id]:
+            del self._pending_remote_file_info[key]
+
 ##########################################
 # VI. CRUD FANBOX post/image table       #
 ##########################################
@@ -1207,8 +1550,9 @@ class PixivDBManager(object):
     def insertPostImages(self, post_files):
         try:
             c = self.conn.cursor()
-            c.executemany('''INSERT OR REPLACE INTO fanbox_post_image
+            c.executemany('''INSERT OR REPLACE INTO fanbox_post_image (post_id, page, save_name, created_date, last_update_date)
                           VALUES(?, ?, ?, datetime('now'), datetime('now'))''', post_files)
+            self._apply_pending_remote_file_info(c, "fanbox_post_image", [(post_id, page) for (post_id, page, _) in post_files])
             self.conn.commit()
         except BaseException:
             print('Error at insertPostImages():', str(sys.exc_info()))
@@ -1282,31 +1626,11 @@ class PixivDBManager(object):
     def cleanUpFanbox(self):
         print("Start FANBOX clean-up operation.")
         print("Selecting all FANBOX images, this may take some times.")
-        items = []
-        try:
-            c = self.conn.cursor()
-            c.execute('''SELECT post_id, page, save_name from fanbox_post_image''')
-            print("Checking images.")
-            for row in c:
-                filename = row[2]
-
-                if filename is not None and len(filename) > 0:
-                    if os.path.exists(filename):
-                        continue
-
-                print("Missing: {0} at {1}".format(row[0], row[2]))
-                items.append(row)
-
-            for item in items:
-                c.execute('''DELETE FROM fanbox_post_image WHERE post_id = ? and page = ?''', (item[0], item[1]))
-                c.execute('''DELETE FROM fanbox_master_post WHERE post_id = ?''', (item[0],))
-            self.conn.commit()
-        except BaseException:
-            print('Error at cleanUpFanbox():', str(sys.exc_info()))
-            print('failed')
-            raise
-        finally:
-            c.close()
+        self._cleanUpTable("cleanUpFanbox",
+                           '''SELECT post_id, page, save_name FROM fanbox_post_image ORDER BY save_name''',
+                           lambda row: row[2] is None or len(row[2]) == 0 or not PixivFileIndex.exists(row[2]),
+                           [('''DELETE FROM fanbox_post_image WHERE post_id = ? and page = ?''', lambda row: (row[0], row[1])),
+                            ('''DELETE FROM fanbox_master_post WHERE post_id = ?''', lambda row: (row[0], ))])
 
     def interactiveCleanUpFanbox(self):
         items = []
@@ -1442,31 +1766,14 @@ class PixivDBManager(object):
             c.close()
 
     def cleanUpSketch(self):
-        try:
-            print("Start sketch clean-up operation.")
-            print("Selecting all sketches, this may take some times.")
-            c = self.conn.cursor()
-            c.execute('''SELECT post_id, page, save_name from sketch_post_image''')
-            print("Checking images.")
-            for row in c:
-                # Issue 340
-                filename = row[2]
-                fileExists = False
-
-                if filename is not None and len(filename) > 0:
-                    if os.path.exists(filename):
-                        continue
-
-                if not fileExists:
-                    print("Missing: {0} at {1}".format(row[0], row[2]))
-                    self.deleteSketch(row[0])
-            self.conn.commit()
-        except BaseException:
-            print('Error at cleanUpSketch():', str(sys.exc_info()))
-            print('failed')
-            raise
-        finally:
-            c.close()
+        print("Start sketch clean-up operation.")
+        print("Selecting all sketches, this may take some times.")
+        self._cleanUpTable("cleanUpSketch",
+                           '''SELECT post_id, page, save_name FROM sketch_post_image ORDER BY save_name''',
+                           # Issue 340
+                           lambda row: row[2] is None or len(row[2]) == 0 or not PixivFileIndex.exists(row[2]),
+                           [('''DELETE FROM sketch_master_post WHERE post_id = ?''', lambda row: (row[0], )),
+                            ('''DELETE FROM sketch_post_image WHERE post_id = ?''', lambda row: (row[0], ))])
 
     def interactiveSketchCleanUp(self):
         items = []
@@ -1744,3 +2051,196 @@ class PixivDBManager(object):
         except BaseException:
             print('Error: ', sys.exc_info())
             self.main()
+
+
+class ConcurrentDBManager(object):
+    """Thread safe facade of a PixivDBManager with the same methods, shared by the worker threads.
+    The queries use a read-only connection per thread. The writes are executed by a single writer thread,
+    which commits the writes queued by all the threads in one transaction, and the caller waits for the commit.
+    The maintenance methods (clean up, interactive menu, ...) run in the calling thread while the writer is paused."""
+
+    WRITE_METHODS = frozenset(["importList", "insertNewMember", "updateMemberName", "updateSaveFolder",
+                               "updateLastDownloadedImage", "updateLastDownloadDate", "deleteMemberByMemberId",
+                               "deleteCascadeMemberByMemberId", "setIsDeletedFlagForMemberId",
+                               "insertTag", "insertImageToTag", "insertTagTranslation", "insertImageTags", "deleteImagesByTag",
+                               "insertImage", "insertMangaImages", "blacklistImage", "updateImage", "deleteImage",
+                               "deleteSketch", "updateRemoteFileInfo", "discardPendingRemoteFileInfo",
+                               "insertPost", "insertPostImages", "updatePostUpdateDate", "deleteFanboxPost",
+                               "insertSketchPost", "insertSketchPostImages", "deleteSketchPost", "insertNovelPost"])
+    EXCLUSIVE_METHODS = frozenset(["createDatabase", "migrateDatabase", "dropDatabase", "compactDatabase",
+                                   "deleteMembersByList", "keepMembersByList", "replaceRootPath",
+                                   "cleanUp", "interactiveCleanUp", "cleanUpFanbox", "interactiveCleanUpFanbox",
+                                   "cleanUpSketch", "interactiveSketchCleanUp", "create_update_novel_table",
+                                   "menu", "main"])
+    # maximum number of queued units committed in one transaction
+    MAX_BATCH = 100
+
+    def __init__(self, db_manager):
+        self._db = db_manager
+        self._queue = queue.Queue()
+        self._write_lock = threading.RLock()
+        self._index_lock = threading.Lock()
+        self._local = threading.local()
+        self._readers = list()
+        self._readers_lock = threading.Lock()
+        # set when the writer thread exits, the writes submitted after it fail
+        self._closed = False
+        self._closed_lock = threading.Lock()
+        self._writer = threading.Thread(target=self._run, name="db-writer", daemon=True)
+        self._writer.start()
+
+    def __getattr__(self, name):
+        attr = getattr(self._db, name)
+        if not callable(attr) or name.startswith("_"):
+            return attr
+        if name in self.WRITE_METHODS:
+            return partial(self._write, name)
+        if name in self.EXCLUSIVE_METHODS:
+            return partial(self._exclusive, attr)
+        return getattr(self._get_reader(), name)
+
+    def _get_reader(self):
+        reader = getattr(self._local, "reader", None)
+        if reader is None:
+            reader = self._db.createReader()
+            self._local.reader = reader
+            with self._readers_lock:
+                self._readers.append(reader)
+        return reader
+
+    def _exclusive(self, method, *args, **kwargs):
+        with self._write_lock:
+            return method(*args, **kwargs)
+
+    def _write(self, name, *args, **kwargs):
+        calls = getattr(self._local, "calls", None)
+        if calls is not None:
+            # inside transaction(), sent with the other writes of the block
+            calls.append((name, args, kwargs))
+            return None
+        return self._submit([(name, args, kwargs)]).result()[0]
+
+    def _submit(self, calls):
+        future = Future()
+        with self._closed_lock:
+            if self._closed:
+                future.set_exception(sqlite3.ProgrammingError("Cannot write to a closed ConcurrentDBManager."))
+            else:
+                self._queue.put((calls, future))
+        return future
+
+    @contextmanager
+    def transaction(self):
+        '''Send the writes made by this thread inside the block to the writer at the end, committed together.
+        The writes are dropped if the block raises. The queries inside the block do not see its writes.'''
+        if getattr(self._local, "calls", None) is not None:
+            yield self
+            return
+        self._local.calls = list()
+        try:
+            yield self
+            calls = self._local.calls
+        finally:
+            self._local.calls = None
+        if len(calls) > 0:
+            self._submit(calls).result()
+
+    def _run(self):
+        stopped = False
+        try:
+            while not stopped:
+                batch = list()
+                item = self._queue.get()
+                # commit the writes queued meanwhile by the other threads in the same transaction,
+                # up to the None sent by close()
+                while True:
+                    if item is None:
+                        stopped = True
+                        break
+                    batch.append(item)
+                    if len(batch) >= self.MAX_BATCH:
+                        break
+                    try:
+                        item = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                self._execute(batch)
+        finally:
+            self._fail_pending()
+
+    def _fail_pending(self):
+        '''Fail the writes still queued when the writer exits, so their callers do not wait forever.'''
+        with self._closed_lock:
+            self._closed = True
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            if item is not None:
+                item[1].set_exception(sqlite3.ProgrammingError("Cannot write to a closed ConcurrentDBManager."))
+
+    def _execute(self, batch):
+        if len(batch) == 0:
+            return
+        results = list()
+        with self._write_lock:
+            try:
+                with self._db.transaction():
+                    self._db.conn.execute('''BEGIN''')
+                    for (calls, future) in batch:
+                        results.append((future, self._execute_unit(calls)))
+            except BaseException as ex:
+                results = [(future, (False, ex)) for (_, future) in batch]
+        for (future, (success, value)) in results:
+            if success:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+    def _execute_unit(self, calls):
+        '''Execute the writes of one transaction() block, rolled back to the savepoint if one failed.'''
+        self._db.conn.execute('''SAVEPOINT unit''')
+        try:
+            values = [getattr(self._db, name)(*args, **kwargs) for (name, args, kwargs) in calls]
+        except Exception as ex:
+            self._db.conn.execute('''ROLLBACK TO unit''')
+            self._db.conn.execute('''RELEASE unit''')
+            # the caches might contain the rolled back rows
+            self._db._image_index = None
+            self._db._known_tags = None
+            return (False, ex)
+        self._db.conn.execute('''RELEASE unit''')
+        return (True, values)
+
+    def getImageIdIndex(self):
+        '''Shared index of the writer, loaded by a reader connection.
+        The writer is paused while loading, so no write is missed between the query and sharing the index.'''
+        with self._index_lock:
+            index = self._db._image_index
+            if index is None:
+                with self._write_lock:
+                    index = self._get_reader().loadImageIdIndex()
+                    self._db._image_index = index
+            return index
+
+    def isImageDownloaded(self, image_id):
+        try:
+            image_id = int(image_id)
+        except (TypeError, ValueError):
+            return False
+        return image_id in self.getImageIdIndex()
+
+    def selectDownloadedImageIds(self, image_ids):
+        return set(image_id for image_id in image_ids if self.isImageDownloaded(image_id))
+
+    def close(self):
+        '''Commit the queued writes, stop the writer thread and close all the connections.'''
+        if self._writer.is_alive():
+            self._queue.put(None)
+            self._writer.join()
+        with self._readers_lock:
+            for reader in self._readers:
+                reader.close()
+            self._readers.clear()
+        self._db.close()
@@ -8,13 +8,17 @@ import sys
 import time
 import traceback
 import urllib
+from datetime import datetime, timezone
 
-import mechanize
 
 import PixivBrowserFactory
+import PixivCircuitBreaker
 import PixivConfig
 import PixivConstant
+import PixivFileIndex
 import PixivHelper
+import PixivRateLimiter
+import PixivStatistics
 from PixivDBManager import PixivDBManager
 from PixivException import PixivException
 
@@ -33,7 +37,6 @@ def download_image(caller,
     '''return download result and filename if ok'''
     # caller function/method
     # TODO: ideally to be removed or passed as argument
-    db: PixivDBManager = caller.__dbManager__
     config: PixivConfig = caller.__config__
 
     if notifier is None:
@@ -42,249 +45,42 @@ def download_image(caller,
     temp_error_code = None
     retry_count = 0
 
-    # Issue #548
-    filename_save = filename
-
-    # test once and set the result
-    if caller.UTF8_FS is None:
-        filename_test = os.path.dirname(filename_save) + os.sep + "あいうえお"
-        try:
-            PixivHelper.makeSubdirs(filename_test)
-            test_utf = open(filename_test + '.test', "wb")
-            test_utf.close()
-            os.remove(filename_test + '.test')
-            caller.UTF8_FS = True
-        except UnicodeEncodeError:
-            caller.UTF8_FS = False
-
-    if not caller.UTF8_FS:
-        filename_save = filename.encode('utf-8')  # For file operations, force the usage of a utf-8 encode filename
+    filename_save = get_filename_save(caller, filename)
 
     while retry_count <= max_retry:
         res = None
         req = None
         try:
             try:
-                is_exists = os.path.isfile(filename_save)
-
-                if not overwrite and not config.alwaysCheckFileSize:
-                    PixivHelper.print_and_log(None, '\rChecking local filename...', newline=False)
-                    if is_exists:
-                        PixivHelper.print_and_log('info', f"\rLocal file exists: {filename}")
-                        return (PixivConstant.PIXIVUTIL_SKIP_DUPLICATE, filename_save)
-
-                # Issue #807
-                if config.checkLastModified and is_exists and image is not None:
-                    local_timestamp = os.path.getmtime(filename_save)
-                    remote_timestamp = time.mktime(image.worksDateDateTime.timetuple())
-                    if local_timestamp == remote_timestamp:
-                        PixivHelper.print_and_log('info', f"\rLocal file timestamp match with remote: {filename} => {image.worksDateDateTime}")
-                        return (PixivConstant.PIXIVUTIL_SKIP_DUPLICATE, filename_save)
-
-                if is_exists:
-                    remote_file_size = get_remote_filesize(url, referer, config, notifier)
-                else:
-                    remote_file_size = -1
-                    # PixivHelper.print_and_log(None, "\rSkipped getting remote file size because local file not exists")
-
-                # 837
-                if config.skipUnknownSize and is_exists and remote_file_size == -1:
-                    PixivHelper.print_and_log('info', f"\rSkipped because file exists and cannot get remote file size for: {filename}")
-                    return (PixivConstant.PIXIVUTIL_SKIP_DUPLICATE, filename_save)
-
-                # 576
-                if remote_file_size > 0:
-                    if config.minFileSize != 0 and remote_file_size <= config.minFileSize:
-                        result = PixivConstant.PIXIVUTIL_SIZE_LIMIT_SMALLER
-                        return (result, filename_save)
-                    if config.maxFileSize != 0 and remote_file_size >= config.maxFileSize:
-                        result = PixivConstant.PIXIVUTIL_SIZE_LIMIT_LARGER
-                        return (result, filename_save)
-
-                # check if existing ugoira file exists
-                if filename.endswith(".zip"):
-                    # non-converted zip (no animation.json)
-                    if is_exists:
-                        old_size = os.path.getsize(filename_save)
-                        # update for #451, always return identical?
-                        check_result = PixivHelper.check_file_exists(config, filename_save, remote_file_size, old_size)
-                        if config.createUgoira:
-                            handle_ugoira(image, filename_save, config, notifier)
-                        return (check_result, filename)
-                    # converted to ugoira (has animation.json)
-                    ugo_name = filename[:-4] + ".ugoira"
-                    if os.path.isfile(ugo_name):
-                        old_size = PixivHelper.get_ugoira_size(ugo_name)
-                        check_result = PixivHelper.check_file_exists(config, ugo_name, remote_file_size, old_size)
-                        if check_result != PixivConstant.PIXIVUTIL_OK:
-                            # try to convert existing file.
-                            handle_ugoira(image, filename_save, config, notifier)
-
-                            return (check_result, filename)
-                elif is_exists:
-                    # other image? files
-                    old_size = os.path.getsize(filename_save)
-                    check_result = PixivHelper.check_file_exists(config, filename, remote_file_size, old_size)
-                    if check_result != PixivConstant.PIXIVUTIL_OK:
-                        return (check_result, filename)
-
-                # check based on filename stored in DB using image id
-                if image is not None:
-                    row = None
-                    db_filename = None
-                    # Issue #1084
-                    if download_from == PixivConstant.DOWNLOAD_PIXIV:
-                        if page is not None:
-                            row = db.selectImageByImageIdAndPage(image.imageId, page)
-                            if row is not None:
-                                db_filename = row[2]
-                        else:
-                            row = db.selectImageByImageId(image.imageId)
-                            if row is not None:
-                                db_filename = row[3]
-                    elif download_from == PixivConstant.DOWNLOAD_FANBOX:
-                        if page is not None:
-                            row = db.selectFanboxImageByImageIdAndPage(image.imageId, page)
-                        else:
-                            row = db.selectFanboxImageByImageIdAndPage(image.imageId, -1)  # Cover image
-                        if row is not None:
-                            db_filename = row[2]
-                    elif download_from == PixivConstant.DOWNLOAD_SKETCH:
-                        if page is not None:
-                            row = db.selectSketchImageByImageIdAndPage(image.imageId, page)
-                        else:
-                            row = db.selectSketchImageByImageIdAndPage(image.imageId, 0)
-                        if row is not None:
-                            db_filename = row[2]
-
-                    if db_filename is not None and os.path.isfile(db_filename):
-                        old_size = os.path.getsize(db_filename)
-                        # if file_size < 0:
-                        #     file_size = get_remote_filesize(url, referer)
-                        check_result = PixivHelper.check_file_exists(config, db_filename, remote_file_size, old_size)
-                        if check_result != PixivConstant.PIXIVUTIL_OK:
-                            ugo_name = None
-                            if db_filename.endswith(".zip"):
-                                ugo_name = filename[:-4] + ".ugoira"
-                                if config.createUgoira:
-                                    handle_ugoira(image, db_filename, config, notifier)
-                            if db_filename.endswith(".ugoira"):
-                                ugo_name = db_filename
-                                handle_ugoira(image, db_filename, config, notifier)
-
-                            return (check_result, db_filename)
+                (check_result, remote_file_size) = check_before_download(caller,
+                                                                         config,
+                                                                         url,
+                                                                         filename,
+                                                                         filename_save,
+                                                                         referer,
+                                                                         overwrite,
+                                                                         image,
+                                                                         page,
+                                                                         notifier,
+                                                                         download_from)
+                if check_result is not None:
+                    return check_result
 
                 # actual download
                 notifier(type="DOWNLOAD", message=f"Start downloading {url} to {filename_save}")
-                (downloadedSize, filename_save) = perform_download(url, remote_file_size, filename_save, overwrite, config, referer)
-
-                # double check after download, because the file might be deleted due to partial download
-                is_exists = os.path.isfile(filename_save)
-
-                # Issue #956 need to calculate hash file for each method
-                old_filename_save = filename_save
-                if filename_save.find("%md5%") > 0:
-                    PixivHelper.print_and_log('info', 'Calculating md5...', end="")
-                    hash_str = PixivHelper.get_hash(filename_save)
-                    PixivHelper.print_and_log('info', f" => {hash_str}")
-                    filename_save = filename_save.replace("%md5%", hash_str)
-                if filename_save.find("%sha1%") > 0:
-                    PixivHelper.print_and_log('info', 'Calculating sha1...', end="")
-                    hash_str = PixivHelper.get_hash(filename_save, "sha1")
-                    PixivHelper.print_and_log('info', f" => {hash_str}")
-                    filename_save = filename_save.replace("%sha1%", hash_str)
-                if filename_save.find("%sha256%") > 0:
-                    PixivHelper.print_and_log('info', 'Calculating sha256...', end="")
-                    hash_str = PixivHelper.get_hash(filename_save, "sha256")
-                    PixivHelper.print_and_log('info', f" => {hash_str}")
-                    filename_save = filename_save.replace("%sha256%", hash_str)
-                if not os.path.exists(filename_save) and os.path.exists(old_filename_save):
-                    os.rename(old_filename_save, filename_save)
-
-                # set last-modified and last-accessed timestamp
-                if image is not None and config.setLastModified and filename_save is not None and is_exists:
-                    ts = time.mktime(image.worksDateDateTime.timetuple())
-                    os.utime(filename_save, (ts, ts))
-
-                # check the downloaded file size again
-                if remote_file_size > 0 and downloadedSize != remote_file_size:
-                    PixivHelper.print_and_log('error', f"Incomplete Download for {url} => {filename_save}")
+                (downloadedSize, filename_save, headers) = perform_download(url, remote_file_size, filename_save, overwrite, config, referer)
+
+                result = finish_download(caller, config, url, filename_save, downloadedSize, remote_file_size, image)
+                if result is not None and result[0] == PixivConstant.PIXIVUTIL_OK:
+                    save_remote_file_info(caller, image, page, download_from, downloadedSize, headers)
+                if result is None:
                     if retry_count < max_retry:
                         retry_count = retry_count + 1
                         PixivHelper.print_and_log(None, f"\rRetrying [{retry_count}]...", newline=False)
                         PixivHelper.print_delay(config.retryWait)
                         continue
                     return (PixivConstant.DOWNLOAD_FAILED_OTHER, filename_save)
-
-                elif config.verifyImage and filename_save.endswith((".jpg", ".png", ".gif")) and is_exists:
-                    fp = None
-                    try:
-                        from PIL import Image, ImageFile
-                        fp = open(filename_save, "rb")
-                        # Fix Issue #269, refer to https://stackoverflow.com/a/42682508
-                        ImageFile.LOAD_TRUNCATED_IMAGES = True
-                        img = Image.open(fp)
-                        img.load()
-                        fp.close()
-                        PixivHelper.print_and_log('info', ' Image verified.')
-                    except BaseException:
-                        if fp is not None:
-                            fp.close()
-                        PixivHelper.print_and_log('info', ' Image invalid, deleting...')
-                        os.remove(filename_save)
-                        raise
-                elif config.verifyImage and filename_save.endswith((".ugoira", ".zip")):
-                    fp = None
-                    try:
-                        import zipfile
-                        fp = open(filename_save, "rb")
-                        zf = zipfile.ZipFile(fp)
-                        check_result = None
-                        try:
-                            check_result = zf.testzip()
-                        # Issue #1165
-                        except NotImplementedError as ne:
-                            PixivHelper.print_and_log('warn', f' {ne}')
-                        except RuntimeError as e:
-                            if 'encrypted' in str(e):
-                                PixivHelper.print_and_log('info', ' archive is encrypted, cannot verify.')
-                            else:
-                                raise
-                        fp.close()
-                        if check_result is None:
-                            PixivHelper.print_and_log('info', ' Image verified.')
-                        else:
-                            PixivHelper.print_and_log('info', f' Corrupted file in archive: {check_result}.')
-                            raise PixivException(f"Incomplete Downloaded for {url}", PixivException.DOWNLOAD_FAILED_OTHER)
-                    except BaseException:
-                        if fp is not None:
-                            fp.close()
-                        PixivHelper.print_and_log('info', ' Image invalid, deleting...')
-                        os.remove(filename_save)
-                        raise
-                PixivHelper.print_and_log('info', f' Download done ==> {filename_save}')
-
-                # codecs.open is stateless, so if platform_encoding == utf-8-sig each new line starts from utf-8-sig
-                # this is bad and I feel bad
-
-                if os.path.isfile(caller.dfilename):
-                    dfile_encoding = 'utf-8'
-                else:
-                    dfile_encoding = caller.platform_encoding
-
-                # write to downloaded lists
-                if caller.start_iv or config.createDownloadLists:
-                    dfile = codecs.open(caller.dfilename, 'a+', encoding=dfile_encoding)
-                    dfile.write(filename_save + "\n")
-                    dfile.close()
-
-                # Issue #970
-                if config.enablePostProcessing and len(config.postProcessingCmd) > 0:
-                    cmd = config.postProcessingCmd.replace("%filename%", filename_save)
-                    PixivHelper.print_and_log('info', f'Running post processing command: {cmd}')
-                    subprocess.Popen(shlex.split(cmd), startupinfo=None)
-
-                return (PixivConstant.PIXIVUTIL_OK, filename_save)
+                return result
 
             except urllib.error.HTTPError as httpError:
                 PixivHelper.print_and_log('error', f'[download_image()] HTTP Error: {httpError} at {url}')
@@ -313,10 +109,15 @@ def download_image(caller,
                     del req
 
         except BaseException:
+            exc_type, exc_value, exc_traceback = sys.exc_info()
+            if PixivCircuitBreaker.is_circuit_open_error(exc_value):
+                # fail fast, no point to retry until the backend recover
+                caller.ERROR_CODE = PixivException.CIRCUIT_OPEN
+                PixivHelper.print_and_log('error', f'{exc_value.message} at {url}')
+                raise
             if temp_error_code is None:
                 temp_error_code = PixivException.DOWNLOAD_FAILED_OTHER
             caller.ERROR_CODE = temp_error_code
-            exc_type, exc_value, exc_traceback = sys.exc_info()
             traceback.print_exception(exc_type, exc_value, exc_traceback)
             PixivHelper.print_and_log('error', f'Error at download_image(): {sys.exc_info()} at {url} ({caller.ERROR_CODE})')
 
@@ -328,6 +129,258 @@ def download_image(caller,
                 raise
 
 
+def get_filename_save(caller, filename):
+    '''Return the filename to be used for file operations.'''
+    # Issue #548
+    filename_save = filename
+
+    # test once and set the result
+    if caller.UTF8_FS is None:
+        filename_test = os.path.dirname(filename_save) + os.sep + "あいうえお"
+        try:
+            PixivHelper.makeSubdirs(filename_test)
+            test_utf = open(filename_test + '.test', "wb")
+            test_utf.close()
+            os.remove(filename_test + '.test')
+            caller.UTF8_FS = True
+        except UnicodeEncodeError:
+            caller.UTF8_FS = False
+
+    if not caller.UTF8_FS:
+        filename_save = filename.encode('utf-8')  # For file operations, force the usage of a utf-8 encode filename
+    return filename_save
+
+
+def check_before_download(caller, config, url, filename, filename_save, referer, overwrite, image=None, page=None, notifier=None, download_from=PixivConstant.DOWNLOAD_PIXIV):
+    '''Check the local file and the DB before downloading.
+    Return (result, remote_file_size), result is (result_code, filename) if the download can be skipped, otherwise None.'''
+    db: PixivDBManager = caller.__dbManager__
+    remote_file_size = -1
+
+    is_exists = PixivFileIndex.isfile(filename_save)
+
+    if not overwrite and not config.alwaysCheckFileSize:
+        PixivHelper.print_and_log(None, '\rChecking local filename...', newline=False)
+        if is_exists:
+            PixivHelper.print_and_log('info', f"\rLocal file exists: {filename}")
+            return ((PixivConstant.PIXIVUTIL_SKIP_DUPLICATE, filename_save), remote_file_size)
+
+    # Issue #807
+    if config.checkLastModified and is_exists and image is not None:
+        local_timestamp = PixivFileIndex.getmtime(filename_save)
+        remote_timestamp = time.mktime(image.worksDateDateTime.timetuple())
+        if local_timestamp == remote_timestamp:
+            PixivHelper.print_and_log('info', f"\rLocal file timestamp match with remote: {filename} => {image.worksDateDateTime}")
+            return ((PixivConstant.PIXIVUTIL_SKIP_DUPLICATE, filename_save), remote_file_size)
+
+    if is_exists:
+        remote_file_size = get_known_remote_filesize(caller, config, url, referer, image, page, download_from, notifier)
+    else:
+        remote_file_size = -1
+        # PixivHelper.print_and_log(None, "\rSkipped getting remote file size because local file not exists")
+
+    # 837
+    if config.skipUnknownSize and is_exists and remote_file_size == -1:
+        PixivHelper.print_and_log('info', f"\rSkipped because file exists and cannot get remote file size for: {filename}")
+        return ((PixivConstant.PIXIVUTIL_SKIP_DUPLICATE, filename_save), remote_file_size)
+
+    # 576
+    if remote_file_size > 0:
+        if config.minFileSize != 0 and remote_file_size <= config.minFileSize:
+            result = PixivConstant.PIXIVUTIL_SIZE_LIMIT_SMALLER
+            return ((result, filename_save), remote_file_size)
+        if config.maxFileSize != 0 and remote_file_size >= config.maxFileSize:
+            result = PixivConstant.PIXIVUTIL_SIZE_LIMIT_LARGER
+            return ((result, filename_save), remote_file_size)
+
+    # check if existing ugoira file exists
+    if filename.endswith(".zip"):
+        # non-converted zip (no animation.json)
+        if is_exists:
+            old_size = PixivFileIndex.getsize(filename_save)
+            # update for #451, always return identical?
+            check_result = PixivHelper.check_file_exists(config, filename_save, remote_file_size, old_size)
+            if config.createUgoira:
+                handle_ugoira(image, filename_save, config, notifier)
+            return ((check_result, filename), remote_file_size)
+        # converted to ugoira (has animation.json)
+        ugo_name = filename[:-4] + ".ugoira"
+        if PixivFileIndex.isfile(ugo_name):
+            old_size = PixivHelper.get_ugoira_size(ugo_name)
+            check_result = PixivHelper.check_file_exists(config, ugo_name, remote_file_size, old_size)
+            if check_result != PixivConstant.PIXIVUTIL_OK:
+                # try to convert existing file.
+                handle_ugoira(image, filename_save, config, notifier)
+
+                return ((check_result, filename), remote_file_size)
+    elif is_exists:
+        # other image? files
+        old_size = PixivFileIndex.getsize(filename_save)
+        check_result = PixivHelper.check_file_exists(config, filename, remote_file_size, old_size)
+        if check_result != PixivConstant.PIXIVUTIL_OK:
+            return ((check_result, filename), remote_file_size)
+
+    # check based on filename stored in DB using image id
+    if image is not None:
+        row = None
+        db_filename = None
+        # Issue #1084
+        if download_from == PixivConstant.DOWNLOAD_PIXIV:
+            if page is not None:
+                row = db.selectImageByImageIdAndPage(image.imageId, page)
+                if row is not None:
+                    db_filename = row[2]
+            else:
+                row = db.selectImageByImageId(image.imageId)
+                if row is not None:
+                    db_filename = row[3]
+        elif download_from == PixivConstant.DOWNLOAD_FANBOX:
+            if page is not None:
+                row = db.selectFanboxImageByImageIdAndPage(image.imageId, page)
+            else:
+                row = db.selectFanboxImageByImageIdAndPage(image.imageId, -1)  # Cover image
+            if row is not None:
+                db_filename = row[2]
+        elif download_from == PixivConstant.DOWNLOAD_SKETCH:
+            if page is not None:
+                row = db.selectSketchImageByImageIdAndPage(image.imageId, page)
+            else:
+                row = db.selectSketchImageByImageIdAndPage(image.imageId, 0)
+            if row is not None:
+                db_filename = row[2]
+
+        if db_filename is not None and PixivFileIndex.isfile(db_filename):
+            old_size = PixivFileIndex.getsize(db_filename)
+            # if file_size < 0:
+            #     file_size = get_remote_filesize(url, referer)
+            check_result = PixivHelper.check_file_exists(config, db_filename, remote_file_size, old_size)
+            if check_result != PixivConstant.PIXIVUTIL_OK:
+                ugo_name = None
+                if db_filename.endswith(".zip"):
+                    ugo_name = filename[:-4] + ".ugoira"
+                    if config.createUgoira:
+                        handle_ugoira(image, db_filename, config, notifier)
+                if db_filename.endswith(".ugoira"):
+                    ugo_name = db_filename
+                    handle_ugoira(image, db_filename, config, notifier)
+
+                return ((check_result, db_filename), remote_file_size)
+
+    return (None, remote_file_size)
+
+
+def finish_download(caller, config, url, filename_save, downloadedSize, remote_file_size, image=None):
+    '''Rename, verify and post process the downloaded file.
+    Return (result_code, filename), or None if the download is incomplete and need to be retried.'''
+    # double check after download, because the file might be deleted due to partial download
+    is_exists = os.path.isfile(filename_save)
+
+    # Issue #956 need to calculate hash file for each method
+    old_filename_save = filename_save
+    if filename_save.find("%md5%") > 0:
+        PixivHelper.print_and_log('info', 'Calculating md5...', end="")
+        hash_str = PixivHelper.get_hash(filename_save)
+        PixivHelper.print_and_log('info', f" => {hash_str}")
+        filename_save = filename_save.replace("%md5%", hash_str)
+    if filename_save.find("%sha1%") > 0:
+        PixivHelper.print_and_log('info', 'Calculating sha1...', end="")
+        hash_str = PixivHelper.get_hash(filename_save, "sha1")
+        PixivHelper.print_and_log('info', f" => {hash_str}")
+        filename_save = filename_save.replace("%sha1%", hash_str)
+    if filename_save.find("%sha256%") > 0:
+        PixivHelper.print_and_log('info', 'Calculating sha256...', end="")
+        hash_str = PixivHelper.get_hash(filename_save, "sha256")
+        PixivHelper.print_and_log('info', f" => {hash_str}")
+        filename_save = filename_save.replace("%sha256%", hash_str)
+    if not os.path.exists(filename_save) and os.path.exists(old_filename_save):
+        os.rename(old_filename_save, filename_save)
+        PixivFileIndex.invalidate(old_filename_save)
+        PixivFileIndex.invalidate(filename_save)
+
+    # set last-modified and last-accessed timestamp
+    if image is not None and config.setLastModified and filename_save is not None and is_exists:
+        ts = time.mktime(image.worksDateDateTime.timetuple())
+        os.utime(filename_save, (ts, ts))
+        PixivFileIndex.invalidate(filename_save)
+
+    # check the downloaded file size again
+    if remote_file_size > 0 and downloadedSize != remote_file_size:
+        PixivHelper.print_and_log('error', f"Incomplete Download for {url} => {filename_save}")
+        return None
+
+    elif config.verifyImage and filename_save.endswith((".jpg", ".png", ".gif")) and is_exists:
+        fp = None
+        try:
+            from PIL import Image, ImageFile
+            fp = open(filename_save, "rb")
+            # Fix Issue #269, refer to https://stackoverflow.com/a/42682508
+            ImageFile.LOAD_TRUNCATED_IMAGES = True
+            img = Image.open(fp)
+            img.load()
+            fp.close()
+            PixivHelper.print_and_log('info', ' Image verified.')
+        except BaseException:
+            if fp is not None:
+                fp.close()
+            PixivHelper.print_and_log('info', ' Image invalid, deleting...')
+            os.remove(filename_save)
+            PixivFileIndex.invalidate(filename_save)
+            raise
+    elif config.verifyImage and filename_save.endswith((".ugoira", ".zip")):
+        fp = None
+        try:
+            import zipfile
+            fp = open(filename_save, "rb")
+            zf = zipfile.ZipFile(fp)
+            check_result = None
+            try:
+                check_result = zf.testzip()
+            # Issue #1165
+            except NotImplementedError as ne:
+                PixivHelper.print_and_log('warn', f' {ne}')
+            except RuntimeError as e:
+                if 'encrypted' in str(e):
+                    PixivHelper.print_and_log('info', ' archive is encrypted, cannot verify.')
+                else:
+                    raise
+            fp.close()
+            if check_result is None:
+                PixivHelper.print_and_log('info', ' Image verified.')
+            else:
+                PixivHelper.print_and_log('info', f' Corrupted file in archive: {check_result}.')
+                raise PixivException(f"Incomplete Downloaded for {url}", PixivException.DOWNLOAD_FAILED_OTHER)
+        except BaseException:
+            if fp is not None:
+                fp.close()
+            PixivHelper.print_and_log('info', ' Image invalid, deleting...')
+            os.remove(filename_save)
+            PixivFileIndex.invalidate(filename_save)
+            raise
+    PixivHelper.print_and_log('info', f' Download done ==> {filename_save}')
+
+    # codecs.open is stateless, so if platform_encoding == utf-8-sig each new line starts from utf-8-sig
+    # this is bad and I feel bad
+
+    if os.path.isfile(caller.dfilename):
+        dfile_encoding = 'utf-8'
+    else:
+        dfile_encoding = caller.platform_encoding
+
+    # write to downloaded lists
+    if caller.start_iv or config.createDownloadLists:
+        dfile = codecs.open(caller.dfilename, 'a+', encoding=dfile_encoding)
+        dfile.write(filename_save + "\n")
+        dfile.close()
+
+    # Issue #970
+    if config.enablePostProcessing and len(config.postProcessingCmd) > 0:
+        cmd = config.postProcessingCmd.replace("%filename%", filename_save)
+        PixivHelper.print_and_log('info', f'Running post processing command: {cmd}')
+        subprocess.Popen(shlex.split(cmd), startupinfo=None)
+
+    return (PixivConstant.PIXIVUTIL_OK, filename_save)
+
+
 def perform_download(url, file_size, filename, overwrite, config, referer=None, notifier=None):
     if notifier is None:
         notifier = PixivHelper.dummy_notifier
@@ -336,46 +389,72 @@ def perform_download(url, file_size, filename, overwrite, config, referer=None,
         referer = config.referer
     # actual download
     # PixivHelper.print_and_log(None, '\rStart downloading...', newline=False)
-    # fetch filesize
-    req = PixivHelper.create_custom_request(url, config, referer)
-    br = PixivBrowserFactory.getBrowser(config=config)
-    res = br.open_novisit(req)
-    if file_size < 0:  # final check before download for download progress bar.
+    PixivHelper.get_logger().info(f"Using Referer: {referer}")
+    headers = {'Referer': referer}
+    resume = PixivHelper.get_resume_info(url, filename)
+    if resume is not None:
+        PixivHelper.print_and_log('info', f"Resuming download from {PixivHelper.size_in_str(resume['offset'])}")
+        headers.update(PixivHelper.get_resume_headers(resume))
+
+    session = PixivBrowserFactory.getDownloadSession(config)
+    with PixivBrowserFactory.request_slot(url):
+        res = session.get(url, headers=headers, stream=True, timeout=config.timeout)
         try:
-            content_length = res.info()['Content-Length']
-            if content_length is not None:
-                file_size = int(content_length)
-        except KeyError:
-            file_size = -1
-            PixivHelper.print_and_log('info', "\tNo file size information!")
-    (downloadedSize, filename) = PixivHelper.download_image(url, filename, res, file_size, overwrite)
-    res.close()
+            offset = PixivHelper.get_resume_offset(url, filename, resume, res.status_code, res.headers)
+            check_response(url, res)
+            if offset > 0:
+                file_size = resume['content_length']
+            elif file_size < 0:  # final check before download for download progress bar.
+                content_length = res.headers.get('Content-Length')
+                if content_length is not None:
+                    file_size = int(content_length)
+                else:
+                    PixivHelper.print_and_log('info', "\tNo file size information!")
+            # the connection goes back to the pool once the body is fully read
+            limiter = PixivRateLimiter.get_bandwidth_limiter(config, url)
+            (downloadedSize, filename) = PixivHelper.download_image(url, filename, res.raw, file_size, overwrite, offset, res.headers, limiter)
+        finally:
+            res.close()
     gc.collect()
-    return (downloadedSize, filename)
+    return (downloadedSize, filename, res.headers)
 
 
 # issue #299
 def get_remote_filesize(url, referer, config, notifier=None):
+    return get_remote_file_info(url, referer, config, notifier=notifier)[0]
+
+
+def get_remote_file_info(url, referer, config, etag=None, last_modified=None, notifier=None):
+    '''Get the remote file size and validators using HEAD request, conditional if etag/last_modified is given.
+    Return (file_size, etag, last_modified, not_modified).'''
     if notifier is None:
         notifier = PixivHelper.dummy_notifier
 
     PixivHelper.print_and_log(None, 'Getting remote filesize...', newline=False)
     # open with HEAD method, might be expensive
-    req = PixivHelper.create_custom_request(url, config, referer, head=True)
     file_size = -1
+    headers = {'Referer': referer}
+    if etag is not None:
+        headers['If-None-Match'] = etag
+    if last_modified is not None:
+        headers['If-Modified-Since'] = last_modified
 
     try:
-        br = PixivBrowserFactory.getBrowser(config=config)
-        res = br.open_novisit(req)
-        content_length = res.info()['Content-Length']
+        session = PixivBrowserFactory.getDownloadSession(config)
+        with PixivBrowserFactory.request_slot(url):
+            res = session.head(url, headers=headers, timeout=config.timeout, allow_redirects=True)
+            check_response(url, res)
+        if res.status_code == 304:
+            PixivHelper.print_and_log(None, "\rRemote file is not modified.")
+            return (-1, etag, last_modified, True)
+        content_length = res.headers.get('Content-Length')
         if content_length is not None:
             file_size = int(content_length)
         else:
             PixivHelper.print_and_log('info', "\rNo file size information!")
-        res.close()
-    except KeyError:
-        PixivHelper.print_and_log('info', "\rNo file size information!")
-    except mechanize.HTTPError as e:
+        etag = res.headers.get('ETag')
+        last_modified = res.headers.get('Last-Modified')
+    except urllib.error.HTTPError as e:
         # fix Issue #503
         # handle http errors explicit by code
         if int(e.code) in (404, 500):
@@ -384,9 +463,65 @@ def get_remote_filesize(url, referer, config, notifier=None):
             raise
 
     PixivHelper.print_and_log(None, f"\rRemote filesize = {PixivHelper.size_in_str(file_size)} ({file_size} Bytes)")
+    return (file_size, etag, last_modified, False)
+
+
+def get_known_remote_filesize(caller, config, url, referer, image=None, page=None, download_from=PixivConstant.DOWNLOAD_PIXIV, notifier=None):
+    '''Return the remote file size saved in the DB if the work is not updated since it was checked,
+    otherwise get it using (conditional) HEAD request and save it.'''
+    db: PixivDBManager = caller.__dbManager__
+    info = None
+    if image is not None:
+        info = db.selectRemoteFileInfo(download_from, image.imageId, page)
+    if info is None or info[0] is None or info[0] <= 0:
+        (file_size, etag, last_modified, _) = get_remote_file_info(url, referer, config, notifier=notifier)
+        if image is not None and file_size > 0:
+            db.updateRemoteFileInfo(download_from, image.imageId, page, file_size, etag, last_modified)
+        return file_size
+
+    (remote_size, etag, last_modified, checked_date) = info
+    if not is_work_updated(image, checked_date):
+        PixivHelper.print_and_log(None, f"\rRemote filesize = {PixivHelper.size_in_str(remote_size)} ({remote_size} Bytes) from DB")
+        PixivStatistics.increment("Skipped HEAD requests")
+        return remote_size
+
+    (file_size, new_etag, new_last_modified, not_modified) = get_remote_file_info(url, referer, config, etag, last_modified, notifier)
+    if not_modified:
+        (file_size, new_etag, new_last_modified) = (remote_size, etag, last_modified)
+    if file_size > 0:
+        db.updateRemoteFileInfo(download_from, image.imageId, page, file_size, new_etag, new_last_modified)
     return file_size
 
 
+def is_work_updated(image, checked_date):
+    '''Return True if the work is updated after checked_date (UTC, from sqlite datetime('now')).'''
+    updated_date = getattr(image, "uploadDateDateTime", None) or getattr(image, "updatedDateDatetime", None)
+    if updated_date is None or checked_date is None:
+        return False
+    try:
+        checked_date = datetime.strptime(checked_date, "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc)
+    except ValueError:
+        return True
+    if updated_date.tzinfo is None:
+        updated_date = updated_date.replace(tzinfo=timezone.utc)
+    return updated_date > checked_date
+
+
+def save_remote_file_info(caller, image, page, download_from, file_size, headers):
+    '''Save the size and validators of the downloaded file, so the next run does not need HEAD request.'''
+    if image is None or headers is None or file_size <= 0:
+        return
+    db: PixivDBManager = caller.__dbManager__
+    db.updateRemoteFileInfo(download_from, image.imageId, page, file_size, headers.get('ETag'), headers.get('Last-Modified'))
+
+
+def check_response(url, res):
+    '''Raise HTTPError for error status code, same as the mechanize browser.'''
+    if res.status_code >= 400:
+        res.close()
+        raise urllib.error.HTTPError(url, res.status_code, res.reason, res.headers, None)
+
+
 def handle_ugoira(image, zip_filename, config, notifier):
     if image and not hasattr(image, 'create_ugoira'): # for fanbox zips that can't resolve remote file size
         return
@@ -399,63 +534,72 @@ def handle_ugoira(image, zip_filename, config, notifier):
     else:
         ugo_name = zip_filename
 
-    if not os.path.exists(ugo_name):
+    if not PixivFileIndex.exists(ugo_name):
         PixivHelper.print_and_log('info', f"Creating ugoira archive => {ugo_name}")
         image.create_ugoira(zip_filename)
         # set last-modified and last-accessed timestamp
         if config.setLastModified and ugo_name is not None and os.path.isfile(ugo_name):
             ts = time.mktime(image.worksDateDateTime.timetuple())
             os.utime(ugo_name, (ts, ts))
+        PixivFileIndex.invalidate(ugo_name)
 
     if config.createGif:
         gif_filename = ugo_name[:-7] + ".gif"
-        if not os.path.exists(gif_filename):
+        if not PixivFileIndex.exists(gif_filename):
             PixivHelper.ugoira2gif(ugo_name,
                                    gif_filename,
                                    image=image)
+            PixivFileIndex.invalidate(gif_filename)
 
     if config.createApng:
         apng_filename = ugo_name[:-7] + ".png"
-        if not os.path.exists(apng_filename):
+        if not PixivFileIndex.exists(apng_filename):
             PixivHelper.ugoira2apng(ugo_name,
                                     apng_filename,
                                     image=image)
+            PixivFileIndex.invalidate(apng_filename)
 
     if config.createAvif:
         avif_filename = ugo_name[:-7] + ".avif"
-        if not os.path.exists(avif_filename):
+        if not PixivFileIndex.exists(avif_filename):
             PixivHelper.ugoira2avif(ugo_name,
                                     avif_filename,
                                     image=image)
+            PixivFileIndex.invalidate(avif_filename)
 
     if config.createWebm:
         webm_filename = ugo_name[:-7] + "." + config.ffmpegExt
-        if not os.path.exists(webm_filename):
+        if not PixivFileIndex.exists(webm_filename):
             PixivHelper.ugoira2webm(ugo_name,
                                     webm_filename,
                                     codec=config.ffmpegCodec,
                                     extension=config.ffmpegExt,
                                     image=image)
+            PixivFileIndex.invalidate(webm_filename)
 
     if config.createWebp:
         webp_filename = ugo_name[:-7] + ".webp"
-        if not os.path.exists(webp_filename):
+        if not PixivFileIndex.exists(webp_filename):
             PixivHelper.ugoira2webp(ugo_name,
                                     webp_filename,
                                     image=image)
+            PixivFileIndex.invalidate(webp_filename)
 
     if config.createMkv:
         mkv_filename = ugo_name[:-7] + ".mkv"
-        if not os.path.exists(mkv_filename):
+        if not PixivFileIndex.exists(mkv_filename):
             PixivHelper.ugoira2mkv(ugo_name,
                                    mkv_filename,
                                    codec=config.mkvCodec,
                                    image=image)
+            PixivFileIndex.invalidate(mkv_filename)
 
-    if config.deleteZipFile and os.path.exists(zip_filename) and zip_filename.endswith(".zip"):
+    if config.deleteZipFile and PixivFileIndex.exists(zip_filename) and zip_filename.endswith(".zip"):
         PixivHelper.print_and_log('info', f"Deleting zip file => {zip_filename}")
         os.remove(zip_filename)
+        PixivFileIndex.invalidate(zip_filename)
 
-    if config.deleteUgoira and os.path.exists(ugo_name) and ugo_name.endswith(".ugoira"):
+    if config.deleteUgoira and PixivFileIndex.exists(ugo_name) and ugo_name.endswith(".ugoira"):
         PixivHelper.print_and_log('info', f"Deleting ugoira file => {ugo_name}")
         os.remove(ugo_name)
+        PixivFileIndex.invalidate(ugo_name)
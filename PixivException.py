@@ -29,6 +29,7 @@ class PixivException(BaseException):
     DOWNLOAD_FAILED_IO = 9001
     DOWNLOAD_FAILED_NETWORK = 9002
     SERVER_ERROR = 9005
+    CIRCUIT_OPEN = 9006
 
     MISSING_CONFIG = 9901
     OTHER_ERROR = 9999
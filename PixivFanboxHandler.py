@@ -7,6 +7,7 @@ import PixivConstant
 import PixivDownloadHandler
 import PixivHelper
 import PixivModelFanbox
+import PixivRateLimiter
 from PixivException import PixivException
 import PixivArtistHandler
 
@@ -70,7 +71,7 @@ def process_fanbox_artist_by_id(caller, config, artist_id, end_page, title_prefi
             else:
                 PixivHelper.print_and_log("info", f"Unsupported post type: {post.imageId} => {post.type}")
             image_count += 1
-            PixivHelper.wait(config=config)
+            PixivHelper.wait(config=config, host_classes=(PixivRateLimiter.HOST_FANBOX, PixivRateLimiter.HOST_PXIMG))
 
         if not artist.hasNextPage:
             PixivHelper.print_and_log("info", "No more post for {0}".format(artist))
@@ -233,6 +234,7 @@ def process_fanbox_post(caller, config, post: PixivModelFanbox.FanboxPost, artis
     finally:
         if len(post_files) > 0:
             db.insertPostImages(post_files)
+        db.discardPendingRemoteFileInfo(PixivConstant.DOWNLOAD_FANBOX, post.imageId)
 
     db.updatePostUpdateDate(post.imageId, post.updatedDate)
 
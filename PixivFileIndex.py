@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+# pylint: disable=W0603
+import errno
+import os
+import stat
+import threading
+from collections import OrderedDict
+
+# number of directory listings kept in memory, the least recently used is dropped first
+MAX_DIRECTORIES = 256
+
+_listings = OrderedDict()
+_lock = threading.Lock()
+
+
+class _StatEntry(object):
+    '''DirEntry-like entry from os.stat(), for a name written after its directory was listed.'''
+
+    __slots__ = ("_stat", )
+
+    def __init__(self, stat_result):
+        self._stat = stat_result
+
+    def stat(self):
+        return self._stat
+
+    def is_file(self):
+        return stat.S_ISREG(self._stat.st_mode)
+
+    def is_symlink(self):
+        return False
+
+
+class DirectoryListing(object):
+    '''Entries of one directory from a single os.scandir(), stat'ed on demand.
+    A name invalidated by our own write is stat'ed again on its next lookup.'''
+
+    def __init__(self, path):
+        self.path = path
+        self._entries = None  # normcase(name) -> DirEntry, _StatEntry or None if the name changed
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        '''Return the DirEntry-like entry of name, or None if it does not exist.'''
+        key = os.path.normcase(name)
+        with self._lock:
+            if self._entries is None:
+                self._entries = _scan(self.path)
+            if key not in self._entries:
+                return None
+            entry = self._entries[key]
+            if entry is None:
+                try:
+                    entry = _StatEntry(os.stat(os.path.join(self.path, name)))
+                    self._entries[key] = entry
+                except OSError:
+                    del self._entries[key]
+            return entry
+
+    def invalidate(self, name):
+        with self._lock:
+            if self._entries is not None:
+                self._entries[os.path.normcase(name)] = None
+
+
+def _scan(path):
+    entries = dict()
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                entries[os.path.normcase(entry.name)] = entry
+    except (FileNotFoundError, NotADirectoryError):
+        pass
+    return entries
+
+
+def _get_entry(path):
+    '''Return (True, entry) from the directory listing, or (False, None) if path cannot be indexed.'''
+    if isinstance(path, bytes) or len(path) == 0:
+        return (False, None)
+    (directory, name) = os.path.split(os.path.abspath(path))
+    if len(name) == 0:
+        return (False, None)
+    key = os.path.normcase(directory)
+    with _lock:
+        listing = _listings.get(key)
+        if listing is None:
+            listing = DirectoryListing(directory)
+            _listings[key] = listing
+            if len(_listings) > MAX_DIRECTORIES:
+                _listings.popitem(last=False)
+        else:
+            _listings.move_to_end(key)
+    try:
+        return (True, listing.get(name))
+    except OSError:
+        # e.g. permission denied on the directory, check the file itself.
+        return (False, None)
+
+
+def exists(path):
+    '''Same as os.path.exists(), answered from the listing of the parent directory.'''
+    (indexed, entry) = _get_entry(path)
+    if not indexed or (entry is not None and entry.is_symlink()):
+        return os.path.exists(path)
+    return entry is not None
+
+
+def isfile(path):
+    '''Same as os.path.isfile().'''
+    (indexed, entry) = _get_entry(path)
+    if not indexed:
+        return os.path.isfile(path)
+    try:
+        return entry is not None and entry.is_file()
+    except OSError:
+        return False
+
+
+def _stat(path):
+    (indexed, entry) = _get_entry(path)
+    if not indexed:
+        return os.stat(path)
+    if entry is None:
+        raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+    return entry.stat()
+
+
+def getsize(path):
+    '''Same as os.path.getsize().'''
+    return _stat(path).st_size
+
+
+def getmtime(path):
+    '''Same as os.path.getmtime().'''
+    return _stat(path).st_mtime
+
+
+def invalidate(path):
+    '''Forget the cached state of path after we created, modified, renamed or deleted it.'''
+    if isinstance(path, bytes) or len(path) == 0:
+        return
+    path = os.path.abspath(path)
+    (directory, name) = os.path.split(path)
+    with _lock:
+        listing = _listings.get(os.path.normcase(directory))
+        # the listing of path itself, if it was a directory.
+        _listings.pop(os.path.normcase(path), None)
+    if listing is not None:
+        listing.invalidate(name)
+
+
+def makedirs(directory):
+    '''os.makedirs(), the created directories are added to the index.'''
+    created = list()
+    path = os.path.abspath(directory)
+    while not exists(path):
+        created.append(path)
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    os.makedirs(directory, exist_ok=True)
+    for path in created:
+        invalidate(path)
+
+
+def clear():
+    '''Drop all the listings, so the changes made by other programs are seen.'''
+    with _lock:
+        _listings.clear()
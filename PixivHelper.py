@@ -3,6 +3,7 @@
 
 import codecs
 import html
+import io
 import json
 import logging
 import logging.handlers
@@ -15,6 +16,7 @@ import shutil
 import subprocess
 import sys
 import tempfile
+import threading
 import time
 import traceback
 import unicodedata
@@ -22,18 +24,21 @@ import urllib
 import urllib.parse
 import webbrowser
 import zipfile
+from contextlib import contextmanager
 from datetime import date, datetime, timedelta, tzinfo
 from hashlib import md5, sha1, sha256
 from mmap import ACCESS_READ, mmap
 from pathlib import Path
 from typing import Union
 
-import mechanize
 from colorama import Fore, Style
 from PIL import Image, ImageFile
 
 import PixivArtist
 import PixivConstant
+import PixivFileIndex
+import PixivProgress
+import PixivRateLimiter
 from PixivException import PixivException
 from PixivImage import PixivImage
 from PixivModelFanbox import FanboxArtist, FanboxPost
@@ -402,6 +407,91 @@ def safePrint(msg, newline=True, end=None):
         print("")
 
 
+class BufferedConsole(object):
+    '''Wrapper for sys.stdout, the output of a thread inside capture() is kept
+    and written in one block when it is done or at flush_captured(), so parallel jobs do not interleave.'''
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def write(self, text):
+        buffer = getattr(self._local, "buffer", None)
+        if buffer is not None:
+            return buffer.write(text)
+        with self._lock:
+            return self._stream.write(text)
+
+    def flush(self):
+        if getattr(self._local, "buffer", None) is None:
+            self._stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+    def current_buffer(self):
+        return getattr(self._local, "buffer", None)
+
+    @contextmanager
+    def attach(self, buffer):
+        '''Write the output of this thread to the buffer of another thread, e.g. nested worker threads.'''
+        self._local.buffer = buffer
+        try:
+            yield
+        finally:
+            self._local.buffer = None
+
+    @contextmanager
+    def capture(self):
+        self._local.buffer = io.StringIO()
+        try:
+            yield
+        finally:
+            text = self._local.buffer.getvalue()
+            self._local.buffer = None
+            self._write_block(text)
+
+    def flush_captured(self):
+        '''Write the output captured so far by this thread, e.g. after each post of a long member.'''
+        buffer = getattr(self._local, "buffer", None)
+        if buffer is None:
+            return
+        text = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        self._write_block(text)
+
+    def _write_block(self, text):
+        if len(text) == 0:
+            return
+        # progress bar redraws are collapsed to their last state
+        lines = [next((x for x in reversed(line.split('\r')) if x.strip()), '') for line in text.split('\n')]
+        with self._lock:
+            self._stream.write('\n'.join(lines))
+            self._stream.flush()
+
+
+def flush_captured_output():
+    '''Show the output of the current job so far when running in parallel, see BufferedConsole.'''
+    if isinstance(sys.stdout, BufferedConsole):
+        sys.stdout.flush_captured()
+
+
+@contextmanager
+def buffered_console():
+    '''Install BufferedConsole as sys.stdout for the duration of the block.'''
+    if isinstance(sys.stdout, BufferedConsole):
+        yield sys.stdout
+        return
+    original = sys.stdout
+    sys.stdout = BufferedConsole(original)
+    try:
+        yield sys.stdout
+    finally:
+        sys.stdout = original
+
+
 def set_console_title(title):
     try:
         if platform.system() == "Windows":
@@ -735,9 +825,11 @@ def check_file_exists(config, filename, file_size, old_size):
                 new_name = split_name[0] + "." + str(int(time.time())) + "." + split_name[1]
             print_and_log('warn', f"\t Found file with different file size ==> {filename}, backing up to: {new_name}.")
             os.rename(filename, new_name)
+            PixivFileIndex.invalidate(new_name)
         else:
             print_and_log('warn', f"\tFound file with different file size ==> {filename}, removing old file (old: {old_size} vs new: {file_size})")
             os.remove(filename)
+        PixivFileIndex.invalidate(filename)
         return PixivConstant.PIXIVUTIL_OK
 
 
@@ -749,80 +841,66 @@ def print_delay(retry_wait):
     print_and_log(None, "")
 
 
-def create_custom_request(url, config, referer='https://www.pixiv.net', head=False):
-    if config.useProxy:
-        proxy = urllib.request.ProxyHandler(config.proxy)
-        opener = urllib.request.build_opener(proxy)
-        urllib.request.install_opener(opener)
-    req = mechanize.Request(url)
-    req.add_header('Referer', referer)
-    # print_and_log('info', u"Using Referer: " + str(referer))
-    get_logger().info(f"Using Referer: {referer}")
-
-    if head:
-        req.get_method = lambda: 'HEAD'
-    else:
-        req.get_method = lambda: 'GET'
-
-    return req
-
-
 def makeSubdirs(filename):
     directory = os.path.dirname(filename)
-    if not os.path.exists(directory) and len(directory) > 0:
+    if len(directory) > 0 and not PixivFileIndex.exists(directory):
         print_and_log('info', u'Creating directory: ' + directory)
-        os.makedirs(directory)
+        PixivFileIndex.makedirs(directory)
 
 
-def download_image(url, filename, res, file_size, overwrite):
-    ''' Actual download, return the downloaded filesize and saved filename.'''
+def download_image(url, filename, res, file_size, overwrite, offset=0, headers=None, limiter=None):
+    ''' Actual download, return the downloaded filesize and saved filename.
+    offset is the size of the partial .pixiv file being resumed, headers are the response headers to save for resuming.
+    limiter is the PixivRateLimiter.BandwidthLimiter throttling the reads.'''
     start_time = datetime.now()
     global _config
     BUFFER_SIZE = _config.downloadBuffer * 1024
 
-    # try to save to the given filename + .pixiv extension if possible
-    try:
-        makeSubdirs(filename)
-        save = open(filename + '.pixiv', 'wb+', 4096)
-    except IOError as ex:
-        print_and_log('error', f"Error at download_image(): Cannot save {url} to {filename}: {sys.exc_info()}", exception=ex)
-        input("Press enter to continue or Ctrl+C to abort.")  # Issue #1187
-
-        # get the actual server filename and use it as the filename for saving to current app dir
-        filename = os.path.split(url)[1]
-        filename = filename.split("?")[0]
-        filename = sanitize_filename(filename)
-        save = open(filename + '.pixiv', 'wb+', 4096)
-        print_and_log('info', f'File is saved to {filename}')
-
-    # download the file
-    prev = 0
-    curr = 0
-    msg_len = 0
+    (save, filename) = open_download_file(url, filename, offset)
+    resumable = headers is not None and save_resume_info(url, filename, headers, file_size)
+    preallocated = not resumable and preallocate_download_file(save, offset, file_size)
+
+    # download the file, reusing the same buffer for each chunk
+    if limiter is not None:
+        BUFFER_SIZE = min(BUFFER_SIZE, limiter.chunk_size)
+    buffer = memoryview(bytearray(BUFFER_SIZE))
+    readinto = getattr(res, "readinto", None)
+    curr = offset
+    # the progress is drawn by the renderer thread from the transfer counters
+    transfer = PixivProgress.start(os.path.basename(filename), file_size, offset)
     try:
         while True:
-            save.write(res.read(BUFFER_SIZE))
-            curr = save.tell()
-            msg_len = print_progress(curr, file_size, msg_len)
+            if readinto is not None:
+                size = readinto(buffer)
+                if size > 0:
+                    save.write(buffer[:size])
+            else:
+                chunk = res.read(BUFFER_SIZE)
+                size = len(chunk)
+                save.write(chunk)
+            curr = curr + size
+            transfer.update(curr)
+            if limiter is not None:
+                limiter.consume(size)
 
             # check if downloaded file is complete
             if file_size > 0 and curr == file_size:
+                transfer.finish()
                 total_time = (datetime.now() - start_time).total_seconds()
-                print_and_log(None, f' Completed in {Fore.CYAN}{total_time}{Style.RESET_ALL}s ({Fore.RED}{speed_in_str(file_size, total_time)}{Style.RESET_ALL})')
+                print_and_log(None, f' Completed in {Fore.CYAN}{total_time}{Style.RESET_ALL}s ({Fore.RED}{speed_in_str(file_size - offset, total_time)}{Style.RESET_ALL})')
                 break
 
             # no file size info
-            elif file_size < 0 and curr == prev:
+            elif file_size < 0 and size == 0:
+                transfer.finish()
                 total_time = (datetime.now() - start_time).total_seconds()
-                print_and_log(None, f' Completed in {Fore.CYAN}{total_time}{Style.RESET_ALL}s ({Fore.RED}{speed_in_str(curr, total_time)}{Style.RESET_ALL})')
+                print_and_log(None, f' Completed in {Fore.CYAN}{total_time}{Style.RESET_ALL}s ({Fore.RED}{speed_in_str(curr - offset, total_time)}{Style.RESET_ALL})')
                 break
 
             # incomplete download
-            elif file_size >= 0 and curr == prev:
+            elif file_size >= 0 and size == 0:
                 raise PixivException(f"Download incomplete for: {url}", errorCode=PixivException.DOWNLOAD_FAILED_OTHER)
 
-            prev = curr
-
     except ConnectionResetError as ex:
         print_and_log('error', f"ConnectionResetError at download_image(): Cannot save {url} to {filename}: {sys.exc_info()}", exception=ex)
         raise
@@ -833,36 +911,164 @@ def download_image(url, filename, res, file_size, overwrite):
         raise
 
     finally:
+        transfer.finish()
         if save is not None:
+            if preallocated and curr < file_size:
+                # drop the unused preallocated space, so a partial file can be resumed from its size
+                save.truncate(curr)
             save.close()
+        complete_download(url, filename, curr, file_size, overwrite)
+        del save
+
+    return (curr, filename)
+
 
-        completed = True
-        if file_size > 0 and curr < file_size:
-            # File size is known and downloaded file is smaller
-            print_and_log('error', f'Downloaded file incomplete! {curr:9} of {file_size:9} Bytes')
-            print_and_log('error', f'Filename = {filename}')
-            print_and_log('error', f'URL      = {url}')
-            completed = False
-        elif curr == 0:
-            # No data received.
-            print_and_log('error', 'No data received!')
-            print_and_log('error', f'Filename = {filename}')
-            print_and_log('error', f'URL      = {url}')
-            completed = False
-
-        if completed:
-            if overwrite and os.path.exists(filename):
-                os.remove(filename)
-            os.rename(filename + '.pixiv', filename)
+def preallocate_download_file(save, offset, file_size):
+    '''Reserve the disk space for the remaining part of the download when the size is known.
+    Return True if the file was extended, the caller must truncate it if the download is incomplete.
+    Not used for a resumable download: after a crash the file would be full size, and could not be resumed from its size.'''
+    if file_size <= offset:
+        return False
+    try:
+        save.flush()
+        if hasattr(os, "posix_fallocate"):
+            os.posix_fallocate(save.fileno(), offset, file_size - offset)
         else:
-            os.remove(filename + '.pixiv')
+            save.truncate(file_size)
+    except OSError as ex:
+        get_logger().debug(f"Cannot preallocate {file_size} bytes: {ex}")
+        return False
+    return True
 
-        del save
 
-    return (curr, filename)
+def open_download_file(url, filename, offset=0):
+    '''Open the temporary .pixiv file for writing, return the file and the actual filename.
+    If offset is given, the existing .pixiv file is opened for appending from that offset.'''
+    buffer_size = _config.downloadBuffer * 1024 if _config is not None else io.DEFAULT_BUFFER_SIZE
+    # try to save to the given filename + .pixiv extension if possible
+    try:
+        makeSubdirs(filename)
+        if offset > 0:
+            save = open(filename + '.pixiv', 'r+b', buffer_size)
+            save.seek(offset)
+            save.truncate()
+        else:
+            save = open(filename + '.pixiv', 'wb+', buffer_size)
+    except IOError as ex:
+        print_and_log('error', f"Error at download_image(): Cannot save {url} to {filename}: {sys.exc_info()}", exception=ex)
+        if offset > 0:
+            # the response only contains the remaining part
+            discard_partial_download(filename)
+            raise
+        input("Press enter to continue or Ctrl+C to abort.")  # Issue #1187
+
+        # get the actual server filename and use it as the filename for saving to current app dir
+        filename = os.path.split(url)[1]
+        filename = filename.split("?")[0]
+        filename = sanitize_filename(filename)
+        save = open(filename + '.pixiv', 'wb+', buffer_size)
+        print_and_log('info', f'File is saved to {filename}')
+    return (save, filename)
+
+
+def complete_download(url, filename, curr, file_size, overwrite):
+    '''Rename the temporary .pixiv file to the filename if the download is complete,
+    otherwise keep it for resuming if possible or delete it.'''
+    completed = True
+    if file_size > 0 and curr < file_size:
+        # File size is known and downloaded file is smaller
+        print_and_log('error', f'Downloaded file incomplete! {curr:9} of {file_size:9} Bytes')
+        print_and_log('error', f'Filename = {filename}')
+        print_and_log('error', f'URL      = {url}')
+        completed = False
+    elif curr == 0:
+        # No data received.
+        print_and_log('error', 'No data received!')
+        print_and_log('error', f'Filename = {filename}')
+        print_and_log('error', f'URL      = {url}')
+        completed = False
+
+    if completed:
+        if overwrite and os.path.exists(filename):
+            os.remove(filename)
+        os.rename(filename + '.pixiv', filename)
+        PixivFileIndex.invalidate(filename)
+        if os.path.exists(filename + '.pixiv.resume'):
+            os.remove(filename + '.pixiv.resume')
+    elif curr > 0 and os.path.exists(filename + '.pixiv.resume'):
+        print_and_log('info', f'Partial file kept for resuming: {filename}.pixiv')
+    else:
+        discard_partial_download(filename)
+    return completed
+
+
+def save_resume_info(url, filename, headers, file_size):
+    '''Save the validators of the response next to the .pixiv file if the server support Range request.
+    Return True if the download can be resumed.'''
+    etag = headers.get('ETag')
+    last_modified = headers.get('Last-Modified')
+    accept_ranges = headers.get('Accept-Ranges', '').lower() == 'bytes' or 'Content-Range' in headers
+    if not accept_ranges or file_size <= 0 or (etag is None and last_modified is None):
+        if os.path.exists(filename + '.pixiv.resume'):
+            os.remove(filename + '.pixiv.resume')
+        return False
+    info = {'url': url, 'etag': etag, 'last_modified': last_modified, 'content_length': file_size}
+    with open(filename + '.pixiv.resume', 'w', encoding='utf-8') as resume_file:
+        json.dump(info, resume_file)
+    return True
 
 
-def print_progress(curr, total, max_msg_length=80):
+def get_resume_info(url, filename):
+    '''Return the saved validators and the current size (offset) of the partial .pixiv file, or None if it cannot be resumed.'''
+    try:
+        with open(filename + '.pixiv.resume', 'r', encoding='utf-8') as resume_file:
+            info = json.load(resume_file)
+        info['offset'] = os.path.getsize(filename + '.pixiv')
+    except (OSError, ValueError):
+        return None
+    if info.get('url') != url or not 0 < info['offset'] < info.get('content_length', 0):
+        discard_partial_download(filename)
+        return None
+    return info
+
+
+def get_resume_headers(info):
+    '''Range request headers to resume the download, the server send the full content if the file has changed.'''
+    return {'Range': f"bytes={info['offset']}-",
+            'If-Range': info['etag'] or info['last_modified']}
+
+
+def get_resume_offset(url, filename, info, status, headers):
+    '''Return the offset to continue writing the response, 0 if the server send the full content.'''
+    if info is None:
+        return 0
+    if status == 416:
+        discard_partial_download(filename)
+        raise PixivException(f"Range not satisfiable, restarting download: {url}", errorCode=PixivException.DOWNLOAD_FAILED_OTHER)
+    if status != 206:
+        # range ignored or file has changed
+        print_and_log('info', 'Server sent the full content, restarting download.')
+        return 0
+
+    match = re.match(r"bytes (\d+)-\d+/(\d+)", headers.get('Content-Range', ''))
+    etag = headers.get('ETag')
+    if match is None \
+       or int(match.group(1)) != info['offset'] \
+       or int(match.group(2)) != info['content_length'] \
+       or (etag is not None and info['etag'] is not None and etag != info['etag']):
+        discard_partial_download(filename)
+        raise PixivException(f"Invalid Content-Range for resumed download: {headers.get('Content-Range')} at {url}",
+                             errorCode=PixivException.DOWNLOAD_FAILED_OTHER)
+    return info['offset']
+
+
+def discard_partial_download(filename):
+    for partial in (filename + '.pixiv', filename + '.pixiv.resume'):
+        if os.path.exists(partial):
+            os.remove(partial)
+
+
+def format_progress(curr, total):
     # [12345678901234567890]
     # [████████------------]
     # [━╸                  ]
@@ -890,10 +1096,7 @@ def print_progress(curr, total, max_msg_length=80):
         # also changes, thus producing the scrolling effect.
         msg = f'\r{Fore.YELLOW}[{anim[animBarLen + 3 - pos:]:.{animBarLen}}]{Style.RESET_ALL} {size_in_str(curr)}'
 
-    curr_msg_length = len(msg)
-    print_and_log(None, msg.ljust(max_msg_length, " "), newline=False)
-
-    return curr_msg_length if curr_msg_length > max_msg_length else max_msg_length
+    return msg
 
 
 def generate_search_tag_url(tags,
@@ -1141,6 +1344,7 @@ def convert_ugoira(ugoira_file, exportname, ffmpeg, codec, param, extension, ima
         if image is not None and _config.setLastModified and exportname is not None and os.path.isfile(exportname):
             ts = time.mktime(image.worksDateDateTime.timetuple())
             os.utime(exportname, (ts, ts))
+        PixivFileIndex.invalidate(exportname)
     except FileNotFoundError:
         print_and_log("error", f"Failed when converting, ffmpeg command used: {cmd}")
         raise
@@ -1409,9 +1613,16 @@ def get_start_and_end_number(start_only=False, total_number_of_page=None):
     return page_num, end_page_num
 
 
-def wait(result=None, config=None):
+def wait(result=None, config=None, host_classes=None):
+    '''Random delay of up to downloadDelay after a post.
+    host_classes are the PixivRateLimiter host classes used by the post, pixiv and pximg by default.'''
     if result == PixivConstant.PIXIVUTIL_SKIP_DUPLICATE_NO_WAIT:
         return
+    if host_classes is None:
+        host_classes = (PixivRateLimiter.HOST_PIXIV, PixivRateLimiter.HOST_PXIMG)
+    # the request rate is already controlled, or the download speed is limited, for all the hosts used
+    if all(PixivRateLimiter.is_host_limited(config, host_class) for host_class in host_classes):
+        return
     # Issue#276: add random delay for each post.
     if config is not None and config.downloadDelay > 0:
         delay = random.random() * config.downloadDelay
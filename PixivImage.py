@@ -66,6 +66,7 @@ class PixivImage (object):
     imageCount = 0
     fromBookmark = False
     worksDateDateTime = datetime.fromordinal(1)
+    uploadDateDateTime = None
     js_createDate = None
     bookmark_count = -1
     image_response_count = -1
@@ -225,6 +226,9 @@ class PixivImage (object):
         self.worksDateDateTime = datetime_z.parse_datetime(root["createDate"])
         assert (self.worksDateDateTime is not None)
         self.js_createDate = root["createDate"]  # store for json file
+        # "uploadDate" : "2018-06-08T15:00:04+00:00", updated when the images are replaced
+        if root.get("uploadDate") is not None:
+            self.uploadDateDateTime = datetime_z.parse_datetime(root["uploadDate"])
         # Issue #420
         if self._tzInfo is not None:
             self.worksDateDateTime = self.worksDateDateTime.astimezone(self._tzInfo)
@@ -5,23 +5,103 @@ import os
 import re
 import sys
 import shutil
+import threading
 import time
 import traceback
 import pathlib
+from concurrent.futures import ThreadPoolExecutor
 from urllib.error import URLError
 
 from colorama import Fore, Style
 
 import datetime_z
+import PixivAsyncDownloadHandler
 import PixivBrowserFactory
 import PixivConstant
 import PixivDownloadHandler
 import PixivHelper
+import PixivStatistics
 from PixivDBManager import PixivDBManager
 from PixivException import PixivException
 
 __re_manga_page = re.compile(r'(\d+(_big)?_p\d+)')
 
+# see get_page_executor()
+_page_executor = None
+_page_executor_size = 0
+_page_executor_lock = threading.Lock()
+
+
+class ImagePagePrefetcher(object):
+    '''Get the image info of the next image ids in background threads while the current image is processed,
+    at most depth image ids ahead, see prefetchImageInfo.'''
+
+    def __init__(self, caller, config, image_ids, artist=None, bookmark=False, bookmark_count=-1, depth=2):
+        self._caller = caller
+        self._config = config
+        self._image_ids = list(image_ids)
+        self._positions = dict((image_id, position) for (position, image_id) in enumerate(self._image_ids))
+        self._artist = artist
+        self._bookmark = bookmark
+        self._bookmark_count = bookmark_count
+        self._depth = depth
+        self._next = 0
+        self._futures = dict()
+        self._executor = None
+        if depth > 0:
+            self._executor = ThreadPoolExecutor(max_workers=depth, thread_name_prefix="prefetch")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def get(self, image_id):
+        '''Return the future of (image, response) for the image id or None if not prefetched,
+        and start getting the next image ids.'''
+        if self._executor is None or image_id not in self._positions:
+            return None
+        position = self._positions[image_id]
+        self._next = max(self._next, position)
+        while self._next < len(self._image_ids) and self._next <= position + self._depth:
+            next_id = self._image_ids[self._next]
+            self._next = self._next + 1
+            if next_id not in self._futures and self._need_image_page(next_id):
+                self._futures[next_id] = self._executor.submit(self._get_image_page, next_id)
+        return self._futures.pop(image_id, None)
+
+    def _need_image_page(self, image_id):
+        '''Same as process_image(), images already in the DB are skipped without getting the info.'''
+        if self._config.alwaysCheckFileSize or self._config.overwrite:
+            return True
+        return not self._caller.__dbManager__.isImageDownloaded(image_id)
+
+    def _get_image_page(self, image_id):
+        PixivStatistics.increment("Prefetched image info")
+        return PixivBrowserFactory.getBrowser().getImagePage(image_id=image_id,
+                                                              parent=self._artist,
+                                                              from_bookmark=self._bookmark,
+                                                              bookmark_count=self._bookmark_count)
+
+    def close(self):
+        '''Cancel the pending requests, e.g. when the member processing stopped early.'''
+        if self._executor is None:
+            return
+        for future in self._futures.values():
+            future.cancel()
+        self._futures.clear()
+        self._executor.shutdown(wait=False)
+        self._executor = None
+
+
+def get_downloaded_image_ids(caller, config, image_ids):
+    '''Return the image ids which process_image() would skip as already downloaded,
+    checked in bulk with the in-memory DB index so the handlers can skip them without processing.'''
+    if config.alwaysCheckFileSize or config.overwrite:
+        return set()
+    return caller.__dbManager__.selectDownloadedImageIds(image_ids)
+
 
 def process_image(caller,
                   config,
@@ -39,7 +119,8 @@ def process_image(caller,
                   manga_series_order=-1,
                   manga_series_parent=None,
                   ui_prefix="",
-                  is_unlisted=False) -> int:
+                  is_unlisted=False,
+                  prefetched=None) -> int:
     # caller function/method
     # TODO: ideally to be removed or passed as argument
     db: PixivDBManager = caller.__dbManager__
@@ -69,28 +150,36 @@ def process_image(caller,
         notifier(type="IMAGE", message=msg)
 
         # check if already downloaded. images won't be downloaded twice - needed in process_image to catch any download
-        r = db.selectImageByImageId(image_id, cols='save_name')
-        exists = False
-        in_db = False
-        if r is not None:
-            exists = db.cleanupFileExists(r[0])
-            in_db = True
+        # answered in memory, see isImageDownloaded()
+        in_db = db.isImageDownloaded(image_id)
 
         # skip if already recorded in db and alwaysCheckFileSize is disabled and overwrite is disabled.
         if in_db and not config.alwaysCheckFileSize and not config.overwrite and not reencoding:
             PixivHelper.print_and_log(None, f'Already downloaded in DB: {image_id}')
-            gc.collect()
             return PixivConstant.PIXIVUTIL_SKIP_DUPLICATE_NO_WAIT
 
+        # only query the saved file name of the images in db
+        exists = False
+        if in_db:
+            r = db.selectImageByImageId(image_id, cols='save_name')
+            if r is not None:
+                exists = db.cleanupFileExists(r[0])
+            else:
+                in_db = False
+
         # get the medium page
         try:
-            (image, parse_medium_page) = PixivBrowserFactory.getBrowser().getImagePage(image_id=image_id,
-                                                                                       parent=artist,
-                                                                                       from_bookmark=bookmark,
-                                                                                       bookmark_count=bookmark_count,
-                                                                                       manga_series_order=manga_series_order,
-                                                                                       manga_series_parent=manga_series_parent,
-                                                                                       is_unlisted=is_unlisted)
+            if prefetched is not None:
+                # already requested by ImagePagePrefetcher
+                (image, parse_medium_page) = prefetched.result()
+            else:
+                (image, parse_medium_page) = PixivBrowserFactory.getBrowser().getImagePage(image_id=image_id,
+                                                                                           parent=artist,
+                                                                                           from_bookmark=bookmark,
+                                                                                           bookmark_count=bookmark_count,
+                                                                                           manga_series_order=manga_series_order,
+                                                                                           manga_series_parent=manga_series_parent,
+                                                                                           is_unlisted=is_unlisted)
             if len(title_prefix) > 0:
                 caller.set_console_title(f"{title_prefix} ImageId: {image.imageId}")
             else:
@@ -237,7 +326,6 @@ def process_image(caller,
 
             result = PixivConstant.PIXIVUTIL_OK
             manga_files = list()
-            page = 0
 
             # Issue #639
             source_urls = image.imageUrls
@@ -248,11 +336,9 @@ def process_image(caller,
             if caller.DEBUG_SKIP_DOWNLOAD_IMAGE:
                 return PixivConstant.PIXIVUTIL_OK
 
-            current_img = 1
             total = len(source_urls)
-            for img in source_urls:
-                prefix = f"{Fore.CYAN}[{current_img}/{total}]{Style.RESET_ALL} "
-                PixivHelper.print_and_log(None, f'{prefix}Image URL : {img}')
+            pages = list()
+            for (page, img) in enumerate(source_urls):
                 url = os.path.basename(img)
                 # split_url = url.split('.')
                 # if split_url[0].startswith(str(image_id)):
@@ -279,32 +365,16 @@ def process_image(caller,
                         # filename = splitted_filename[0] + splitted_manga_page[0] + os.sep + "_p" + splitted_manga_page[1] + splitted_filename[1]
                         filename = f"{splitted_filename[0]}{splitted_manga_page[0]}{os.sep}_p{splitted_manga_page[1]}{splitted_filename[1]}"
 
-                PixivHelper.print_and_log('info', f'{prefix}Filename  : {filename}')
+                prefix = f"{Fore.CYAN}[{page + 1}/{total}]{Style.RESET_ALL} "
+                pages.append((page, img, filename, prefix))
 
-                result = PixivConstant.PIXIVUTIL_NOT_OK
-                try:
-                    (result, filename) = PixivDownloadHandler.download_image(caller,
-                                                                                img,
-                                                                                filename,
-                                                                                referer,
-                                                                                config.overwrite,
-                                                                                config.retry,
-                                                                                config.backupOldFile,
-                                                                                image,
-                                                                                page,
-                                                                                notifier)
-
-                    if result == PixivConstant.PIXIVUTIL_NOT_OK:
-                        PixivHelper.print_and_log('error', f'Image url not found/failed to download: {image.imageId}')
-                    elif result == PixivConstant.PIXIVUTIL_KEYBOARD_INTERRUPT:
-                        raise KeyboardInterrupt()
+            # pages can be downloaded in parallel, the results are returned in page order.
+            page_results = download_pages(caller, config, image, pages, referer, notifier)
 
+            for ((page, img, _, _), (result, filename, downloaded)) in zip(pages, page_results):
+                url = os.path.basename(img)
+                if downloaded:
                     manga_files.append((image_id, page, filename))
-                    page = page + 1
-
-                except URLError:
-                    PixivHelper.print_and_log('error', f'Error when download_image(), giving up url: {img}')
-                PixivHelper.print_and_log(None, '')
 
                 # XMP image info per images
                 if config.writeImageXMPPerImage:
@@ -364,7 +434,10 @@ def process_image(caller,
                                                                     tagTranslationLocale=config.tagTranslationLocale)
                         info_filename = PixivHelper.sanitize_filename(info_filename + ".xmp", target_dir)
                         image.WriteXMP(info_filename, config.useTranslatedTag, config.tagTranslationLocale)
-                current_img = current_img + 1
+
+            # a failed page fails the post, so it is not saved to DB as downloaded and retried next time.
+            if any(page_result == PixivConstant.PIXIVUTIL_NOT_OK for (page_result, _, _) in page_results):
+                result = PixivConstant.PIXIVUTIL_NOT_OK
 
             if config.writeImageInfo or config.writeImageJSON or config.writeImageXMP:
                 filename_info_format = config.filenameInfoFormat or config.filenameFormat
@@ -417,40 +490,45 @@ def process_image(caller,
                       PixivConstant.PIXIVUTIL_SKIP_DUPLICATE,
                       PixivConstant.PIXIVUTIL_SKIP_LOCAL_LARGER):
             caption = image.imageCaption if config.autoAddCaption else ""
-            try:
-                assert (image.artist is not None)
-                db.insertImage(image.artist.artistId, image.imageId, image.imageMode, caption=caption)
-            except BaseException:
-                PixivHelper.print_and_log('error', f'Failed to insert image id:{image.imageId} to DB')
-
-            db.updateImage(image.imageId, image.imageTitle, filename, image.imageMode)
-
-            if len(manga_files) > 0:
-                db.insertMangaImages(manga_files)
-
-            # Save tags if enabled
-            if config.autoAddTag:
-                tags = image.tags
-                if tags:
-                    for tag_data in tags:
-                        tag_id = tag_data.tag
-                        if tag_id:
-                            db.insertTag(tag_id)
-                            db.insertImageToTag(image_id, tag_id)
-                            if tag_data.romaji:
-                                db.insertTagTranslation(tag_id, 'romaji', tag_data.romaji)
-                            if tag_data.translation_data:
-                                for locale in tag_data.translation_data:
-                                    db.insertTagTranslation(tag_id, locale, tag_data.translation_data[locale])
-
-            # Save member data if enabled
-            if image.artist is not None and config.autoAddMember:
-                member_id = image.artist.artistId
-                member_token = image.artist.artistToken
-                member_name = image.artist.artistName
-                if member_id and member_token and member_name:
-                    db.insertNewMember(int(member_id), member_token=member_token)
-                    db.updateMemberName(member_id, member_name, member_token)
+            # commit all the writes of the post at once.
+            # the writes may be queued (see ConcurrentDBManager), so a failure is raised by the whole unit:
+            # insertImage ignores the existing row instead of failing on it.
+            with db.transaction():
+                if image.artist is not None:
+                    db.insertImage(image.artist.artistId, image.imageId, image.imageMode, caption=caption)
+                else:
+                    PixivHelper.print_and_log('error', f'Failed to insert image id:{image.imageId} to DB')
+
+                db.updateImage(image.imageId, image.imageTitle, filename, image.imageMode)
+
+                if len(manga_files) > 0:
+                    db.insertMangaImages(manga_files)
+
+                # Save tags if enabled
+                if config.autoAddTag:
+                    tags = image.tags
+                    if tags:
+                        image_tags = list()
+                        tag_translations = list()
+                        for tag_data in tags:
+                            tag_id = tag_data.tag
+                            if tag_id:
+                                image_tags.append((image_id, tag_id))
+                                if tag_data.romaji:
+                                    tag_translations.append((tag_id, 'romaji', tag_data.romaji))
+                                if tag_data.translation_data:
+                                    for locale in tag_data.translation_data:
+                                        tag_translations.append((tag_id, locale, tag_data.translation_data[locale]))
+                        db.insertImageTags(image_tags, tag_translations)
+
+                # Save member data if enabled
+                if image.artist is not None and config.autoAddMember:
+                    member_id = image.artist.artistId
+                    member_token = image.artist.artistToken
+                    member_name = image.artist.artistName
+                    if member_id and member_token and member_name:
+                        db.insertNewMember(int(member_id), member_token=member_token)
+                        db.updateMemberName(member_id, member_name, member_token)
 
             # map back to PIXIVUTIL_OK (because of ugoira file check)
             result = 0
@@ -477,6 +555,155 @@ def process_image(caller,
             PixivHelper.print_and_log('error', f'Dumping html to: {dump_filename}')
 
         raise
+    finally:
+        # the remote file info of the pages not saved to DB is not needed anymore
+        if image_id is not None:
+            db.discardPendingRemoteFileInfo(PixivConstant.DOWNLOAD_PIXIV, image_id)
+
+
+def download_pages(caller, config, image, pages, referer, notifier=None):
+    '''Download the pages of an image, using the async engine if enabled, else up to config.maxConcurrentPages worker threads.
+    pages is a list of (page, url, filename, prefix), returns a list of (result, filename, downloaded) in the same order.'''
+    if config.downloadEngine == "async":
+        engine = PixivAsyncDownloadHandler.get_engine(config)
+        if engine is not None:
+            return download_pages_async(caller, config, engine, image, pages, referer, notifier)
+
+    max_workers = min(config.maxConcurrentPages, len(pages))
+    if max_workers <= 1:
+        results = list()
+        for page in pages:
+            results.append(download_page(caller, config, image, page, referer, notifier))
+            # returned instead of raised in the member worker threads of process_list
+            if results[-1][0] == PixivConstant.PIXIVUTIL_KEYBOARD_INTERRUPT:
+                raise KeyboardInterrupt()
+        return results
+
+    # keep the output together with the member when running from parallel process_list
+    console = sys.stdout if isinstance(sys.stdout, PixivHelper.BufferedConsole) else None
+    buffer = console.current_buffer() if console is not None else None
+
+    # max_workers tasks of the shared pool take the next page until all are done or interrupted
+    results = [None] * len(pages)
+    remaining = iter(enumerate(pages))
+    lock = threading.Lock()
+    stopped = threading.Event()
+
+    def download():
+        while not stopped.is_set():
+            with lock:
+                (index, page) = next(remaining, (None, None))
+            if page is None:
+                return
+            results[index] = download_page(caller, config, image, page, referer, notifier)
+            if results[index][0] == PixivConstant.PIXIVUTIL_KEYBOARD_INTERRUPT:
+                stopped.set()
+
+    def attached_download():
+        if buffer is None:
+            return download()
+        with console.attach(buffer):
+            return download()
+
+    executor = get_page_executor(config)
+    futures = [executor.submit(attached_download) for _ in range(max_workers)]
+    try:
+        for future in futures:
+            future.result()
+    except KeyboardInterrupt:
+        stopped.set()
+        raise
+
+    if stopped.is_set():
+        raise KeyboardInterrupt()
+    return results
+
+
+def get_page_executor(config):
+    '''Thread pool shared by the posts, so the threads and their worker browsers are reused.
+    Each post uses at most maxConcurrentPages of them, for each of the maxConcurrentMembers.'''
+    global _page_executor
+    global _page_executor_size
+    size = config.maxConcurrentPages * config.maxConcurrentMembers
+    with _page_executor_lock:
+        if _page_executor is None or _page_executor_size < size:
+            if _page_executor is not None:
+                _page_executor.shutdown(wait=False)
+            _page_executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix="page")
+            _page_executor_size = size
+        return _page_executor
+
+
+def download_page(caller, config, image, page_info, referer, notifier=None):
+    (page, img, filename, prefix) = page_info
+    PixivHelper.print_and_log(None, f'{prefix}Image URL : {img}')
+    PixivHelper.print_and_log('info', f'{prefix}Filename  : {filename}')
+
+    def download():
+        return PixivDownloadHandler.download_image(caller,
+                                                   img,
+                                                   filename,
+                                                   referer,
+                                                   config.overwrite,
+                                                   config.retry,
+                                                   config.backupOldFile,
+                                                   image,
+                                                   page,
+                                                   notifier)
+    result = get_page_result(image, page_info, download)
+    PixivHelper.print_and_log(None, '')
+    return result
+
+
+def get_page_result(image, page_info, download):
+    '''Run download() for the page and return (result, filename, downloaded), only KeyboardInterrupt is raised.'''
+    (page, img, filename, prefix) = page_info
+    in_worker = threading.current_thread() is not threading.main_thread()
+    result = PixivConstant.PIXIVUTIL_NOT_OK
+    downloaded = False
+    try:
+        (result, filename) = download()
+
+        if result == PixivConstant.PIXIVUTIL_NOT_OK:
+            PixivHelper.print_and_log('error', f'{prefix}Image url not found/failed to download: {image.imageId}')
+        elif result == PixivConstant.PIXIVUTIL_KEYBOARD_INTERRUPT:
+            if not in_worker:
+                raise KeyboardInterrupt()
+            return (result, filename, False)
+        downloaded = True
+    except URLError:
+        PixivHelper.print_and_log('error', f'{prefix}Error when download_image(), giving up url: {img}')
+    except Exception as ex:
+        # one failed page should not abort the remaining pages
+        PixivHelper.print_and_log('error', f'{prefix}Failed to download page {page} of {image.imageId}: {ex}', exception=ex)
+        result = PixivConstant.PIXIVUTIL_NOT_OK
+    return (result, filename, downloaded)
+
+
+def download_pages_async(caller, config, engine, image, pages, referer, notifier=None):
+    '''Submit all the pages to the async download engine and wait for them in the page order.'''
+    futures = list()
+    for (page, img, filename, prefix) in pages:
+        PixivHelper.print_and_log(None, f'{prefix}Image URL : {img}')
+        PixivHelper.print_and_log('info', f'{prefix}Filename  : {filename}')
+    try:
+        for (page, img, filename, prefix) in pages:
+            futures.append(engine.submit(caller,
+                                         img,
+                                         filename,
+                                         referer,
+                                         config.overwrite,
+                                         config.retry,
+                                         config.backupOldFile,
+                                         image,
+                                         page,
+                                         notifier))
+        results = [get_page_result(image, page_info, future.result) for (page_info, future) in zip(pages, futures)]
+    except KeyboardInterrupt:
+        engine.cancel(futures)
+        raise
+    PixivHelper.print_and_log(None, '')
+    return results
 
 
 def process_manga_series(caller,
@@ -1,17 +1,25 @@
 import os
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import PixivArtistHandler
+import PixivBrowserFactory
+import PixivCircuitBreaker
 import PixivHelper
+import PixivRateLimiter
 import PixivSketchHandler
 import PixivTagsHandler
+from PixivException import PixivException
 from PixivListItem import PixivListItem
 from PixivTags import PixivTags
 
+# the list items are pixiv members, their sketch (sketch.pixiv.net) also use HOST_PIXIV
+_list_backends = (PixivRateLimiter.HOST_PIXIV, PixivRateLimiter.HOST_PXIMG)
+
 
 def process_list(caller, config, list_file_name=None, tags=None, include_sketch=False):
     db = caller.__dbManager__
-    br = caller.__br__
 
     result = None
     try:
@@ -38,55 +46,53 @@ def process_list(caller, config, list_file_name=None, tags=None, include_sketch=
                         break
 
         PixivHelper.print_and_log('info', f"Found {len(result)} items.")
-        current_member = 1
-        for item in result:
-            retry_count = 0
-            while True:
-                try:
-                    prefix = f"[{current_member} of {len(result)}] "
-                    PixivArtistHandler.process_member(caller,
-                                                      config,
-                                                      item.memberId,
-                                                      user_dir=item.path,
-                                                      tags=tags,
-                                                      title_prefix=prefix)
-                    break
-                except KeyboardInterrupt:
-                    raise
-                except BaseException as ex:
-                    if retry_count > config.retry:
-                        PixivHelper.print_and_log('error', f'Giving up member_id: {item.memberId} ==> {ex}')
-                        break
-                    retry_count = retry_count + 1
-                    print(f'Something wrong, retrying after 2 second ({retry_count}) ==> {ex}')
-                    PixivHelper.print_delay(2)
+        max_workers = min(config.maxConcurrentMembers, len(result))
+
+        # members are deferred while pixiv/pximg is failing, see circuitBreakerThreshold
+        def process_deferred(items):
+            PixivCircuitBreaker.process_deferrable(items,
+                                                   lambda x: process_list_item(caller, config, x[1], x[0], len(result), tags, include_sketch),
+                                                   lambda x: _list_backends,
+                                                   describe=lambda x: f"member id = {x[1].memberId}",
+                                                   max_deferral=config.retry)
 
-            retry_count = 0
-            while include_sketch:
+        if max_workers <= 1:
+            process_deferred(list(enumerate(result, 1)))
+        else:
+            PixivHelper.print_and_log('info', f"Processing {max_workers} members in parallel.")
+            deferred = list()
+            stop_event = threading.Event()
+            with PixivHelper.buffered_console() as console:
+                def process_isolated(current_member, item):
+                    with console.capture():
+                        PixivCircuitBreaker.wait_for_backends(_list_backends)
+                        trips = PixivCircuitBreaker.get_trip_count(_list_backends)
+                        try:
+                            process_list_item(caller, config, item, current_member, len(result), tags, include_sketch, stop_event=stop_event)
+                        except PixivException as ex:
+                            if not PixivCircuitBreaker.is_circuit_open_error(ex):
+                                raise
+                            deferred.append((current_member, item))
+                            return
+                        if PixivCircuitBreaker.get_trip_count(_list_backends) != trips:
+                            deferred.append((current_member, item))
+
+                executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="member")
+                futures = [executor.submit(process_isolated, current_member, item) for (current_member, item) in enumerate(result, 1)]
                 try:
-                    # Issue 1007
-                    # fetching artist token...
-                    (artist_model, _) = br.getMemberPage(item.memberId)
-                    prefix = f"[{current_member} ({item.memberId} - {artist_model.artistToken}) of {len(result)}] "
-                    PixivSketchHandler.process_sketch_artists(caller,
-                                                              config,
-                                                              artist_model.artistToken,
-                                                              title_prefix=prefix)
-                    break
-                except KeyboardInterrupt:
+                    for future in futures:
+                        future.result()
+                except BaseException:
+                    stop_event.set()
+                    for future in futures:
+                        future.cancel()
+                    PixivHelper.print_and_log('info', "Waiting for the running members to stop after the current post.")
                     raise
-                except BaseException as ex:
-                    if retry_count > config.retry:
-                        PixivHelper.print_and_log('error', f'Giving up member_id: {item.memberId} when processing PixivSketch ==> {ex}')
-                        break
-                    retry_count = retry_count + 1
-                    print(f'Something wrong, retrying after 2 second ({retry_count}) ==> {ex}')
-                    PixivHelper.print_delay(2)
-
-            current_member = current_member + 1
-            br.clear_history()
-            print(f'done for member id = {item.memberId}.')
-            print('')
+                finally:
+                    executor.shutdown(wait=True)
+            if len(deferred) > 0:
+                PixivHelper.print_and_log('info', f"Retrying {len(deferred)} member(s) processed while the circuit breaker tripped.")
+                process_deferred(sorted(deferred, key=lambda x: x[0]))
     except Exception as ex:
         if isinstance(ex, KeyboardInterrupt):
             raise
@@ -96,6 +102,68 @@ def process_list(caller, config, list_file_name=None, tags=None, include_sketch=
         raise
 
 
+def process_list_item(caller, config, item, current_member, total, tags=None, include_sketch=False, stop_event=None):
+    # worker threads get their own browser
+    br = PixivBrowserFactory.getBrowser()
+
+    retry_count = 0
+    while True:
+        try:
+            prefix = f"[{current_member} of {total}] "
+            PixivArtistHandler.process_member(caller,
+                                              config,
+                                              item.memberId,
+                                              user_dir=item.path,
+                                              tags=tags,
+                                              title_prefix=prefix,
+                                              stop_event=stop_event)
+            break
+        except KeyboardInterrupt:
+            raise
+        except BaseException as ex:
+            if stop_event is not None and stop_event.is_set():
+                raise KeyboardInterrupt()
+            if PixivCircuitBreaker.is_circuit_open_error(ex):
+                # the member is deferred until the backend recovers, see process_list()
+                raise
+            if retry_count > config.retry:
+                PixivHelper.print_and_log('error', f'Giving up member_id: {item.memberId} ==> {ex}')
+                break
+            retry_count = retry_count + 1
+            print(f'Something wrong, retrying after 2 second ({retry_count}) ==> {ex}')
+            PixivHelper.print_delay(2)
+
+    retry_count = 0
+    while include_sketch:
+        if stop_event is not None and stop_event.is_set():
+            raise KeyboardInterrupt()
+        try:
+            # Issue 1007
+            # fetching artist token...
+            (artist_model, _) = br.getMemberPage(item.memberId)
+            prefix = f"[{current_member} ({item.memberId} - {artist_model.artistToken}) of {total}] "
+            PixivSketchHandler.process_sketch_artists(caller,
+                                                      config,
+                                                      artist_model.artistToken,
+                                                      title_prefix=prefix)
+            break
+        except KeyboardInterrupt:
+            raise
+        except BaseException as ex:
+            if PixivCircuitBreaker.is_circuit_open_error(ex):
+                raise
+            if retry_count > config.retry:
+                PixivHelper.print_and_log('error', f'Giving up member_id: {item.memberId} when processing PixivSketch ==> {ex}')
+                break
+            retry_count = retry_count + 1
+            print(f'Something wrong, retrying after 2 second ({retry_count}) ==> {ex}')
+            PixivHelper.print_delay(2)
+
+    br.clear_history()
+    print(f'done for member id = {item.memberId}.')
+    print('')
+
+
 def process_tags_list(caller,
                       config,
                       filename,
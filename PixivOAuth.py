@@ -7,6 +7,8 @@ import os
 import random
 import ssl
 import sys
+import threading
+import time
 from collections import OrderedDict
 from datetime import datetime
 from typing import Dict
@@ -16,6 +18,7 @@ import requests
 
 import PixivHelper
 import PixivOAuthBrowser
+import PixivRateLimiter
 
 
 # monkey patch cloudscraper.User_Agent.loadUserAgent function
@@ -125,6 +128,9 @@ class PixivOAuth():
     _proxies: Dict[str, str] = None
     _tzInfo: PixivHelper.LocalUTCOffsetTimezone = None
     _validate_ssl: bool = True
+    _access_token_expiry: float = 0
+    # refresh the access token this many seconds before it expires
+    _refresh_margin: int = 60
 
     sess = requests.Session()
     if PixivHelper.we_are_frozen():
@@ -150,6 +156,8 @@ class PixivOAuth():
         else:
             self._refresh_token = None
         self._access_token = None
+        self._access_token_expiry = 0
+        self._lock = threading.RLock()
         self._tzInfo = PixivHelper.LocalUTCOffsetTimezone()
         self._validate_ssl = validate_ssl
         PixivOAuthBrowser.set_proxy(proxies)
@@ -189,16 +197,33 @@ class PixivOAuth():
                 'X-Client-Time': time,
                 'X-Client-Hash': time_hash.hexdigest()}
 
-    def _get_headers_with_bearer(self):
-        if self._access_token is None:
-            self.login()
-
+    def _get_headers_with_bearer(self, access_token=None):
+        if access_token is None:
+            access_token = self.get_access_token()
         headers = self._get_default_headers()
-        headers["Authorization"] = "Bearer {0}".format(self._access_token)
+        headers["Authorization"] = "Bearer {0}".format(access_token)
         return headers
 
+    def get_access_token(self):
+        '''Return the current access token, login/refresh only if it is missing or about to expire.'''
+        with self._lock:
+            if self._access_token is None or time.time() >= self._access_token_expiry - self._refresh_margin:
+                self.login()
+            return self._access_token
+
+    def refresh_access_token(self, stale_token):
+        '''Refresh the access token after it is rejected, unless another thread already did it.'''
+        with self._lock:
+            if self._access_token == stale_token:
+                self._access_token = None
+            return self.get_access_token()
+
+    def get_refresh_token(self):
+        return self._refresh_token
+
     def login_with_username_and_password(self):
         PixivHelper.get_logger().info("Login to OAuth using username and password.")
+        PixivRateLimiter.acquire(self._url)
         oauth_response = self._req.post(self._url,
                                         data=self._get_values_for_login(),
                                         headers=self._get_default_headers(),
@@ -207,10 +232,15 @@ class PixivOAuth():
         return oauth_response
 
     def login(self):
+        with self._lock:
+            return self._login()
+
+    def _login(self):
         oauth_response = None
         need_relogin = True
         if self._refresh_token is not None:
             PixivHelper.get_logger().info("Login to OAuth using refresh token.")
+            PixivRateLimiter.acquire(self._url)
             oauth_response = self._req.post(self._url,
                                             data=self._get_values_for_refresh(),
                                             headers=self._get_default_headers(),
@@ -230,6 +260,7 @@ class PixivOAuth():
             info = json.loads(oauth_response.text)
             self._refresh_token = info["response"]["refresh_token"]
             self._access_token = info["response"]["access_token"]
+            self._access_token_expiry = time.time() + int(info["response"].get("expires_in", 3600))
         elif oauth_response.status_code in (400, 403):
             info = oauth_response.text
             try:
@@ -245,11 +276,23 @@ class PixivOAuth():
 
     def get_user_info(self, userid):
         url = 'https://app-api.pixiv.net/v1/user/detail?user_id={0}'.format(userid)
+        access_token = self.get_access_token()
+        PixivRateLimiter.acquire(url)
         user_info = self._req.get(url,
-                                  headers=self._get_headers_with_bearer(),
+                                  headers=self._get_headers_with_bearer(access_token),
                                   proxies=self._proxies,
                                   verify=self._validate_ssl)
 
+        if user_info.status_code == 401:
+            # access token revoked/expired early, refresh and retry once
+            PixivHelper.get_logger().info("OAuth access token rejected, refreshing.")
+            access_token = self.refresh_access_token(access_token)
+            PixivRateLimiter.acquire(url)
+            user_info = self._req.get(url,
+                                      headers=self._get_headers_with_bearer(access_token),
+                                      proxies=self._proxies,
+                                      verify=self._validate_ssl)
+
         if user_info.status_code == 404:
             PixivHelper.print_and_log('error', user_info.text)
 
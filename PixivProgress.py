@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+# pylint: disable=W0603
+import json
+import sys
+import threading
+import time
+
+from colorama import Fore, Style
+
+import PixivHelper
+
+MODE_BAR = "bar"
+MODE_JSON = "json"
+MODE_NONE = "none"
+MODES = (MODE_BAR, MODE_JSON, MODE_NONE)
+
+# the bar is redrawn at 10 Hz, the json lines are written once per second
+RENDER_INTERVAL = 0.1
+JSON_INTERVAL = 1.0
+
+_mode = MODE_BAR
+_transfers = dict()
+_lock = threading.Lock()
+_active = threading.Event()
+_thread = None
+_msg_len = 0
+_speed = 0
+_last_tick = 0
+_finished_bytes = 0
+
+
+class Transfer(object):
+    '''Counters of one download, updated by the downloading thread without locking and read by the renderer.'''
+
+    __slots__ = ("name", "total", "offset", "curr", "start_time", "last_curr")
+
+    def __init__(self, name, total=-1, offset=0):
+        self.name = name
+        self.total = total
+        self.offset = offset
+        self.curr = offset
+        self.last_curr = offset
+        self.start_time = time.monotonic()
+
+    def update(self, curr):
+        self.curr = curr
+
+    def finish(self):
+        _finish(self)
+
+
+def configure(mode):
+    '''Set the progress mode: bar (default), json for one json line per second on stderr, or none.'''
+    global _mode
+    if mode not in MODES:
+        raise ValueError(f"Invalid progress mode: {mode}, valid modes: {', '.join(MODES)}")
+    _mode = mode
+
+
+def get_mode():
+    return _mode
+
+
+def start(name, total=-1, offset=0):
+    '''Register a new transfer of total bytes (-1 if unknown), resuming from offset.'''
+    global _thread
+    global _last_tick
+    transfer = Transfer(name, total, offset)
+    if _mode == MODE_NONE:
+        return transfer
+    with _lock:
+        if len(_transfers) == 0:
+            _last_tick = transfer.start_time
+        _transfers[id(transfer)] = transfer
+        if _thread is None:
+            _thread = threading.Thread(target=_run, name="progress", daemon=True)
+            _thread.start()
+        _active.set()
+    return transfer
+
+
+def _finish(transfer):
+    global _msg_len
+    global _finished_bytes
+    with _lock:
+        if _transfers.pop(id(transfer), None) is None:
+            return
+        _finished_bytes = _finished_bytes + transfer.curr - transfer.last_curr
+        transfer.last_curr = transfer.curr
+        if _mode == MODE_BAR:
+            if len(_transfers) == 0:
+                # draw the final state, so the completion message is printed after a full bar.
+                _render_bar([transfer])
+            else:
+                _write("\r" + " " * _msg_len + "\r")
+        elif _mode == MODE_JSON:
+            _write_json({"event": "done",
+                         "name": transfer.name,
+                         "downloaded": transfer.curr,
+                         "total": transfer.total,
+                         "elapsed": round(time.monotonic() - transfer.start_time, 3)})
+        if len(_transfers) == 0:
+            _reset_speed()
+            _active.clear()
+
+
+def _run():
+    last_json = 0
+    while True:
+        _active.wait()
+        time.sleep(RENDER_INTERVAL)
+        with _lock:
+            transfers = list(_transfers.values())
+            if len(transfers) == 0:
+                continue
+            _update_speed(transfers)
+            if _mode == MODE_BAR:
+                _render_bar(transfers)
+            elif _mode == MODE_JSON and time.monotonic() - last_json >= JSON_INTERVAL:
+                last_json = time.monotonic()
+                _render_json(transfers)
+
+
+def _update_speed(transfers):
+    '''Aggregate throughput of all the transfers since the previous tick, smoothed.'''
+    global _speed
+    global _last_tick
+    global _finished_bytes
+    now = time.monotonic()
+    received = _finished_bytes
+    for transfer in transfers:
+        curr = transfer.curr
+        received = received + curr - transfer.last_curr
+        transfer.last_curr = curr
+    _finished_bytes = 0
+    elapsed = now - _last_tick
+    _last_tick = now
+    if elapsed <= 0:
+        return
+    rate = received / elapsed
+    _speed = rate if _speed == 0 else _speed * 0.7 + rate * 0.3
+
+
+def _reset_speed():
+    global _speed
+    global _finished_bytes
+    _speed = 0
+    _finished_bytes = 0
+
+
+def _get_totals(transfers):
+    curr = sum(transfer.curr for transfer in transfers)
+    if any(transfer.total < 0 for transfer in transfers):
+        return (curr, -1, None)
+    total = sum(transfer.total for transfer in transfers)
+    eta = (total - curr) / _speed if _speed > 0 else None
+    return (curr, total, eta)
+
+
+def _render_bar(transfers):
+    global _msg_len
+    if len(transfers) == 1:
+        transfer = transfers[0]
+        msg = PixivHelper.format_progress(transfer.curr, transfer.total)
+    else:
+        msg = _format_aggregate(transfers)
+    _write(msg.ljust(_msg_len, " "))
+    _msg_len = max(len(msg), _msg_len)
+
+
+def _format_aggregate(transfers):
+    (curr, total, eta) = _get_totals(transfers)
+    msg = f"\r{Fore.CYAN}[{len(transfers)} downloads]{Style.RESET_ALL} {PixivHelper.size_in_str(curr)}"
+    if total > 0:
+        msg = msg + f" of {PixivHelper.size_in_str(total)} ({int(curr * 100 / total)}%)"
+    msg = msg + f" {Fore.RED}{PixivHelper.speed_in_str(_speed, 1)}{Style.RESET_ALL}"
+    if eta is not None:
+        msg = msg + f" ETA {_format_eta(eta)}"
+    return msg
+
+
+def _render_json(transfers):
+    (curr, total, eta) = _get_totals(transfers)
+    _write_json({"event": "progress",
+                 "active": len(transfers),
+                 "downloaded": curr,
+                 "total": total,
+                 "speed": int(_speed),
+                 "eta": round(eta, 1) if eta is not None else None,
+                 "transfers": [{"name": transfer.name, "downloaded": transfer.curr, "total": transfer.total}
+                               for transfer in transfers]})
+
+
+def _format_eta(eta):
+    eta = int(eta)
+    if eta >= 3600:
+        return f"{eta // 3600}h{eta % 3600 // 60:02d}m"
+    if eta >= 60:
+        return f"{eta // 60}m{eta % 60:02d}s"
+    return f"{eta}s"
+
+
+def _write_json(data):
+    # on stderr, so the json lines are not mixed with the console output on stdout
+    _write(json.dumps(data, ensure_ascii=False) + "\n", sys.stderr)
+
+
+def _write(text, stream=None):
+    if stream is None:
+        stream = sys.stdout
+    try:
+        stream.write(text)
+        stream.flush()
+    except (OSError, UnicodeError):
+        pass
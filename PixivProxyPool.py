@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+# pylint: disable=W0603
+import base64
+import http.client
+import random
+import re
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from functools import partial
+from urllib.parse import unquote, urlparse
+
+import mechanize
+import requests
+import socks
+
+import PixivHelper
+import PixivStatistics
+
+_pool = None
+_pool_key = None
+_pool_lock = threading.Lock()
+
+_re_separator = re.compile(r"[\s,;|]+")
+
+# socket errors from the proxy, counted against its health
+PROXY_ERRORS = (OSError,
+                http.client.HTTPException,
+                requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout)
+
+
+def parse_proxy_list(value):
+    '''Split proxyAddress into the list of proxy urls, separated by comma, semicolon, pipe or space.'''
+    if not value:
+        return list()
+    return [proxy for proxy in _re_separator.split(value.strip()) if len(proxy) > 0]
+
+
+class ProxyEntry(object):
+    '''One egress proxy with its own connection pool and health score.
+    The proxy is ejected for a while after max_failures consecutive errors.'''
+
+    def __init__(self, url, max_failures=3, eject_time=60):
+        if "://" not in url:
+            url = "http://" + url
+        parsed = urlparse(url)
+        self.url = url
+        self.scheme = parsed.scheme.lower()
+        self.hostname = parsed.hostname
+        self.is_socks = self.scheme.startswith("socks")
+        self.port = parsed.port or (1080 if self.is_socks else 8080)
+        self.username = unquote(parsed.username) if parsed.username else None
+        self.password = unquote(parsed.password) if parsed.password else None
+        self.name = f"{self.hostname}:{self.port}"
+        self.max_failures = max_failures
+        self.eject_time = eject_time
+
+        self.latency = None  # moving average of the connect/response time in seconds
+        self.failures = 0  # consecutive errors
+        self.requests = 0
+        self.errors = 0
+        self.ejections = 0
+        self.ejected_until = 0
+        self._session = None
+        self._session_key = None
+        self._lock = threading.Lock()
+
+    @property
+    def requests_url(self):
+        '''Proxy url for requests, the host names are resolved by the SOCKS proxy like the http proxy.'''
+        scheme = {"socks5": "socks5h", "socks4": "socks4a"}.get(self.scheme, self.scheme)
+        return f"{scheme}://{self.url.split('://', 1)[1]}"
+
+    def is_ejected(self, now=None):
+        return self.ejected_until > (now or time.monotonic())
+
+    def score(self):
+        '''Lower is better: the average latency, penalized by the recent errors.
+        An unused proxy get a low latency so it is tried early.'''
+        latency = max(self.latency, 0.01) if self.latency is not None else 0.1
+        return latency * (1 + self.failures) ** 2
+
+    def record_success(self, latency):
+        with self._lock:
+            self.requests = self.requests + 1
+            self.failures = 0
+            self.latency = latency if self.latency is None else self.latency * 0.8 + latency * 0.2
+
+    def record_failure(self):
+        with self._lock:
+            self.requests = self.requests + 1
+            self.errors = self.errors + 1
+            self.failures = self.failures + 1
+            if self.failures < self.max_failures:
+                return
+            # back off longer for a proxy which keeps failing, one more error after the ejection eject it again.
+            eject_time = self.eject_time * 2 ** min(self.ejections, 5)
+            self.ejections = self.ejections + 1
+            self.ejected_until = time.monotonic() + eject_time
+            self.failures = self.max_failures - 1
+        PixivStatistics.increment("Proxy ejections")
+        PixivHelper.print_and_log('warn', f'Proxy {self.name} ejected for {eject_time}s after {self.max_failures} consecutive errors.')
+
+    def create_connection(self, address, timeout=None):
+        '''Return a socket connected to address through the proxy, using CONNECT for http proxy.'''
+        if self.is_socks:
+            proxy_type = socks.PROXY_TYPE_SOCKS5 if self.scheme.startswith("socks5") else socks.PROXY_TYPE_SOCKS4
+            return socks.create_connection(address, timeout, None, proxy_type, self.hostname, self.port,
+                                           True, self.username, self.password)
+
+        sock = socket.create_connection((self.hostname, self.port), timeout)
+        try:
+            (host, port) = address
+            connect = f"CONNECT {host}:{port} HTTP/1.1\r\nHost: {host}:{port}\r\n"
+            if self.username is not None:
+                credential = base64.b64encode(f"{self.username}:{self.password or ''}".encode("utf8")).decode("ascii")
+                connect = connect + f"Proxy-Authorization: Basic {credential}\r\n"
+            sock.sendall((connect + "\r\n").encode("latin-1"))
+            response = http.client.HTTPResponse(sock, method="CONNECT")
+            response.begin()
+            if response.status != 200:
+                raise OSError(f"Tunnel connection to {host}:{port} failed: {response.status} {response.reason}")
+        except BaseException:
+            sock.close()
+            raise
+        return sock
+
+    def get_session(self, key, factory):
+        '''Return the requests.Session of this proxy, created by factory(entry) if the key changed.'''
+        with self._lock:
+            if self._session is None or self._session_key != key:
+                self._session = factory(self)
+                self._session_key = key
+            return self._session
+
+
+class ProxyPool(object):
+    '''Spread the requests across the proxies, the healthy ones with lower latency are chosen more often.'''
+
+    def __init__(self, urls, max_failures=3, eject_time=60):
+        self.entries = [ProxyEntry(url, max_failures, eject_time) for url in urls]
+
+    def has_socks(self):
+        return any(entry.is_socks for entry in self.entries)
+
+    def choose(self):
+        '''Pick a healthy proxy weighted by 1/score, or the one to be back soonest if all are ejected.'''
+        now = time.monotonic()
+        healthy = [entry for entry in self.entries if not entry.is_ejected(now)]
+        if len(healthy) == 0:
+            return min(self.entries, key=lambda entry: entry.ejected_until)
+        if len(healthy) == 1:
+            return healthy[0]
+        return random.choices(healthy, weights=[1 / entry.score() for entry in healthy])[0]
+
+    def create_connection(self, address, timeout=None):
+        entry = self.choose()
+        start = time.monotonic()
+        try:
+            sock = entry.create_connection(address, timeout)
+        except PROXY_ERRORS:
+            entry.record_failure()
+            raise
+        entry.record_success(time.monotonic() - start)
+        return sock
+
+    def get_statistics(self):
+        statistics = dict()
+        for entry in self.entries:
+            statistics[f"Proxy {entry.name} requests"] = entry.requests
+            statistics[f"Proxy {entry.name} errors"] = entry.errors
+            if entry.latency is not None:
+                statistics[f"Proxy {entry.name} latency (ms)"] = int(entry.latency * 1000)
+        return statistics
+
+
+@contextmanager
+def track(entry, errors=PROXY_ERRORS):
+    '''Record the errors raised in the block against the proxy, the block should call entry.record_success().'''
+    if entry is None:
+        yield
+        return
+    try:
+        yield
+    except errors:
+        entry.record_failure()
+        raise
+
+
+class ProxyHealthAdapter(requests.adapters.HTTPAdapter):
+    '''HTTPAdapter recording the response time and the connection errors of its proxy.'''
+
+    def __init__(self, entry, **kwargs):
+        self.entry = entry
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        start = time.monotonic()
+        with track(self.entry):
+            response = super().send(request, **kwargs)
+        self.entry.record_success(time.monotonic() - start)
+        return response
+
+
+class ProxyHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, pool, *args, **kwargs):
+        self._pool = pool
+        super().__init__(*args, **kwargs)
+
+    def connect(self):
+        self.sock = self._pool.create_connection((self.host, self.port), _get_timeout(self.timeout))
+
+
+class ProxyHTTPSConnection(http.client.HTTPSConnection):
+    def __init__(self, pool, *args, **kwargs):
+        self._pool = pool
+        super().__init__(*args, **kwargs)
+
+    def connect(self):
+        sock = self._pool.create_connection((self.host, self.port), _get_timeout(self.timeout))
+        self.sock = self._context.wrap_socket(sock, server_hostname=self.host)
+
+
+def _get_timeout(timeout):
+    if timeout is socket._GLOBAL_DEFAULT_TIMEOUT:
+        return socket.getdefaulttimeout()
+    return timeout
+
+
+class ProxyHTTPHandler(mechanize.HTTPHandler):
+    '''mechanize handler connecting through the proxy pool, instead of patching the socket module.'''
+
+    def __init__(self, pool):
+        super().__init__()
+        self.pool = pool
+
+    def http_open(self, req):
+        return self.do_open(partial(ProxyHTTPConnection, self.pool), req)
+
+    def __copy__(self):
+        ans = self.__class__(self.pool)
+        ans._debuglevel = self._debuglevel
+        return ans
+
+
+class ProxyHTTPSHandler(mechanize.HTTPSHandler):
+    def __init__(self, pool):
+        super().__init__()
+        self.pool = pool
+
+    def https_open(self, req):
+        import ssl
+        context = self.ssl_context or ssl.create_default_context()
+        return self.do_open(partial(ProxyHTTPSConnection, self.pool, context=context), req)
+
+    def __copy__(self):
+        ans = self.__class__(self.pool)
+        ans._debuglevel = self._debuglevel
+        ans.ssl_context = self.ssl_context
+        return ans
+
+
+def install_handlers(browser, pool):
+    '''Send the mechanize browser requests through the proxy pool.'''
+    # the proxy handler is not needed, the connections are tunneled by the pool.
+    browser.set_proxies({})
+    ssl_context = browser._ua_handlers["https"].ssl_context
+    browser._replace_handler("http", ProxyHTTPHandler(pool))
+    browser._replace_handler("https", ProxyHTTPSHandler(pool))
+    browser._ua_handlers["https"].ssl_context = ssl_context
+
+
+def get_pool(config):
+    '''Return the shared proxy pool for proxyAddress, or None if the proxy is disabled.'''
+    global _pool
+    global _pool_key
+    if config is None or not config.useProxy:
+        return None
+    urls = parse_proxy_list(config.proxyAddress)
+    if len(urls) == 0:
+        return None
+    key = (tuple(urls), config.proxyMaxFailures, config.proxyEjectTime)
+    with _pool_lock:
+        if _pool is None or _pool_key != key:
+            _pool = ProxyPool(urls, config.proxyMaxFailures, config.proxyEjectTime)
+            _pool_key = key
+            PixivHelper.get_logger().info("Using %d proxies: %s", len(urls), ", ".join(entry.name for entry in _pool.entries))
+        return _pool
+
+
+def get_statistics():
+    pool = _pool
+    if pool is None:
+        return dict()
+    return pool.get_statistics()
+
+
+PixivStatistics.register(get_statistics)
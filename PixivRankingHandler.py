@@ -42,10 +42,14 @@ def process_ranking(caller, config, mode, content, start_page=1, end_page=0, dat
                             ranks.remove(item)
                             break
 
+            downloaded_ids = PixivImageHandler.get_downloaded_image_ids(caller, config, [post["illust_id"] for post in ranks.contents])
             for post in ranks.contents:
                 try:
                     result = PixivConstant.PIXIVUTIL_OK
-                    if not caller.DEBUG_SKIP_PROCESS_IMAGE:
+                    if post["illust_id"] in downloaded_ids:
+                        PixivHelper.print_and_log(None, f'Already downloaded in DB: {post["illust_id"]}')
+                        result = PixivConstant.PIXIVUTIL_SKIP_DUPLICATE_NO_WAIT
+                    elif not caller.DEBUG_SKIP_PROCESS_IMAGE:
                         print(f"{Fore.YELLOW} #{i}.{Style.RESET_ALL}")
                         result = PixivImageHandler.process_image(caller,
                                                                 config,
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+import weakref
+from urllib.parse import urlparse
+
+import PixivHelper
+
+HOST_PIXIV = "pixiv"
+HOST_PXIMG = "pximg"
+HOST_FANBOX = "fanbox"
+
+# the bandwidth buckets allow 100ms worth of bytes back to back, so the transfer is smooth.
+BANDWIDTH_BURST_TIME = 0.1
+BANDWIDTH_GLOBAL = "global"
+
+_buckets = dict()
+_bandwidth_buckets = dict()
+_job_bandwidth_buckets = weakref.WeakKeyDictionary()
+_lock = threading.Lock()
+
+
+class TokenBucket(object):
+    '''Thread safe token bucket, rate is the number of tokens per second and burst is the bucket size.'''
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = max(float(burst), 1.0)
+        self._tokens = self.burst
+        self._timestamp = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, tokens=1):
+        '''Take the tokens and return how long the caller need to wait before using them.'''
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._timestamp) * self.rate)
+            self._timestamp = now
+            # allow the bucket to go negative, so the next callers wait in order.
+            self._tokens = self._tokens - tokens
+            if self._tokens >= 0:
+                return 0
+            return -self._tokens / self.rate
+
+    def consume(self, tokens=1):
+        delay = self.reserve(tokens)
+        if delay > 0:
+            time.sleep(delay)
+        return delay
+
+
+def configure(config):
+    '''Create/update the bucket for each host class, rate = 0 disable the limit.'''
+    settings = ((HOST_PIXIV, config.rateLimitPixiv, config.rateLimitPixivBurst),
+                (HOST_PXIMG, config.rateLimitPximg, config.rateLimitPximgBurst),
+                (HOST_FANBOX, config.rateLimitFanbox, config.rateLimitFanboxBurst))
+    with _lock:
+        for (host_class, rate, burst) in settings:
+            bucket = _buckets.get(host_class)
+            if rate <= 0:
+                _buckets.pop(host_class, None)
+            elif bucket is None or bucket.rate != rate or bucket.burst != max(burst, 1):
+                _buckets[host_class] = TokenBucket(rate, burst)
+
+
+def get_host_class(url):
+    if hasattr(url, "get_full_url"):
+        url = url.get_full_url()
+    host = urlparse(url).hostname or ""
+    if host.endswith("pximg.net"):
+        return HOST_PXIMG
+    if host.endswith("fanbox.cc"):
+        return HOST_FANBOX
+    if host.endswith("pixiv.net"):
+        return HOST_PIXIV
+    return None
+
+
+def reserve(url):
+    '''Take a token for the url host class and return how long to wait before sending the request.'''
+    host_class = get_host_class(url)
+    bucket = _buckets.get(host_class)
+    if bucket is None:
+        return 0
+    delay = bucket.reserve()
+    if delay > 0:
+        PixivHelper.get_logger().debug(f"Rate limited {host_class} for {delay:.3f}s")
+    return delay
+
+
+def acquire(url):
+    '''Block until a request to the url is allowed by the rate limit of its host class.'''
+    delay = reserve(url)
+    if delay > 0:
+        time.sleep(delay)
+    return delay
+
+
+class BandwidthLimiter(object):
+    '''Throttle the bytes read by a download with all the bandwidth buckets applying to it.'''
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # read in small chunks, so the throttling does not stall the transfer for seconds
+        self.chunk_size = max(int(min(bucket.burst for bucket in buckets)), 1024)
+
+    def reserve(self, size):
+        '''Take size bytes from the buckets and return how long to wait before reading more.'''
+        if size <= 0:
+            return 0
+        return max(bucket.reserve(size) for bucket in self.buckets)
+
+    def consume(self, size):
+        delay = self.reserve(size)
+        if delay > 0:
+            time.sleep(delay)
+        return delay
+
+
+def _create_bandwidth_bucket(limit):
+    rate = limit * 1024
+    return TokenBucket(rate, rate * BANDWIDTH_BURST_TIME)
+
+
+def _get_bandwidth_bucket(name, limit):
+    '''Return the shared bucket for limit KiB/s, or None if limit is 0.'''
+    if limit <= 0:
+        return None
+    with _lock:
+        bucket = _bandwidth_buckets.get(name)
+        if bucket is None or bucket.rate != limit * 1024:
+            bucket = _create_bandwidth_bucket(limit)
+            _bandwidth_buckets[name] = bucket
+        return bucket
+
+
+def set_job_bandwidth_limit(config, limit):
+    '''Use a separate bucket of limit KiB/s instead of the global bandwidthLimit for the downloads using config, e.g. a batch job.'''
+    with _lock:
+        if limit > 0:
+            _job_bandwidth_buckets[config] = _create_bandwidth_bucket(limit)
+        else:
+            # unlimited job
+            _job_bandwidth_buckets[config] = None
+
+
+def get_bandwidth_limiter(config, url):
+    '''Return the BandwidthLimiter for downloading url: the global or job limit and the destination limit, or None if unlimited.'''
+    if config is None:
+        return None
+    buckets = list()
+    if config in _job_bandwidth_buckets:
+        buckets.append(_job_bandwidth_buckets[config])
+    else:
+        buckets.append(_get_bandwidth_bucket(BANDWIDTH_GLOBAL, config.bandwidthLimit))
+
+    host_class = get_host_class(url)
+    if host_class == HOST_PXIMG:
+        buckets.append(_get_bandwidth_bucket(host_class, config.bandwidthLimitPximg))
+    elif host_class == HOST_FANBOX:
+        buckets.append(_get_bandwidth_bucket(host_class, config.bandwidthLimitFanbox))
+
+    buckets = [bucket for bucket in buckets if bucket is not None]
+    if len(buckets) == 0:
+        return None
+    return BandwidthLimiter(buckets)
+
+
+def is_host_limited(config, host_class):
+    '''True if the requests to the host class are rate limited, or the downloads from the file hosts (pximg, fanbox) are bandwidth limited.
+    A bandwidth limit does not pace the pixiv.net API and page requests.'''
+    if host_class in _buckets:
+        return True
+    if config is None or host_class not in (HOST_PXIMG, HOST_FANBOX):
+        return False
+    if config in _job_bandwidth_buckets:
+        if _job_bandwidth_buckets[config] is not None:
+            return True
+    elif config.bandwidthLimit > 0:
+        return True
+    if host_class == HOST_PXIMG:
+        return config.bandwidthLimitPximg > 0
+    return config.bandwidthLimitFanbox > 0
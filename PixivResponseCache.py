@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+# pylint: disable=W0603
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import PixivHelper
+import PixivStatistics
+
+ENDPOINT_MEMBER = "member"
+ENDPOINT_WORKS = "works"
+ENDPOINT_SEARCH = "search"
+ENDPOINT_OTHER = "other"
+
+# (pattern, endpoint class), first match wins
+_ENDPOINTS = [
+    (re.compile(r"/ajax/user/\d+/(profile|illusts|manga|illustmanga)\b"), ENDPOINT_WORKS),
+    (re.compile(r"/ajax/user/\d+(\?|$)"), ENDPOINT_MEMBER),
+    (re.compile(r"app-api\.pixiv\.net/v1/user/detail"), ENDPOINT_MEMBER),
+    (re.compile(r"/rpc/get_work\.php"), ENDPOINT_MEMBER),
+    (re.compile(r"/ajax/search/|/tags/"), ENDPOINT_SEARCH),
+]
+
+# how the value is stored
+KIND_TEXT = 0
+KIND_BYTES = 1
+KIND_JSON = 2
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_endpoint_class(url):
+    for (pattern, endpoint) in _ENDPOINTS:
+        if pattern.search(url):
+            return endpoint
+    return ENDPOINT_OTHER
+
+
+def get_size(item):
+    '''Approximate memory size of a cached response in bytes.'''
+    if isinstance(item, (str, bytes, bytearray)):
+        return len(item)
+    try:
+        return len(json.dumps(item, default=str))
+    except (TypeError, ValueError):
+        return 0
+
+
+class MemoryCache(object):
+    '''In-memory LRU cache with TTL, bounded by the number of items and the total size in bytes.
+    All operations are O(1), the least recently used items are evicted first.'''
+
+    def __init__(self, max_items, max_size):
+        self.max_items = max_items
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.size = 0
+        self._items = OrderedDict()  # key => (item, expiry, size), oldest first
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, sliding_window=3600):
+        now = time.time()
+        with self._lock:
+            entry = self._items.get(key)
+            if entry is not None:
+                (item, expiry, size) = entry
+                if expiry > now:
+                    self._items[key] = (item, max(expiry, now + sliding_window), size)
+                    self._items.move_to_end(key)
+                    self.hits = self.hits + 1
+                    return item
+                # expired data
+                del self._items[key]
+                self.size = self.size - size
+            self.misses = self.misses + 1
+        return None
+
+    def put(self, key, item, expiration=3600):
+        size = get_size(item)
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.size = self.size - old[2]
+            if size > self.max_size:
+                return
+            self._items[key] = (item, time.time() + expiration, size)
+            self.size = self.size + size
+            while len(self._items) > self.max_items or self.size > self.max_size:
+                (_, (_, _, evicted_size)) = self._items.popitem(last=False)
+                self.size = self.size - evicted_size
+                self.evictions = self.evictions + 1
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.size = 0
+
+    def get_statistics(self):
+        return {"Memory cache hits": self.hits,
+                "Memory cache misses": self.misses,
+                "Memory cache evictions": self.evictions,
+                "Memory cache bytes held": self.size}
+
+
+class ResponseCache(object):
+    '''Persistent response cache keyed by url, stored in a SQLite database.
+    Each endpoint class has its own TTL, the least recently used entries are evicted
+    when the total size is over max_size bytes.'''
+
+    def __init__(self, path, max_size, ttls):
+        self.path = path
+        self.max_size = max_size
+        self.ttls = ttls
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('''CREATE TABLE IF NOT EXISTS response_cache (
+                                url TEXT PRIMARY KEY,
+                                kind INTEGER,
+                                content BLOB,
+                                size INTEGER,
+                                expiry REAL,
+                                last_access REAL
+                              )''')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS response_cache_last_access ON response_cache(last_access)')
+        self._conn.execute('DELETE FROM response_cache WHERE expiry < ?', (time.time(),))
+        self._total_size = self._conn.execute('SELECT IFNULL(SUM(size), 0) FROM response_cache').fetchone()[0]
+
+    def get(self, url):
+        now = time.time()
+        try:
+            with self._lock:
+                row = self._conn.execute('SELECT kind, content, size FROM response_cache WHERE url = ? AND expiry >= ?',
+                                         (url, now)).fetchone()
+                if row is not None:
+                    self._conn.execute('UPDATE response_cache SET last_access = ? WHERE url = ?', (now, url))
+        except sqlite3.Error as ex:
+            PixivHelper.print_and_log('error', f'Error reading response cache for {url}: {ex}')
+            return None
+
+        if row is None:
+            PixivStatistics.increment("Response cache misses")
+            return None
+        (kind, content, size) = row
+        PixivStatistics.increment("Response cache hits")
+        PixivStatistics.increment("Response cache bytes read", size)
+        if kind == KIND_TEXT:
+            return content.decode("utf8")
+        if kind == KIND_JSON:
+            return json.loads(content)
+        return bytes(content)
+
+    def put(self, url, value):
+        ttl = self.ttls.get(get_endpoint_class(url), 0)
+        if ttl <= 0 or value is None:
+            return
+        if isinstance(value, str):
+            (kind, content) = (KIND_TEXT, value.encode("utf8"))
+        elif isinstance(value, (bytes, bytearray)):
+            (kind, content) = (KIND_BYTES, bytes(value))
+        else:
+            (kind, content) = (KIND_JSON, json.dumps(value).encode("utf8"))
+        size = len(content)
+        if size > self.max_size:
+            return
+
+        now = time.time()
+        try:
+            with self._lock:
+                old = self._conn.execute('SELECT size FROM response_cache WHERE url = ?', (url,)).fetchone()
+                self._conn.execute('INSERT OR REPLACE INTO response_cache VALUES(?, ?, ?, ?, ?, ?)',
+                                   (url, kind, content, size, now + ttl, now))
+                self._total_size = self._total_size + size - (old[0] if old is not None else 0)
+                if self._total_size > self.max_size:
+                    self._evict(now)
+        except sqlite3.Error as ex:
+            PixivHelper.print_and_log('error', f'Error writing response cache for {url}: {ex}')
+            return
+        PixivStatistics.increment("Response cache bytes written", size)
+
+    def _evict(self, now):
+        '''Remove the expired entries, then the least recently used until 90% of max_size.'''
+        self._conn.execute('DELETE FROM response_cache WHERE expiry < ?', (now,))
+        self._total_size = self._conn.execute('SELECT IFNULL(SUM(size), 0) FROM response_cache').fetchone()[0]
+        target = self.max_size * 0.9
+        if self._total_size <= target:
+            return
+        evicted = 0
+        for (url, size) in self._conn.execute('SELECT url, size FROM response_cache ORDER BY last_access').fetchall():
+            self._conn.execute('DELETE FROM response_cache WHERE url = ?', (url,))
+            self._total_size = self._total_size - size
+            evicted = evicted + 1
+            if self._total_size <= target:
+                break
+        PixivStatistics.increment("Response cache evictions", evicted)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def get_cache(config):
+    '''Return the shared persistent response cache, or None if disabled.'''
+    global _cache
+    if config is None or not config.useResponseCache:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            path = config.responseCacheFile
+            if len(path) == 0:
+                db_path = config.dbPath if len(config.dbPath) > 0 else PixivHelper.module_path() + os.sep + "db.sqlite"
+                path = os.path.join(os.path.dirname(os.path.abspath(db_path)), "cache.sqlite")
+            ttls = {ENDPOINT_MEMBER: config.cacheTtlMember,
+                    ENDPOINT_WORKS: config.cacheTtlWorks,
+                    ENDPOINT_SEARCH: config.cacheTtlSearch,
+                    ENDPOINT_OTHER: config.cacheTtlDefault}
+            try:
+                _cache = ResponseCache(path, config.responseCacheMaxSize * 1024 * 1024, ttls)
+                PixivHelper.print_and_log('info', f'Using response cache: {path}')
+            except sqlite3.Error as ex:
+                PixivHelper.print_and_log('error', f'Cannot open response cache {path}: {ex}')
+                config.useResponseCache = False
+                return None
+        return _cache
+
+
+def close():
+    global _cache
+    with _cache_lock:
+        if _cache is not None:
+            _cache.close()
+            _cache = None
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+import email.utils
+import random
+import re
+import time
+from urllib.error import HTTPError
+from urllib.parse import urlparse
+
+import PixivHelper
+import PixivStatistics
+from PixivException import PixivException
+
+# HTTP status code worth retrying, the other errors are returned to the caller as is.
+RETRY_HTTP_CODES = (429, 500, 502, 503, 504)
+# do not wait longer than this even if the server ask for it
+MAX_RETRY_AFTER = 600
+
+__re_id = re.compile(r"^\d+$")
+
+
+def get_endpoint(url):
+    '''Short name of the url for the statistics, e.g. www.pixiv.net/ajax/user'''
+    if hasattr(url, "get_full_url"):
+        url = url.get_full_url()
+    parsed = urlparse(url)
+    segments = [segment for segment in parsed.path.split("/") if len(segment) > 0 and not __re_id.match(segment)]
+    return "/".join([parsed.hostname or ""] + segments[:2])
+
+
+def get_retry_after(error):
+    '''Return the Retry-After header of the HTTPError in seconds, or None.'''
+    headers = getattr(error, "headers", None) or getattr(error, "hdrs", None)
+    if headers is None:
+        return None
+    value = headers.get("Retry-After")
+    if value is None:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return min(int(value), MAX_RETRY_AFTER)
+    try:
+        retry_date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return min(max(retry_date.timestamp() - time.time(), 0), MAX_RETRY_AFTER)
+
+
+class RetryPolicy(object):
+    '''Exponential backoff with decorrelated jitter, with separate retry budget for connection and HTTP errors.'''
+
+    def __init__(self, base_wait, max_wait, connection_retry, http_retry):
+        self.base_wait = max(float(base_wait), 0.1)
+        self.max_wait = max(float(max_wait), self.base_wait)
+        self.connection_retry = connection_retry
+        self.http_retry = http_retry
+
+    @classmethod
+    def from_config(cls, config, connection_retry=0):
+        if connection_retry == 0:
+            connection_retry = config.retry
+        return cls(config.retryWait, config.retryMaxWait, connection_retry, config.retryHttp)
+
+    def start(self, url):
+        return RetryState(self, url)
+
+
+class RetryState(object):
+    '''Retry state of one request, call next_delay() for each error.'''
+
+    def __init__(self, policy, url):
+        self.policy = policy
+        self.endpoint = get_endpoint(url)
+        self.connection_retry_count = 0
+        self.http_retry_count = 0
+        self._last_delay = policy.base_wait
+
+    def next_delay(self, error):
+        '''Return how long to wait before retrying, or None if the error should not be retried.'''
+        if isinstance(error, (KeyboardInterrupt, SystemExit, PixivException)):
+            return None
+        policy = self.policy
+        if isinstance(error, HTTPError):
+            if error.code not in RETRY_HTTP_CODES or self.http_retry_count >= policy.http_retry:
+                return None
+            self.http_retry_count = self.http_retry_count + 1
+        else:
+            if self.connection_retry_count >= policy.connection_retry:
+                return None
+            self.connection_retry_count = self.connection_retry_count + 1
+
+        # decorrelated jitter: random between base and 3x the previous delay, capped.
+        delay = min(policy.max_wait, random.uniform(policy.base_wait, self._last_delay * 3))
+        self._last_delay = delay
+        if isinstance(error, HTTPError):
+            retry_after = get_retry_after(error)
+            if retry_after is not None:
+                # spread the workers waiting for the same Retry-After
+                delay = retry_after + random.uniform(0, policy.base_wait)
+
+        PixivStatistics.increment(f"Retries {self.endpoint}")
+        return delay
+
+    def wait(self, error, delay):
+        PixivHelper.print_and_log(None, f"{error}, retrying in {delay:.1f}s...")
+        time.sleep(delay)
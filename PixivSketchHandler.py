@@ -119,11 +119,12 @@ def download_post(caller, config, post):
                                                                  image=post,
                                                                  download_from=PixivConstant.DOWNLOAD_SKETCH)
         if result == PixivConstant.PIXIVUTIL_OK:
-            db.insertSketchPost(post)
-            db.insertSketchPostImages(post.imageId,
-                                      current_page,
-                                      filename,
-                                      post.worksDateDateTime,
-                                      post.worksUpdateDateTime)
+            with db.transaction():
+                db.insertSketchPost(post)
+                db.insertSketchPostImages(post.imageId,
+                                          current_page,
+                                          filename,
+                                          post.worksDateDateTime,
+                                          post.worksUpdateDateTime)
 
         current_page = current_page + 1
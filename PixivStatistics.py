@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+import threading
+
+import PixivHelper
+
+_counters = dict()
+_providers = list()
+_lock = threading.Lock()
+
+
+def increment(name, value=1):
+    '''Add value to the named counter of the run summary.'''
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def register(provider):
+    '''Add a function returning a dict of name => value, called when printing the summary.'''
+    with _lock:
+        _providers.append(provider)
+
+
+def get(name):
+    with _lock:
+        return _counters.get(name, 0)
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+
+
+def print_summary():
+    '''Print the non zero counters, in the order they were first used.'''
+    with _lock:
+        counters = [(name, value) for (name, value) in _counters.items() if value]
+        providers = list(_providers)
+    for provider in providers:
+        counters.extend((name, value) for (name, value) in provider().items() if value)
+    if len(counters) == 0:
+        return
+    PixivHelper.print_and_log('info', 'Run summary:')
+    width = max(len(name) for (name, _) in counters)
+    for (name, value) in counters:
+        PixivHelper.print_and_log('info', f' - {name:{width}} : {value}')
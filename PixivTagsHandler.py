@@ -104,6 +104,7 @@ def process_tags(caller,
             if flag:
                 # Issue #1090 reset retry flag on succesfull load
                 empty_page_retry = 0
+                downloaded_ids = PixivImageHandler.get_downloaded_image_ids(caller, config, [item.imageId for item in t.itemList])
 
                 for item in t.itemList:
                     last_image_id = item.imageId
@@ -141,7 +142,10 @@ def process_tags(caller,
                                                                                                              skipped_count,
                                                                                                              total_image)
                             result = PixivConstant.PIXIVUTIL_OK
-                            if not caller.DEBUG_SKIP_PROCESS_IMAGE:
+                            if item.imageId in downloaded_ids:
+                                PixivHelper.print_and_log(None, f'Already downloaded in DB: {item.imageId}')
+                                result = PixivConstant.PIXIVUTIL_SKIP_DUPLICATE_NO_WAIT
+                            elif not caller.DEBUG_SKIP_PROCESS_IMAGE:
                                 result = PixivImageHandler.process_image(caller,
                                                                          config,
                                                                          None,
@@ -23,15 +23,19 @@ import PixivBrowserFactory
 import PixivConfig
 import PixivConstant
 import PixivFanboxHandler
+import PixivFileIndex
 import PixivHelper
 import PixivImageHandler
 import PixivListHandler
 import PixivModelFanbox
 import PixivNovelHandler
+import PixivProgress
 import PixivRankingHandler
+import PixivResponseCache
 import PixivSketchHandler
+import PixivStatistics
 import PixivTagsHandler
-from PixivDBManager import PixivDBManager
+from PixivDBManager import ConcurrentDBManager, PixivDBManager
 from PixivException import PixivException
 from PixivTags import PixivTags
 
@@ -1296,6 +1300,19 @@ d  - Manage database''')
     parser.add_option('-c', '--config', dest='configlocation',
                       default=None,
                       help='Load the config file from a custom location')
+    parser.add_option('-q', '--quiet',
+                      dest='quiet',
+                      default=False,
+                      help='Do not show the download progress.',
+                      action='store_true')
+    parser.add_option('--progress',
+                      dest='progress',
+                      default=PixivProgress.MODE_BAR,
+                      choices=list(PixivProgress.MODES),
+                      help='''Download progress display:                              \n
+ bar  - progress bar (default).                     \n
+ json - json lines on stderr, for headless usage.   \n
+ none - same as --quiet.''')
     parser.add_option('--bf', '--batch_file',
                       dest='batch_file',
                       default=None,
@@ -1432,6 +1449,8 @@ def main_loop(ewd, op_is_valid, selection, np_is_valid_local, args, options):
                 selection = op
             else:
                 selection = menu()
+            # see the files changed by other programs since the previous operation.
+            PixivFileIndex.clear()
 
             if selection == '1':
                 menu_download_by_member_id(op_is_valid, args, options)
@@ -1628,6 +1647,7 @@ def main():
 
     ewd = options.exit_when_done
     configfile = options.configlocation
+    PixivProgress.configure(PixivProgress.MODE_NONE if options.quiet else options.progress)
 
     try:
         if options.number_of_pages is not None:
@@ -1695,7 +1715,10 @@ def main():
         PixivHelper.print_and_log("warn", f"Post Processing after download is enabled: {__config__.postProcessingCmd}")
 
     try:
-        __dbManager__ = PixivDBManager(root_directory=__config__.rootDirectory, target=__config__.dbPath)
+        __dbManager__ = ConcurrentDBManager(PixivDBManager(root_directory=__config__.rootDirectory,
+                                                           target=__config__.dbPath,
+                                                           synchronous=__config__.dbSynchronous,
+                                                           journal_mode=__config__.dbJournalMode))
         __dbManager__.createDatabase()
 
         if __config__.useList:
@@ -1787,6 +1810,8 @@ def main():
         PixivHelper.print_and_log("error", f"Unknown Error, please check the log file: {sys.exc_info()}")
         ERROR_CODE = getattr(ex, 'errorCode', -1)
     finally:
+        PixivStatistics.print_summary()
+        PixivResponseCache.close()
         __dbManager__.close()
         if not ewd:  # Yavos: prevent input on exit_when_done
             if selection is None or selection != 'x':
@@ -1,9 +1,11 @@
 #!C:/Python37-32/python
 # -*- coding: UTF-8 -*-
 
+import sqlite3
+import threading
 import unittest
 import PixivConstant
-from PixivDBManager import PixivDBManager
+from PixivDBManager import ConcurrentDBManager, ImageIdIndex, PixivDBManager
 from PixivListItem import PixivListItem
 
 LIST_SIZE = 9
@@ -38,6 +40,205 @@ class TestPixivDBManager(unittest.TestCase):
         for item in result:
             print(item.memberId, item.path)
 
+    def test_RemoteFileInfo(self):
+        DB = PixivDBManager(root_directory=".", target="test.db.sqlite")
+        DB.createDatabase()
+        DB.deleteImage(123456789)
+        # saved before the page is inserted
+        DB.updateRemoteFileInfo(PixivConstant.DOWNLOAD_PIXIV, 123456789, 0, 1000, '"abc"', None)
+        self.assertIsNone(DB.selectRemoteFileInfo(PixivConstant.DOWNLOAD_PIXIV, 123456789, 0))
+        DB.insertMangaImages([(123456789, 0, "test.jpg"), (123456789, 1, "test_p1.jpg")])
+        result = DB.selectRemoteFileInfo(PixivConstant.DOWNLOAD_PIXIV, 123456789, 0)
+        self.assertEqual(result[0:3], (1000, '"abc"', None))
+        self.assertIsNone(DB.selectRemoteFileInfo(PixivConstant.DOWNLOAD_PIXIV, 123456789, 1)[0])
+
+        DB.updateRemoteFileInfo(PixivConstant.DOWNLOAD_PIXIV, 123456789, 1, 2000, None, "Wed, 01 Jan 2020 00:00:00 GMT")
+        result = DB.selectRemoteFileInfo(PixivConstant.DOWNLOAD_PIXIV, 123456789, 1)
+        self.assertEqual(result[0:3], (2000, None, "Wed, 01 Jan 2020 00:00:00 GMT"))
+        self.assertIsNotNone(result[3])
+        DB.deleteImage(123456789)
+
+        # the info of the pages never inserted is dropped at the end of the post
+        DB.updateRemoteFileInfo(PixivConstant.DOWNLOAD_PIXIV, 123456789, 2, 3000, None, None)
+        DB.discardPendingRemoteFileInfo(PixivConstant.DOWNLOAD_PIXIV, 123456789)
+        self.assertEqual(len(DB._pending_remote_file_info), 0)
+
+    def test_Migrations(self):
+        DB = PixivDBManager(root_directory=".", target=":memory:")
+        c = DB.conn.cursor()
+        # database created before the migrations were recorded, with some columns already added
+        c.execute('''CREATE TABLE pixiv_master_member (member_id INTEGER PRIMARY KEY ON CONFLICT IGNORE, name TEXT, save_folder TEXT,
+                     created_date DATE, last_update_date DATE, last_image INTEGER, is_deleted INTEGER DEFAULT 0)''')
+        DB.conn.commit()
+        DB.createDatabase()
+
+        c.execute('''SELECT version FROM schema_migrations ORDER BY version''')
+        versions = [row[0] for row in c.fetchall()]
+        self.assertEqual(versions, [migration[0] for migration in PixivDBManager.MIGRATIONS])
+        c.execute('''SELECT name FROM sqlite_master WHERE type = 'index' AND name LIKE 'idx_%' ''')
+        indexes = set(row[0] for row in c.fetchall())
+        self.assertIn("idx_pixiv_master_image_member_id", indexes)
+        self.assertIn("idx_pixiv_master_member_last_update_date", indexes)
+
+        # already applied migrations are skipped
+        DB.createDatabase()
+        c.execute('''SELECT COUNT(*) FROM schema_migrations''')
+        self.assertEqual(c.fetchone()[0], len(PixivDBManager.MIGRATIONS))
+
+        c.execute('''EXPLAIN QUERY PLAN SELECT * FROM pixiv_master_image WHERE member_id = ?''', (1, ))
+        self.assertIn("idx_pixiv_master_image_member_id", str(c.fetchall()))
+
+        DB.insertNewMember(1)
+        DB.insertNewMember(2)
+        DB.insertNewMember(3)
+        c.execute('''UPDATE pixiv_master_member SET last_update_date = datetime('now', '-10 days') WHERE member_id = 2''')
+        c.execute('''UPDATE pixiv_master_member SET last_update_date = datetime('now') WHERE member_id = 3''')
+        DB.conn.commit()
+        result = DB.selectMembersByLastDownloadDate(7)
+        self.assertEqual([item.memberId for item in result], [1, 2])
+        c.execute('''EXPLAIN QUERY PLAN SELECT member_id FROM pixiv_master_member
+                     WHERE is_deleted <> 1 AND last_update_date < date('now', '-7 days') ORDER BY +member_id''')
+        self.assertIn("idx_pixiv_master_member_last_update_date", str(c.fetchall()))
+        DB.close()
+
+    def test_Transaction(self):
+        DB = PixivDBManager(root_directory=".", target="test.db.sqlite")
+        DB.createDatabase()
+        DB.deleteImage(123456780)
+        with self.assertRaises(ValueError):
+            with DB.transaction():
+                DB.insertImage(1, 123456780, "big")
+                DB.updateImage(123456780, "title", "test.jpg", "big")
+                raise ValueError()
+        self.assertIsNone(DB.selectImageByImageId(123456780))
+
+        with DB.transaction():
+            DB.insertImage(1, 123456780, "big")
+            with DB.transaction():
+                DB.updateImage(123456780, "title", "test.jpg", "big")
+            self.assertTrue(DB.conn.in_transaction)
+        self.assertFalse(DB.conn.in_transaction)
+        self.assertEqual(DB.selectImageByImageId(123456780, cols='save_name')[0], "test.jpg")
+        DB.deleteImage(123456780)
+
+    def test_ImageIdIndex(self):
+        index = ImageIdIndex([1, 5, 9])
+        self.assertIn(5, index)
+        self.assertNotIn(4, index)
+        index.MERGE_SIZE = 2
+        index.add(4)
+        index.add(100)
+        index.discard(1)
+        self.assertEqual([i for i in range(101) if i in index], [4, 5, 9, 100])
+
+        DB = PixivDBManager(root_directory=".", target=":memory:")
+        DB.createDatabase()
+        DB.insertImage(1, 123)
+        DB.updateImage(123, "title", "123.jpg")
+        self.assertTrue(DB.isImageDownloaded("123"))
+        DB.insertImage(1, 456)
+        # not downloaded until the filename is saved
+        self.assertFalse(DB.isImageDownloaded(456))
+        DB.updateImage(456, "title", "456.jpg")
+        DB.blacklistImage(1, 789)
+        # left at 'N/A' by an interrupted insert
+        DB.insertImage(1, 999)
+        DB._image_index = None
+        self.assertEqual(DB.selectDownloadedImageIds([123, 456, 789, 999, 1000]), {123, 456, 789})
+        DB.deleteImage(456)
+        self.assertFalse(DB.isImageDownloaded(456))
+        self.assertFalse(DB.isImageDownloaded("SbliQHtJS5MMu3elqDFZ"))
+        with self.assertRaises(ValueError):
+            with DB.transaction():
+                DB.insertImage(1, 1000)
+                raise ValueError()
+        self.assertFalse(DB.isImageDownloaded(1000))
+        DB.close()
+
+    def test_CleanUp(self):
+        DB = PixivDBManager(root_directory=".", target=":memory:")
+        DB.createDatabase()
+        DB.CLEANUP_CHUNK_SIZE = 2
+        for image_id in range(1, 6):
+            DB.insertImage(1, image_id)
+            DB.updateImage(image_id, "title", __file__ if image_id % 2 == 0 else f"missing_{image_id}.jpg", "big")
+        DB.cleanUp()
+        self.assertEqual(DB.selectDownloadedImageIds(range(1, 6)), {2, 4})
+        self.assertFalse(DB.isImageDownloaded(3))
+        DB.close()
+
+    def test_InsertImageTags(self):
+        DB = PixivDBManager(root_directory=".", target=":memory:")
+        DB.createDatabase()
+        DB.insertTag("existing")
+        DB.insertImageTags([(1, "existing"), (1, "new"), (2, "new")],
+                           [("new", "romaji", "nyuu"), ("new", "en", "new")])
+        self.assertEqual(set(DB._known_tags), {"existing", "new"})
+        self.assertEqual([row[0] for row in DB.selectTagsByImageId(2)], ["new"])
+
+        # the changed translation is updated, the others are skipped
+        DB.insertImageTags([(3, "new")], [("new", "romaji", "nyuu"), ("new", "en", "New")])
+        c = DB.conn.cursor()
+        c.execute('''SELECT translation_type, translation FROM pixiv_tag_translation ORDER BY translation_type''')
+        self.assertEqual(c.fetchall(), [("en", "New"), ("romaji", "nyuu")])
+        c.close()
+
+        with self.assertRaises(ValueError):
+            with DB.transaction():
+                DB.insertImageTags([(4, "rolled back")], [])
+                raise ValueError()
+        self.assertIsNone(DB._known_tags)
+        DB.insertImageTags([(4, "rolled back")], [])
+        self.assertEqual([row[0] for row in DB.selectTagsByImageId(4)], ["rolled back"])
+        DB.close()
+
+    def test_ConcurrentDBManager(self):
+        DB = ConcurrentDBManager(PixivDBManager(root_directory=".", target="test.db.sqlite"))
+        DB.createDatabase()
+        image_ids = [123456700 + i for i in range(40)]
+        for image_id in image_ids:
+            DB.deleteImage(image_id)
+
+        def worker(ids):
+            for image_id in ids:
+                with DB.transaction():
+                    DB.insertImage(1, image_id, "big")
+                    DB.updateImage(image_id, "title", f"{image_id}.jpg", "big")
+                self.assertEqual(DB.selectImageByImageId(image_id, cols='save_name')[0], f"{image_id}.jpg")
+
+        threads = [threading.Thread(target=worker, args=(image_ids[i::4], )) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(DB.selectDownloadedImageIds(image_ids), set(image_ids))
+
+        # the failed block is rolled back
+        with self.assertRaises(AttributeError):
+            with DB.transaction():
+                DB.deleteImage(image_ids[0])
+                DB.insertNovelPost(None, None)
+        self.assertIsNotNone(DB.selectImageByImageId(image_ids[0]))
+
+        # saving an image already in DB again does not fail the unit
+        with DB.transaction():
+            DB.insertImage(1, image_ids[1], "big")
+            DB.updateImage(image_ids[1], "title", "again.jpg", "big")
+        self.assertEqual(DB.selectImageByImageId(image_ids[1], cols='save_name')[0], "again.jpg")
+
+        # the index is reloaded after clean-up deleted the missing files
+        self.assertTrue(DB.isImageDownloaded(image_ids[0]))
+        DB.cleanUp()
+        self.assertIsNone(DB.selectImageByImageId(image_ids[0]))
+        self.assertFalse(DB.isImageDownloaded(image_ids[0]))
+
+        for image_id in image_ids:
+            DB.deleteImage(image_id)
+        DB.close()
+        # the writes after close() fail instead of waiting for the stopped writer
+        with self.assertRaises(sqlite3.ProgrammingError):
+            DB.deleteImage(image_ids[0])
+
 
 # if __name__ == '__main__':
 #     suite = unittest.TestLoader().loadTestsFromTestCase(TestPixivDBManager)
@@ -1,9 +1,11 @@
 #!C:/Python37-32/python
 # -*- coding: UTF-8 -*-
 
+import io
 import json
 import os
 import platform
+import threading
 from typing import Tuple
 import unittest
 
@@ -12,8 +14,10 @@ from bs4 import BeautifulSoup
 from PixivBrowserFactory import PixivBrowser
 import PixivConfig
 import PixivConstant
+import PixivFileIndex
 import PixivHelper
 from PixivArtist import PixivArtist
+from PixivException import PixivException
 from PixivImage import PixivImage
 
 PixivConstant.PIXIVUTIL_LOG_FILE = 'pixivutil.test.log'
@@ -329,6 +333,112 @@ class TestPixivHelper(unittest.TestCase):
         # print(r)
         self.assertTrue(len(r) > 0)
 
+    def testBufferedConsole(self):
+        stream = io.StringIO()
+        console = PixivHelper.BufferedConsole(stream)
+
+        def worker(name):
+            with console.capture():
+                for i in range(3):
+                    console.write(f"\r{name} {i}")
+                console.write(f"\ndone {name}\n")
+
+        threads = [threading.Thread(target=worker, args=(name,)) for name in ("a", "b")]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        output = stream.getvalue()
+        self.assertIn("a 2\ndone a\n", output)
+        self.assertIn("b 2\ndone b\n", output)
+        self.assertNotIn("a 0", output)
+
+        # the output so far is written at flush_captured()
+        with console.capture():
+            console.write("post 1\n")
+            console.flush_captured()
+            self.assertTrue(stream.getvalue().endswith("post 1\n"))
+            console.write("post 2\n")
+        self.assertTrue(stream.getvalue().endswith("post 1\npost 2\n"))
+
+    def testResumeDownload(self):
+        filename = os.path.abspath("./test.resume.zip")
+        url = "https://i.pximg.net/img-zip-ugoira/test.zip"
+        with open(filename + ".pixiv", "wb") as partial:
+            partial.write(b"x" * 100)
+        headers = {"Accept-Ranges": "bytes", "ETag": '"abc"', "Content-Length": "1000"}
+        PixivHelper.save_resume_info(url, filename, headers, 1000)
+
+        info = PixivHelper.get_resume_info(url, filename)
+        self.assertEqual(info["offset"], 100)
+        self.assertEqual(PixivHelper.get_resume_headers(info), {"Range": "bytes=100-", "If-Range": '"abc"'})
+        self.assertEqual(PixivHelper.get_resume_offset(url, filename, info, 200, {}), 0)
+        self.assertEqual(PixivHelper.get_resume_offset(url, filename, info, 206, {"Content-Range": "bytes 100-999/1000", "ETag": '"abc"'}), 100)
+
+        # partial file is removed when the range does not match
+        self.assertRaises(PixivException, PixivHelper.get_resume_offset, url, filename, info, 206, {"Content-Range": "bytes 0-999/1000"})
+        self.assertFalse(os.path.exists(filename + ".pixiv"))
+        self.assertFalse(os.path.exists(filename + ".pixiv.resume"))
+        self.assertIsNone(PixivHelper.get_resume_info(url, filename))
+
+    def testDownloadImage(self):
+        _config = PixivConfig.PixivConfig()
+        _config.downloadBuffer = 1
+        PixivHelper.set_config(_config)
+        filename = os.path.abspath("./test.download.jpg")
+        url = "https://i.pximg.net/img-original/img/test.jpg"
+        content = os.urandom(5000)
+
+        (size, saved) = PixivHelper.download_image(url, filename, io.BytesIO(content), len(content), True)
+        self.assertEqual(size, len(content))
+        with open(saved, "rb") as result:
+            self.assertEqual(result.read(), content)
+        os.remove(saved)
+
+        # incomplete download, the partial file of a resumable download is not preallocated
+        headers = {"Accept-Ranges": "bytes", "ETag": '"abc"'}
+        self.assertRaises(PixivException, PixivHelper.download_image, url, filename, io.BytesIO(content[:3000]), len(content), True, 0, headers)
+        self.assertEqual(os.path.getsize(filename + ".pixiv"), 3000)
+        self.assertEqual(PixivHelper.get_resume_info(url, filename)["offset"], 3000)
+        PixivHelper.discard_partial_download(filename)
+
+        # the partial file only contains the received bytes during the transfer, so it can be resumed after a crash
+        sizes = list()
+
+        class Response(io.BytesIO):
+            def readinto(self, buffer):
+                if os.path.exists(filename + ".pixiv"):
+                    sizes.append(os.path.getsize(filename + ".pixiv"))
+                return super().readinto(buffer)
+        PixivHelper.download_image(url, filename, Response(content), len(content), True, 0, headers)
+        self.assertLess(max(sizes), len(content))
+        os.remove(filename)
+
+
+    def testFileIndex(self):
+        directory = os.path.abspath("./test.fileindex")
+        filename = os.path.join(directory, "sub", "test.jpg")
+        PixivHelper.makeSubdirs(filename)
+        self.assertTrue(PixivFileIndex.exists(os.path.dirname(filename)))
+        self.assertFalse(PixivFileIndex.isfile(filename))
+
+        # written by us, the listing is updated
+        with open(filename, "wb") as f:
+            f.write(b"x" * 100)
+        PixivFileIndex.invalidate(filename)
+        self.assertTrue(PixivFileIndex.isfile(filename))
+        self.assertEqual(PixivFileIndex.getsize(filename), 100)
+        self.assertEqual(PixivFileIndex.getmtime(filename), os.path.getmtime(filename))
+
+        # changed outside, the cached listing is used until cleared
+        os.remove(filename)
+        self.assertTrue(PixivFileIndex.exists(filename))
+        PixivFileIndex.clear()
+        self.assertFalse(PixivFileIndex.exists(filename))
+        self.assertRaises(FileNotFoundError, PixivFileIndex.getsize, filename)
+        os.rmdir(os.path.dirname(filename))
+        os.rmdir(directory)
+
 
 if __name__ == '__main__':
     # unittest.main()